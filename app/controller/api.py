@@ -31,15 +31,34 @@ A basic HTTP REST API for the Basium registered classes
 
 If you want to use this, symlink or copy to your web server documentroot
 If you use a symlink, make sure apache follows symlinks
+
+Rows from GET /<table> and GET /<table>/filter are sent in one of
+    NDJSON or the binary wire format, if in the Accept header. All rows
+        are streamed, without paging. With the psql and mysql drivers set
+        DbConf.itersize on the server, so the rows are not read into memory
+    JSON, one page at a time. The page is app.pageSize rows, or the limit
+        in the query up to app.maxPageSize. The response has a "next"
+        continuation token, null on the last page. Repeat the request
+        with the parameter after=<token> to get the next page
+
+To walk a full table, use NDJSON or binary (the json driver does), or
+follow the "next" tokens. Without an order, or ordered on _id, the token
+is the last _id so each page is an index lookup. Other queries continue
+with an offset
 """
 
 import json
+import zlib
+import functools
 import urllib
+import urllib.parse
+import email.utils
 
 import basium_common as bc
 import basium_model
 # import basium_driver
 import basium_driver_json
+import basium_wire
 
 from wsgi.common import *
 
@@ -55,6 +74,237 @@ def writejson(resp):
         raise bc.Error(1, "JSON TypeError for " + resp.dict())
 
 
+NDJSON = basium_driver_json.NDJSON
+NDJSON_CHUNK = 500      # number of rows sent in each write
+
+
+def acceptsNdjson():
+    return request.accept is not None and NDJSON in request.accept
+
+
+def selectRows(dbquery):
+    """
+    Select the rows matching the query. If the client sends the header
+    X-Want-Count, the total number of matching rows, ignoring limit, is
+    returned in the X-Result-Count header
+    """
+    if "X-Want-Count" in request.headers:
+        rows, count = db.driver.selectWithCount(dbquery)
+        response.addHeader('X-Result-Count', str(count))
+        return rows
+    return db.driver.select(dbquery)
+
+
+def writendjson(obj, dbquery):
+    """
+    Stream the rows matching the query as newline delimited JSON
+    First line is a header {"errno": 0, "errmsg": "", "columns": [<name>, ...]}
+    then one line per row, a list with the values in column order.
+    An error after the header is sent as a last line {"errno": .., "errmsg": ..}
+    """
+    codec = db.codecs[obj._table]
+    try:
+        rows = selectRows(dbquery)  # we call driver directly for efficiency reason
+    except db.Error as e:
+        writejson(bc.Response(e.errno, e.errmsg))
+        return
+
+    def generate():
+        yield json.dumps({"errno": 0, "errmsg": "", "columns": codec.colnames}) + "\n"
+        try:
+            for text in codec.serialize(rows, asList=True, separator="\n", end=True, chunk=NDJSON_CHUNK):
+                yield text
+        except Exception as e:     # the driver errors are not caught by the handler here
+            log.error("Error streaming rows from table '%s'. %s" % (obj._table, e))
+            yield json.dumps({"errno": 1, "errmsg": str(e)}) + "\n"
+
+    response.content_type = NDJSON
+    response.stream(generate())
+
+
+def writejsonrows(obj, dbquery, after=None):
+    """
+    Stream one page of the rows matching the query as a JSON response
+        {"errno": 0, "errmsg": "", "data": [{<column>: <value>, ..}, ..], "next": <token>}
+    Rows are serialized with the compiled serializer for the table, see
+    basium_codec. An error after the start is sent as errno and errmsg
+    after data, a JSON parser keeps the last value of a repeated key
+    With X-Want-Count and a keyset token, the count is of the rows
+    from the page on
+    """
+    codec = db.codecs[obj._table]
+    try:
+        pagesize, nextToken = pageQuery(obj, dbquery, after)
+    except ValueError:
+        writejson(bc.Response(1, "Illegal continuation token '%s'" % after))
+        return
+    try:
+        rows = selectRows(dbquery)  # we call driver directly for efficiency reason
+    except db.Error as e:
+        msg = "Could not load objects from table '%s'. %s" % (obj._table, e)
+        log.debug(msg)
+        writejson(bc.Response(1, msg))
+        response.status_code = '404 ' + msg
+        return
+    page = {"last": None, "more": False}
+
+    def pageRows():
+        for count, row in enumerate(rows):
+            if count == pagesize:
+                page["more"] = True
+                break
+            page["last"] = row
+            yield row
+
+    def generate():
+        yield '{"errno": 0, "errmsg": "", "data": ['
+        try:
+            for text in codec.serialize(pageRows(), chunk=NDJSON_CHUNK):
+                yield text
+        except Exception as e:     # the driver errors are not caught by the handler here
+            log.error("Error streaming rows from table '%s'. %s" % (obj._table, e))
+            yield '], "errno": 1, "errmsg": %s}' % json.dumps(str(e))
+            return
+        token = nextToken(page["last"]) if page["more"] else None
+        yield '], "next": %s}' % json.dumps(token)
+
+    response.content_type = 'application/json'
+    response.stream(generate())
+
+
+def decodeQuery(obj):
+    """
+    Decode the query string as a query on obj
+    Returns (query, after), after is the continuation token or None
+    """
+    dbquery = db.query(obj)
+    after = None
+    params = []
+    for key, val in urllib.parse.parse_qsl(request.query_string or "", keep_blank_values=True):
+        if key == "after":
+            after = val
+        else:
+            params.append((key, val))
+    dbquery.decode(urllib.parse.urlencode(params))
+    return dbquery, after
+
+
+def pageQuery(obj, dbquery, after):
+    """
+    Limit the query to one page, starting at the continuation token after
+    Returns (page size, function that returns the token for the next page
+    from the last row of this page). One row more than the page size is
+    selected, to know if there is a next page
+    Raises ValueError if the token is not valid
+    """
+    orders = dbquery._order
+    if dbquery._limit is None and len(orders) <= 1 and all(order.column.name == '_id' for order in orders):
+        # keyset, the next page starts after the last _id
+        desc = orders[0].desc if orders else False
+        if not orders:
+            dbquery.order(obj.q._id)
+        if after is not None:
+            if not after.startswith("k"):
+                raise ValueError(after)
+            dbquery.filter(obj.q._id, '<' if desc else '>', int(after[1:]))
+        dbquery.limit(0, app.pageSize + 1)
+        return app.pageSize, lambda row: "k%d" % row["_id"]
+
+    first = 0
+    rowcount = None
+    if dbquery._limit is not None:
+        first = dbquery._limit.offset or 0
+        rowcount = dbquery._limit.rowcount
+    start = first
+    if after is not None:
+        if not after.startswith("o") or int(after[1:]) < first:
+            raise ValueError(after)
+        start = int(after[1:])
+    if rowcount is None:
+        pagesize = app.pageSize
+        fetch = pagesize + 1
+    else:
+        remaining = max(first + rowcount - start, 0)
+        pagesize = min(remaining, app.maxPageSize)
+        fetch = pagesize if remaining <= pagesize else pagesize + 1
+    dbquery.limit(start, fetch)
+    return pagesize, lambda row: "o%d" % (start + pagesize)
+
+
+def notModified(obj, after=None):
+    """
+    Send ETag and Last-Modified, derived from the table version
+    The ETag also depends on the format sent (binary, NDJSON or JSON),
+    X-Want-Count and the page token, the response varies with them
+    Returns True if the client copy, from If-None-Match, is current.
+    The response is then 304 and nothing more should be written
+    """
+    version, mtime = db.tableVersion(obj._table)
+    if acceptsBinary():
+        fmt = "b"
+    elif acceptsNdjson():
+        fmt = "n"
+    else:
+        fmt = "j"
+    if "X-Want-Count" in request.headers:
+        fmt += "c"
+    if after is not None:
+        fmt += "%x" % zlib.crc32(after.encode("utf-8"))
+    etag = 'W/"%x-%x-%s"' % (version, int(mtime * 1000), fmt)
+    response.addHeader("ETag", etag)
+    response.addHeader("Vary", "Accept, Accept-Encoding, X-Want-Count")
+    response.addHeader("Last-Modified", email.utils.formatdate(mtime, usegmt=True))
+    tags = request.headers.get("If-None-Match")
+    if tags is None:
+        return False
+    tags = [tag.strip() for tag in tags.split(",")]
+    if "*" in tags or etag in tags or etag[2:] in tags:
+        response.status_code = "304 Not Modified"
+        return True
+    return False
+
+
+def acceptsBinary():
+    return request.accept is not None and basium_wire.CONTENT_TYPE in request.accept
+
+
+def writebinary(obj, dbquery):
+    """
+    Stream the rows matching the query in the binary wire format,
+    see basium_wire. Rows are encoded NDJSON_CHUNK rows per block
+    """
+    columns = basium_wire.columnTypes(obj)
+    try:
+        rows = selectRows(dbquery)  # we call driver directly for efficiency reason
+    except db.Error as e:
+        writejson(bc.Response(e.errno, e.errmsg))
+        return
+    names = [name for name, typ in columns]
+    # raw database values are packed, converted only when needed
+    encoder = basium_wire.Encoder(columns, [functools.partial(db.driver.toPython, obj._columns[name]) for name in names])
+
+    def generate():
+        yield encoder.header()
+        block = []
+        try:
+            for row in rows:
+                block.append([row[name] for name in names])
+                if len(block) >= NDJSON_CHUNK:
+                    yield encoder.block(block)
+                    block = []
+            if block:
+                yield encoder.block(block)
+        except Exception as e:     # the driver errors are not caught by the handler here
+            log.error("Error streaming rows from table '%s'. %s" % (obj._table, e))
+            yield encoder.error(1, str(e))
+            return
+        yield encoder.end()
+
+    response.content_type = basium_wire.CONTENT_TYPE
+    response.content_encoding = None    # binary, no charset
+    response.stream(generate())
+
+
 def getclass(table):
     """Return a model object for the table"""
     if table not in db.cls:
@@ -62,30 +312,24 @@ def getclass(table):
     return db.cls[table]()
 
 
-def getData(obj):
-    decodeddata = {}
-    postdata = request.form()
-    for key in obj._columns:
-        if key in postdata.keys():
-            column = obj._columns[key]
-            data = postdata[key]
-            if isinstance(column, basium_model.BooleanCol):
-                data = basium_driver_json.BooleanCol.toPython(data)
-            elif isinstance(column, basium_model.DateCol):
-                data = basium_driver_json.DateCol.toPython(data)
-            elif isinstance(column, basium_model.DateTimeCol):
-                data = basium_driver_json.DateTimeCol.toPython(data)
-            elif isinstance(column, basium_model.DecimalCol):
-                data = basium_driver_json.DecimalCol.toPython(data)
-            elif isinstance(column, basium_model.FloatCol):
-                data = basium_driver_json.FloatCol.toPython(data)
-            elif isinstance(column, basium_model.IntegerCol):
-                data = basium_driver_json.IntegerCol.toPython(data)
-            elif isinstance(column, basium_model.VarcharCol):
-                data = basium_driver_json.VarcharCol.toPython(data)
-            decodeddata[key] = column.toSql(data)        # encode to database specific format
-        else:
-            log.warning("Warning, missing key/column %s" % key)
+def getData(obj, postdata=None):
+    """
+    Decode column values sent by the json driver, and encode them for the
+    database driver. Default is to use the posted form data
+    """
+    codec = db.codecs[obj._table]
+    typed = False
+    if postdata is None and (request.content_type or "").startswith(basium_wire.CONTENT_TYPE):
+        # binary wire format, values are already typed
+        postdata = basium_wire.decodeValues(request.getBody())
+        typed = True
+    elif postdata is None:
+        postdata = request.form()
+    decodeddata = codec.decode(postdata, typed)
+    if len(decodeddata) < len(codec.colnames):
+        for key in codec.colnames:
+            if key not in decodeddata:
+                log.warning("Warning, missing key/column %s" % key)
     return decodeddata
 
 
@@ -111,51 +355,131 @@ def _table(request, response, table):
     writejson(resp)
 
 
+@app.route("/_batch", methods=["POST"])
+def handleBatch(request, response):
+    """
+    Execute a list of operations in one transaction
+    The body is a JSON list, each operation is one of
+        {"op": "insert", "table": <table>, "values": {<column>: <value>, ...}}
+        {"op": "update", "table": <table>, "values": {<column>: <value>, ..., "_id": <id>}}
+        {"op": "delete" | "select" | "count", "table": <table>, "query": <encoded query>}
+    Returns a list with one result per operation
+    """
+    resp = bc.Response()
+    try:
+        ops = []
+        for item in request.json():
+            obj = getclass(item["table"])
+            op = item["op"]
+            if op in ("insert", "update"):
+                ops.append((op, obj._table, getData(obj, item["values"])))
+            else:
+                dbquery = db.query(obj)
+                dbquery.decode(item.get("query", ""))
+                ops.append((op, obj._table, dbquery))
+        log.debug("Batch with %d operations" % len(ops))
+        resp.data = db.driver.executeBatch(ops)  # we call driver directly for efficiency reason
+        for ix, (op, table, arg) in enumerate(ops):
+            if op == "select":
+                resp.data[ix] = [db.codecs[table].encode(row) for row in resp.data[ix]]
+    except (KeyError, TypeError, ValueError) as e:
+        resp.setError(1, "Malformed batch request: %s" % e)
+    except db.Error as e:
+        resp.errno = e.errno
+        resp.errmsg = e.errmsg
+    writejson(resp)
+
+
 @app.route("/<table>/filter/")
 def handleGetFilter(request, response, table):
     obj = getclass(table)
-    dbquery = db.query(obj)
-    dbquery.decode(request.query_string)
+    dbquery, after = decodeQuery(obj)
     log.debug("Get all rows in table '%s' matching query %s" % (obj._table, dbquery.toSql()))
-    
+    if notModified(obj, after):
+        return
+    if acceptsBinary():
+        writebinary(obj, dbquery)
+        return
+    if acceptsNdjson():
+        writendjson(obj, dbquery)
+        return
+    writejsonrows(obj, dbquery, after)
+
+
+@app.route("/<table>/changes")
+def handleChanges(request, response, table):
+    """
+    Rows changed after the sequence number in the query string parameter
+    since, for tables with _trackChanges. Without since, all rows
+    data is {"rows": [..], "deleted": [<_id>, ..] or null, "seq": <last change>}
+    """
+    obj = getclass(table)
     resp = bc.Response()
     try:
-        resp.data = []
-        for row in db.driver.select(dbquery):  # we call driver directly for efficiency reason
-            tmp = {}
-            for colname in obj._iterName():
-                tmp[colname] = row[colname]
-            resp.data.append(tmp)
+        since = urllib.parse.parse_qs(request.query_string).get("since")
+        if since is not None:
+            since = int(since[0])
+        log.debug("Get changes in table '%s' since %s" % (obj._table, since))
+        rows, deleted, seq = db.driver.changes(obj, since)  # we call driver directly for efficiency reason
+        encode = db.codecs[obj._table].encode
+        resp.data = {
+            "rows": [encode(row) for row in rows],
+            "deleted": deleted,
+            "seq": seq,
+        }
+    except ValueError:
+        resp.setError(1, "Illegal since parameter in changes request")
     except db.Error as e:
-        msg = "Could not load objects from table '%s'. %s" % (obj._table, e)
-        log.debug(msg)
-        response.setError(1, msg)
-        response.status_code = '404 ' + msg
-        return
-        
+        resp.errno = e.errno
+        resp.errmsg = e.errmsg
+    writejson(resp)
+
+
+@app.route("/<table>/version")
+def handleVersion(request, response, table):
+    """
+    The version of the table, increased after each write
+    data is {"version": <version>, "changed": <time of last change>}
+    """
+    obj = getclass(table)
+    resp = bc.Response()
+    try:
+        version, changed = db.tableVersion(obj._table)
+        resp.data = {"version": version, "changed": changed}
+    except db.Error as e:
+        resp.errno = e.errno
+        resp.errmsg = e.errmsg
     writejson(resp)
 
 
 @app.route("/<table>/<_id:int:o>")
 def handleGet(request, response, table, _id=None):
     obj = getclass(table)
+    after = None
     if _id is None:
         log.debug('Get all rows in table %s' % obj._table)
-        # all rows (put some sane limit here maybe?)
-        dbquery = db.query(obj)
+        # all rows, JSON is paged, see writejsonrows()
+        dbquery, after = decodeQuery(obj)
     else:
         # one row, identified by rowID
         dbquery = db.query().filter(obj.q._id, '=', _id)
         log.debug("Get one row in table '%s' matching query %s" % (obj._table, dbquery.toSql()))
-    
+    if notModified(obj, after):
+        return
+    if acceptsBinary():
+        writebinary(obj, dbquery)
+        return
+    if _id is None:
+        if acceptsNdjson():
+            writendjson(obj, dbquery)
+        else:
+            writejsonrows(obj, dbquery, after)
+        return
+
     resp = bc.Response()
     try:
-        resp.data = []
-        for row in db.driver.select(dbquery):  # we call driver directly for efficiency reason
-            tmp = {}
-            for colname in obj._iterName():
-                tmp[colname] = row[colname]
-            resp.data.append(tmp)
+        encode = db.codecs[obj._table].encode
+        resp.data = [encode(row) for row in selectRows(dbquery)]  # we call driver directly for efficiency reason
     except db.Error as e:
         msg = "Could not load objects from table '%s'. %s" % (obj._table, e)
         log.debug(msg)
@@ -172,6 +496,35 @@ def handleGet(request, response, table, _id=None):
     writejson(resp)
 
 
+@app.route("/<table>/bulk", methods=["POST"])
+def handleBulkPost(request, response, table):
+    """
+    Insert many rows in one transaction. The body is either
+        JSON, a list of {<column>: <value>, ...}
+        NDJSON, a header {"columns": [<name>, ...]} then one line per
+            row, a list with the values in column order
+    Returns a list with the _id of each new row
+    """
+    obj = getclass(table)
+    decode = db.codecs[obj._table].decodeRow
+    resp = bc.Response()
+    try:
+        if (request.content_type or "").startswith(NDJSON):
+            lines = request.getBody().decode("utf-8").splitlines()
+            colnames = json.loads(lines[0])["columns"]
+            rows = [decode(dict(zip(colnames, json.loads(line)))) for line in lines[1:] if line]
+        else:
+            rows = [decode(values) for values in request.json()]
+        log.debug("Insert %d rows in table '%s'" % (len(rows), obj._table))
+        resp.data = db.driver.insertMany(obj._table, rows)  # we call driver direct for efficiency reason
+    except (IndexError, KeyError, TypeError, ValueError, ArithmeticError) as e:
+        resp.setError(1, "Malformed bulk insert request: %s" % e)
+    except db.Error as e:
+        resp.errno = e.errno
+        resp.errmsg = e.errmsg
+    writejson(resp)
+
+
 @app.route("/<table>", methods=["POST"])
 def handlePost(request, response, table):
     obj = getclass(table)
@@ -222,31 +575,36 @@ def handleDelete(request, response, table, _id):
     writejson(resp)
 
 
-@app.route("/<table>/<_id:int:o>", methods=["HEAD"])
-def handleHead(request, response, table, _id=None):
+def writecount(obj, dbquery):
     """
     Count the number of rows matching a query
     Return data in a HTML header
     """
-    obj = getclass(table)
-    if _id is None:
-        log.debug('Count all rows in table %s' % obj._table)
-        # all rows (put some sane limit here maybe?)
-        dbquery = db.query(obj)
-    elif _id is 'filter':
-        # filter out specific rows
-        dbquery = db.query()
-        dbquery.decode(request.querystr)
-        log.debug("Count all rows in table '%s' matching query %s" % (obj._table, dbquery.toSql()))
-
-    resp = bc.Response()
     try:
-        resp.data = db.driver.count(dbquery)  # we call driver direct for efficiency reason
+        count = db.driver.count(dbquery)  # we call driver direct for efficiency reason
     except db.Error as e:
         msg = "Could not count objects in table '%s'. %s" % (obj._table, e)
         log.debug(msg)
         # self.status_code = '404 ' + msg
         return
-    response.addHeader('X-Result-Count', str(resp.data))
+    response.addHeader('X-Result-Count', str(count))
+
+
+@app.route("/<table>/filter", methods=["HEAD"])
+def handleHeadFilter(request, response, table):
+    obj = getclass(table)
+    dbquery = db.query(obj)
+    dbquery.decode(request.query_string)
+    log.debug("Count all rows in table '%s' matching query %s" % (obj._table, dbquery.toSql()))
+    writecount(obj, dbquery)
 
 
+@app.route("/<table>/<_id:int:o>", methods=["HEAD"])
+def handleHead(request, response, table, _id=None):
+    obj = getclass(table)
+    if _id is None:
+        log.debug('Count all rows in table %s' % obj._table)
+        dbquery = db.query(obj)
+    else:
+        dbquery = db.query().filter(obj.q._id, '=', _id)
+    writecount(obj, dbquery)
@@ -32,9 +32,24 @@
 # functionality in the wsgi server
 #
 
+import time
+import asyncio
+
 from wsgi.common import *
 
 
+@app.route("/wait/<ms:int>")
+def wait(request, response, ms=None):
+    time.sleep(ms / 1000)   # a controller waiting on a backend
+    print("wait(ms=%s)" % ms)
+
+
+@app.route("/await/<ms:int>")
+async def await_(request, response, ms=None):
+    await asyncio.sleep(ms / 1000)
+    print("await_(ms=%s)" % ms)
+
+
 @app.route("/bbb/<ccc>")
 def bbb_ccc(request, response, ccc=None):
     print("bbb_ccc(ccc=%s)" % ccc)
@@ -41,6 +41,7 @@ Usage:
 
 
 import json
+import threading
 import datetime
 import decimal
 
@@ -52,6 +53,7 @@ log.info("Basium default logger started")
 # These must be after definition of the logger instance
 import basium_orm
 import basium_model
+import basium_codec
 
 Error = bc.Error
 
@@ -60,7 +62,9 @@ class DbConf:
     """
     Information to the selected database driver, how to connect to database
     """
-    def __init__(self, host=None, port=None, username=None, password=None, database=None, debugSQL=False, log=None):
+    def __init__(self, host=None, port=None, username=None, password=None, database=None, debugSQL=False, log=None,
+                 scaledDecimal=False, sqliteProfile=None, itersize=None, maxConnections=4, idleTimeout=30,
+                 cacheSize=0, wireFormat="json", workers=None, localDatabase=":memory:"):
         self.host = host
         self.port = None
         self.username = username
@@ -68,6 +72,36 @@ class DbConf:
         self.database = database
         self.debugSQL = debugSQL
 
+        # sqlite only, store DecimalCol as INTEGER scaled with 10**decimal
+        self.scaledDecimal = scaledDecimal
+
+        # sqlite only, pragmas applied on each connect. Name of a preset
+        # in basium_driver_sqlite.PROFILES, or a dictionary pragma->value
+        self.sqliteProfile = sqliteProfile
+
+        # psql and mysql, if set select() streams the result using a
+        # server side cursor, fetching itersize rows at a time
+        self.itersize = itersize
+
+        # json, persistent HTTP connections to the server
+        self.maxConnections = maxConnections
+        self.idleTimeout = idleTimeout     # seconds, close idle connections after this
+
+        # json, number of select responses kept in a local cache and
+        # revalidated with conditional requests. 0 disables the cache
+        self.cacheSize = cacheSize
+
+        # json, format of rows and values sent to the server, "json" or
+        # "binary" for the compact format in basium_wire
+        self.wireFormat = wireFormat
+
+        # number of worker threads for Basium.submit(), default is
+        # maxConnections. Drivers that are not thread safe have no workers
+        self.workers = workers
+
+        # tiered, sqlite database file with the local copy of cached tables
+        self.localDatabase = localDatabase
+
 
 class Basium(basium_orm.BasiumOrm):
     """
@@ -92,6 +126,11 @@ class Basium(basium_orm.BasiumOrm):
         self.Error = bc.Error            # for convenience in dynamic pages
         self.debug = 0
 
+        self.codecs = {}            # key is table, value is basium_codec.TableCodec
+
+        self.executor = None        # worker threads for submit(), started when needed
+        self.executorLock = threading.Lock()
+
     def setDebug(self, debugLevel):
         self.debug = debugLevel
 
@@ -161,6 +200,17 @@ class Basium(basium_orm.BasiumOrm):
                     if actions is not None and len(actions) > 0:
                         self.modifyTable(obj, actions)
 
+        try:
+            for cls in self.cls.values():
+                self.driver.addClass(cls)
+        except bc.Error as err:
+            self.log.error(str(err))
+            return None
+
+        # after startOrm(), so the codecs use the driver column classes
+        for cls in self.cls.values():
+            obj = cls()
+            self.codecs[obj._table] = basium_codec.TableCodec(obj, self.driver)
         return True
 
 
@@ -0,0 +1,286 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012-2013, Anders Lowinger, Abundo AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Conversion of rows between the JSON API and the database driver, used
+by the API server
+
+One TableCodec is built per registered class in Basium.start(), after
+the driver column classes are mixed in. The conversion for each column
+is selected once, instead of testing the column and value types for
+each value in each request
+
+  decode   values sent by the json driver, strings or typed, to values
+           for the database driver
+  encode   rows from the database driver to values that json.dumps()
+           handles without a default() hook
+  serialize  rows from the database driver directly to JSON text, with
+           a function compiled for the table, see rowSerializer()
+"""
+
+import json
+import json.encoder
+import decimal
+import datetime
+import functools
+
+import basium_model
+import basium_driver_json
+
+
+def strFromDatetime(value):
+    if isinstance(value, datetime.date):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def strFromDecimal(value):
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+
+def decimalFrom(toPython):
+    """
+    Returns a function that converts a raw database value with the
+    driver column toPython, for example a scaled INTEGER in sqlite.
+    Decimal values and values the column can't convert are unchanged
+    """
+    def convert(value):
+        if value is None or value.__class__ is decimal.Decimal:
+            return value
+        try:
+            return toPython(value)
+        except (ValueError, ArithmeticError):
+            return value
+    return convert
+
+
+def strFromBytes(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+# JSON string, as json.dumps() with the default ensure_ascii
+encodeString = json.encoder.encode_basestring_ascii
+
+
+def jsonFromDatetime(value):
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None)      # as strftime()
+    return '"%s"' % value.isoformat(" ", "seconds")
+
+
+def jsonFromDate(value):
+    if isinstance(value, datetime.datetime):
+        return jsonFromDatetime(value)
+    return '"%s 00:00:00"' % value.isoformat()
+
+
+def jsonFromValue(value):
+    """
+    Any value as JSON text, the same as json.dumps() after encode().
+    Used when a value does not have the type expected for the column
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, str):
+        return encodeString(value)
+    if isinstance(value, datetime.date):
+        return jsonFromDate(value)
+    if isinstance(value, decimal.Decimal):
+        return '"%s"' % value
+    if isinstance(value, bytes):
+        return encodeString(value.decode())
+    return json.dumps(value)
+
+
+# per column kind, an expression for the value in variable v that is
+# evaluated when v has the expected type. Other values, including None,
+# use jsonFromValue()
+SERIALIZE_EXPR = [
+    (basium_model.BooleanCol, "bool", '("true" if v else "false")'),
+    (basium_model.DateTimeCol, "datetime.datetime", "jsonFromDatetime(v)"),
+    (basium_model.DateCol, "datetime.date", "jsonFromDate(v)"),
+    (basium_model.DecimalCol, "decimal.Decimal", """'"%s"' % v"""),
+    (basium_model.FloatCol, "float", "(repr(v) if v - v == 0 else jsonFromValue(v))"),  # not inf, nan
+    (basium_model.IntegerCol, "int", "str(v)"),
+    (basium_model.VarcharCol, "str", "encodeString(v)"),
+]
+
+
+def compileSerializer(columns, asList, convert=None):
+    """
+    Generate and compile a function serialize(row) that returns one row
+    as JSON text. columns is a list of (name, column)
+    asList True returns a list in column order, otherwise an object
+    convert is a dictionary column name -> function applied to the
+    database value first
+    """
+    convert = convert or {}
+    namespace = {
+        "datetime": datetime,
+        "decimal": decimal,
+        "encodeString": encodeString,
+        "jsonFromDatetime": jsonFromDatetime,
+        "jsonFromDate": jsonFromDate,
+        "jsonFromValue": jsonFromValue,
+    }
+    lines = ["def serialize(row):"]
+    parts = []
+    for ix, (colname, column) in enumerate(columns):
+        for cls, typename, expr in SERIALIZE_EXPR:
+            if isinstance(column, cls):
+                break
+        else:
+            typename, expr = None, None
+        if colname in convert:
+            namespace["convert%d" % ix] = convert[colname]
+            lines.append("    v = convert%d(row[%r])" % (ix, colname))
+        else:
+            lines.append("    v = row[%r]" % colname)
+        if expr is None:
+            lines.append("    s%d = jsonFromValue(v)" % ix)
+        else:
+            lines.append("    s%d = %s if v.__class__ is %s else jsonFromValue(v)" % (ix, expr, typename))
+        if asList:
+            parts.append("s%d" % ix)
+        else:
+            parts.append("%r + s%d" % (encodeString(colname) + ": ", ix))
+    if asList:
+        lines.append('    return "[" + %s + "]"' % ' + "," + '.join(parts))
+    else:
+        lines.append('    return "{" + %s + "}"' % ' + ", " + '.join(parts))
+    exec(compile("\n".join(lines), "<basium serializer>", "exec"), namespace)
+    return namespace["serialize"]
+
+
+def fuse(toPython, toSql, null):
+    """
+    Returns a function that decodes a value from the json driver and
+    encodes it for the database driver. The json driver sends None as
+    the string null
+    """
+    def decode(value):
+        if value is None or value == null:
+            return toSql(None)
+        return toSql(toPython(value))
+    return decode
+
+
+class TableCodec:
+    """
+    Conversion of the rows in one table
+    Values are converted with the driver, whose conversion can depend
+    on DbConf, see BaseDriver.toPython()
+    """
+
+    def __init__(self, obj, driver):
+        self.table = obj._table
+        self.colnames = list(obj._iterName())
+        self.decoders = {}      # column name -> fused decode+encode function
+        self.toSql = {}         # column name -> driver toSql for the column, for typed values
+        self.convert = {}       # column name -> function applied before encode/serialize
+        self.converters = []    # (column name, function) for columns that need it in encode
+        self.columns = list(obj._iterNameColumn())
+        self.serializers = {}   # key is asList, compiled when first used
+        for colname, column in obj._iterNameColumn():
+            toPython = getattr(basium_driver_json, type(column).__name__).toPython
+            null = None if isinstance(column, basium_model.VarcharCol) else "NULL"
+            toSql = functools.partial(driver.toSql, column)
+            self.decoders[colname] = fuse(toPython, toSql, null)
+            self.toSql[colname] = toSql
+            if isinstance(column, (basium_model.DateCol, basium_model.DateTimeCol)):
+                self.converters.append((colname, strFromDatetime))
+            elif isinstance(column, basium_model.DecimalCol):
+                convert = decimalFrom(functools.partial(driver.toPython, column))
+                self.convert[colname] = convert
+                self.converters.append((colname, lambda value, convert=convert: strFromDecimal(convert(value))))
+            elif isinstance(column, basium_model.VarcharCol):
+                self.converters.append((colname, strFromBytes))
+
+    def decode(self, values, typed=False):
+        """
+        Decode the columns present in values, a dictionary
+        typed is True if the values are python types, as in the binary
+        wire format, they are then only encoded for the database driver
+        """
+        functions = self.toSql if typed else self.decoders
+        return {key: functions[key](value) for key, value in values.items() if key in functions}
+
+    def decodeRow(self, values):
+        """As decode(), but all columns except _id must be present"""
+        decoders = self.decoders
+        return {colname: decoders[colname](values[colname]) for colname in self.colnames if colname != '_id'}
+
+    def encode(self, row):
+        """Returns a row from the database driver as a dictionary"""
+        values = {colname: row[colname] for colname in self.colnames}
+        for colname, convert in self.converters:
+            values[colname] = convert(values[colname])
+        return values
+
+    def encodeList(self, row):
+        """Returns a row from the database driver as a list, in column order"""
+        values = self.encode(row)
+        return [values[colname] for colname in self.colnames]
+
+    def rowSerializer(self, asList=False):
+        """
+        Returns a function that serializes a row from the database driver
+        as JSON text, an object or with asList a list in column order.
+        The output is the same as json.dumps() of encode()
+        """
+        if asList not in self.serializers:
+            self.serializers[asList] = compileSerializer(self.columns, asList, self.convert)
+        return self.serializers[asList]
+
+    def serialize(self, rows, asList=False, separator=",", end=False, chunk=500):
+        """
+        Generator, JSON text for the rows from the database driver, chunk
+        rows at a time. Rows are separated with separator. With end the
+        separator is also written after the last row, as in NDJSON
+        Errors from reading rows are raised to the caller
+        """
+        serialize = self.rowSerializer(asList)
+        lead = ""       # separator before the next chunk
+        lines = []
+        for row in rows:
+            lines.append(serialize(row))
+            if len(lines) >= chunk:
+                if end:
+                    lines.append("")
+                yield lead + separator.join(lines)
+                if not end:
+                    lead = separator
+                lines = []
+        if lines:
+            if end:
+                lines.append("")
+            yield lead + separator.join(lines)
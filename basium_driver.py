@@ -33,8 +33,16 @@ Basium base class for all driver implementations
 
 import datetime
 import decimal
+import contextlib
+import threading
+import types
+import time
 
 import basium_common as bc
+import basium_model
+import basium_orm
+
+BULK_CHUNK = 1000       # rows per executemany() in insertMany()
 
 
 #
@@ -54,6 +62,14 @@ class Column:
     def toSql(self, value):
         return value
 
+    def migrateSql(self, colname, tabletype):
+        """
+        Return SQL expression that converts the column in a table with
+        type tabletype to the current column type. Used when a table is
+        rebuilt. Default is to copy the value as is
+        """
+        return colname
+
     # todo: this is mysql specific, fix!
     # Convert a 'describe table' to sqltype
     #
@@ -193,17 +209,258 @@ class VarcharCol(Column):
             return value
 
 
+def seqName(table):
+    """
+    Name of the counter row for the sequence numbers of a tracked table,
+    in the version table. A table name can't contain a dot
+    """
+    return table + "._seq"
+
+
+class ThreadLocal:
+    """
+    Driver attribute with one value per thread, for the connection and
+    the state that belongs to it. Each thread that uses the driver then
+    connects on its own, see BaseDriver.threadState()
+      factory  called for the initial value in a thread, default None
+    """
+    def __init__(self, factory=None):
+        self.factory = factory
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, driver, cls=None):
+        if driver is None:
+            return self
+        state = driver.threadState()
+        try:
+            return getattr(state, self.name)
+        except AttributeError:
+            value = self.factory() if self.factory else None
+            setattr(state, self.name, value)
+            return value
+
+    def __set__(self, driver, value):
+        setattr(driver.threadState(), self.name, value)
+
+
 class BaseDriver:
     """
     Driver base class, Mostly stubs, needs to be overridden
     by the specific driver
     """
+
+    # True if the driver can be used from several threads at the same time
+    # The SQL drivers have one connection per thread, see ThreadLocal
+    threadSafe = False
+
+    # Tables with Model._trackChanges. Drivers that write to the database
+    # set this to a set, the json driver leaves change tracking to the
+    # server. The sequence numbers are allocated in the database, from a
+    # counter row in the version table, see allocateSeq()
+    tracked = None
+
+    # Cached table versions, key is table, value is (version, time of
+    # change), see tableVersion(). Drivers that write to the database
+    # set this to a dict, the json driver asks the server
+    versions = None
+
     def connect(self):
         raise bc.Error(1, 'Not implemented')
 
+    def disconnect(self):
+        """
+        Forget the connection, the next operation connects again
+        Used in a new process after fork(), connections can not be shared
+        """
+        pass
+
+    def threadState(self):
+        """
+        Returns the namespace with the ThreadLocal attributes, one per
+        thread if the driver is threadSafe, otherwise shared
+        """
+        state = self.__dict__.get("_threadState")
+        if state is None:
+            state = threading.local() if self.threadSafe else types.SimpleNamespace()
+            state = self.__dict__.setdefault("_threadState", state)
+        return state
+
+    def toPython(self, column, value):
+        """
+        Convert a value from the database to python
+        Overridden by drivers where the conversion depends on DbConf
+        """
+        return column.toPython(value)
+
+    def toSql(self, column, value):
+        """Convert a python value for the database, see toPython()"""
+        return column.toSql(value)
+
     def execute(self, method=None, url=None, data=None, decode=False):
         raise bc.Error(1, 'Not implemented')
 
+    def addClass(self, cls):
+        """
+        Called by Basium.start() for each registered model class,
+        after the tables are checked
+        Default starts the table version, and change tracking if enabled
+        for the class
+        """
+        if self.versions is not None:
+            self.startVersion(cls._table)
+        if cls._trackChanges and self.tracked is not None:
+            self.startTracking(cls())
+
+    def startVersion(self, table):
+        """
+        Create the version table if needed, and a row for the table
+        """
+        version = basium_model.TableVersion()
+        if not self.isTable(version._table):
+            self.createTable(version)
+        self.loadVersions()
+        if table not in self.versions:
+            self.insert(version._table, {"tablename": table, "version": 0, "changed": time.time()})
+            self.loadVersions()
+
+    def loadVersions(self):
+        """Read all table versions into self.versions"""
+        version = basium_model.TableVersion()
+        versions = {}
+        for row in list(self.select(basium_orm.Query(version))):
+            # two processes can both create the row, use the highest
+            old = versions.get(row["tablename"], (0, 0.0))
+            versions[row["tablename"]] = (max(old[0], int(row["version"])), max(old[1], float(row["changed"])))
+        self.versions = versions
+
+    def versionsChanged(self):
+        """
+        Returns True if the version table can have been changed since
+        loadVersions(). Default always reads the version table again
+        """
+        return True
+
+    def tableVersion(self, table):
+        """
+        Returns (version, time of last change) for a table
+        The version is stored in the database, so writes by other
+        processes are seen
+        """
+        if self.versionsChanged():
+            self.loadVersions()
+        return self.versions.get(table, (0, 0.0))
+
+    def bumpVersion(self, table):
+        """
+        Increase the version of a table, called in the transaction of
+        each write, see writeTransaction()
+        The json driver does nothing, the server increases the version
+        """
+        pass
+
+    def startTracking(self, obj):
+        """
+        Create the tombstone table if needed, and the counter row for the
+        sequence numbers of the table. The counter starts after the last
+        sequence number used in the table
+        """
+        tombstone = basium_model.Tombstone()
+        if not self.isTable(tombstone._table):
+            self.createTable(tombstone)
+        seq = 0
+        query = basium_orm.Query(obj).order(obj.q._seq, desc=True).limit(0, 1)
+        for row in list(self.select(query)):
+            seq = max(seq, int(row["_seq"] or 0))
+        query = basium_orm.Query(tombstone).filter(tombstone.q.tablename, '=', obj._table)
+        query.order(tombstone.q.seq, desc=True).limit(0, 1)
+        for row in list(self.select(query)):
+            seq = max(seq, int(row["seq"]))
+        current = self.lastSeq(obj._table)
+        if current is None:
+            self.insert(basium_model.TableVersion._table,
+                        {"tablename": seqName(obj._table), "version": seq, "changed": time.time()})
+        elif current < seq:
+            with self.inTransaction():
+                self.allocateSeq(obj._table, seq - current)
+        self.tracked.add(obj._table)
+
+    def lastSeq(self, table):
+        """
+        Returns the last allocated sequence number of a tracked table,
+        None if the table has no counter row
+        """
+        version = basium_model.TableVersion()
+        query = basium_orm.Query(version).filter(version.q.tablename, '=', seqName(table))
+        seqs = [int(row["version"]) for row in list(self.select(query))]
+        return max(seqs) if seqs else None
+
+    def allocateSeq(self, table, count):
+        """
+        Increase the counter row of a tracked table with count, returns
+        the first of the count allocated sequence numbers
+        Must be called in the transaction that writes the rows. The
+        update locks the counter row until commit, so the rows of a
+        later sequence number are never committed first
+        """
+        raise bc.Error(1, 'Not implemented')
+
+    @contextlib.contextmanager
+    def writeTransaction(self, table):
+        """
+        Context manager for a write to table. The write, the sequence
+        numbers of a tracked table and the new table version are
+        committed in one transaction
+        """
+        with self.inTransaction():
+            yield
+            if table != basium_model.TableVersion._table:
+                self.bumpVersion(table)
+
+    def stampChange(self, table, values):
+        """
+        Returns the values to insert or update, with the next sequence
+        number in _seq if the table is tracked
+        Call inside writeTransaction()
+        """
+        if self.tracked is None or table not in self.tracked:
+            return values
+        values = dict(values)
+        values["_seq"] = self.allocateSeq(table, 1)
+        return values
+
+    def stampChanges(self, table, rows):
+        """As stampChange(), for a list of rows"""
+        if self.tracked is None or table not in self.tracked:
+            return rows
+        seq = self.allocateSeq(table, len(rows))
+        return [dict(values, _seq=seq + ix) for ix, values in enumerate(rows)]
+
+    def changes(self, obj, since=None):
+        """
+        Fetch what changed in a tracked table after sequence number since
+        Returns (rows, deleted, seq)
+            rows     changed and new rows
+            deleted  _id of deleted rows. None if rows is the complete
+                     table, since was None or newer than the table
+            seq      sequence number of the last change, use as since
+                     next time
+        """
+        if self.tracked is None or obj._table not in self.tracked:
+            raise bc.Error(1, "Table '%s' does not track changes" % obj._table)
+        seq = self.lastSeq(obj._table) or 0
+        query = basium_orm.Query(obj)
+        if since is not None and since <= seq:
+            query.filter(obj.q._seq, '>', since)
+            tombstone = basium_model.Tombstone()
+            tquery = basium_orm.Query(tombstone).filter(tombstone.q.tablename, '=', obj._table)
+            tquery.filter(tombstone.q.seq, '>', since)
+            deleted = [row["rowid"] for row in list(self.select(tquery))]
+        else:
+            deleted = None
+        return list(self.select(query)), deleted, seq
+
     def isDatabase(self, dbName):
         return True
 
@@ -225,6 +482,40 @@ class BaseDriver:
     def select(self, query):
         raise bc.Error(1, "Not implemented")
 
+    def selectWithCount(self, query):
+        """
+        Fetch rows as select(), and the total number of rows matching the
+        query, ignoring limit
+        Returns (list of rows, total)
+        Default runs count and select in one transaction, drivers with
+        window functions can do it in one statement
+        """
+        self.begin()
+        try:
+            total = self.count(query.countQuery())
+            rows = list(self.select(query))
+        except:
+            self.rollback()
+            raise
+        self.commit()
+        return rows, total
+
+    def iterCursor(self, cursor, itersize):
+        """
+        Generator, fetch rows from a cursor itersize rows at a time
+        Only one chunk is held in memory. The cursor is closed when all
+        rows are fetched, or the generator is discarded
+        """
+        try:
+            while True:
+                rows = cursor.fetchmany(itersize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
     def insert(self, table, values):
         raise bc.Error(1, 'Not implemented')
 
@@ -232,4 +523,101 @@ class BaseDriver:
         raise bc.Error(1, 'Not implemented')
 
     def delete(self, query):
+        """
+        Delete the rows matching the query, returns number of deleted rows
+        In a tracked table a tombstone is written for each deleted row,
+        in the same transaction
+        """
+        with self.writeTransaction(query.table()):
+            if self.tracked is not None and query.table() in self.tracked:
+                ids = [row["_id"] for row in list(self.select(query))]
+                if ids:
+                    seq = self.allocateSeq(query.table(), len(ids))
+                    for ix, _id in enumerate(ids):
+                        self.insert(basium_model.Tombstone._table,
+                                    {"tablename": query.table(), "rowid": _id, "seq": seq + ix})
+            return self.deleteRows(query)
+
+    def deleteRows(self, query):
         raise bc.Error(1, 'Not implemented')
+
+    def insertMany(self, table, rows):
+        """
+        Insert rows, a list of dictionaries with the same columns, in one
+        transaction. Primary key '_id' is ignored
+        Returns list with the _id of each new row
+        Default inserts one row at a time, drivers can use executemany()
+        """
+        with self.writeTransaction(table):
+            return [self.insert(table, values) for values in rows]
+
+    @contextlib.contextmanager
+    def inTransaction(self):
+        """
+        Context manager, run the block in a transaction. If already in a
+        transaction, the block is part of it
+        """
+        if self.transaction:
+            yield
+            return
+        self.begin()
+        try:
+            yield
+        except:
+            self.rollback()
+            raise
+        self.commit()
+
+    def begin(self):
+        raise bc.Error(1, 'Not implemented')
+
+    def commit(self):
+        raise bc.Error(1, 'Not implemented')
+
+    def rollback(self):
+        raise bc.Error(1, 'Not implemented')
+
+    def executeBatch(self, ops):
+        """
+        Execute a list of operations in one transaction
+        Each operation is a tuple (op, table, arg)
+            op     insert, update, delete, select or count
+            arg    dictionary with column values for insert, update
+                   Query() for delete, select, count
+        Returns a list with one result per operation
+            insert  the new _id
+            update  None
+            delete  number of deleted rows
+            select  list of rows, each a dictionary
+            count   number of rows
+        If any operation fails everything is rolled back, and an
+        exception is raised
+        """
+        results = []
+        self.begin()
+        try:
+            for ix, (op, table, arg) in enumerate(ops):
+                try:
+                    if op == "insert":
+                        results.append(self.insert(table, arg))
+                    elif op == "update":
+                        results.append(self.update(table, arg))
+                    elif op == "delete":
+                        results.append(self.delete(arg))
+                    elif op == "select":
+                        colnames = list(arg._model._iterName())
+                        rows = []
+                        for row in self.select(arg):
+                            rows.append({colname: row[colname] for colname in colnames})
+                        results.append(rows)
+                    elif op == "count":
+                        results.append(self.count(arg))
+                    else:
+                        raise bc.Error(1, "Unknown operation '%s'" % op)
+                except bc.Error as e:
+                    raise bc.Error(e.errno, "Operation %d (%s %s) failed: %s" % (ix, op, table, e.errmsg))
+        except:
+            self.rollback()
+            raise
+        self.commit()
+        return results
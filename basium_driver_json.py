@@ -39,15 +39,28 @@ api.py is the code running on the server, that handles all requests from
 this driver
 """
 
+import time
 import datetime
 import decimal
 import urllib
-import urllib.request
+import urllib.parse
+import http.client
+import threading
 import base64
+import struct
 import json
+import collections
+import zlib
 
 import basium_common as bc
 import basium_driver
+import basium_wire
+
+NDJSON = "application/x-ndjson"    # newline delimited JSON
+ACCEPT_ENCODING = "gzip, deflate"
+
+# methods that can be sent again if the connection fails after the request
+IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
 
 #
 # These are shadow classes from the basium_model
@@ -58,6 +71,9 @@ import basium_driver
 # it converts to string and utf-8 encodes the data, so it can be sent in a
 # HTTP POST/PUT message
 #
+# With the binary wire format the values are sent typed, the driver
+# toSql() then returns the python value unchanged
+#
 
 
 class BooleanCol(basium_driver.BooleanCol):
@@ -198,74 +214,502 @@ class VarcharCol(basium_driver.VarcharCol):
         return value
 
 
-class RequestWithMethod(urllib.request.Request):
+def jsonValue(value):
+    """
+    json.dumps() default, typed values are sent as strings in the format
+    toSql() uses for JSON
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value)
+
+
+class ConnectionPool:
+    """
+    Pool of persistent HTTP/1.1 connections to one server
+
+    A connection is returned to the pool when the response is read, unless
+    the server wants to close it. Idle connections older than idleTimeout
+    are closed. If a reused connection turns out to be closed by the
+    server, the request is retried on the next connection, see request()
+    """
+    def __init__(self, scheme, netloc, maxConnections=4, idleTimeout=30, timeout=60):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.idle = []      # list of (connection, time when returned to pool)
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxConnections)
+        self.connects = 0   # number of new connections, for statistics
+
+    def newConnection(self):
+        self.connects += 1
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def get(self):
+        """
+        Returns (connection, reused)
+        Blocks if maxConnections connections are in use
+        """
+        self.slots.acquire()
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                conn, lastused = self.idle.pop()
+                if now - lastused < self.idleTimeout:
+                    return conn, True
+                conn.close()
+        return self.newConnection(), False
+
+    def put(self, conn):
+        with self.lock:
+            self.idle.append((conn, time.monotonic()))
+        self.slots.release()
+
+    def discard(self, conn):
+        conn.close()
+        self.slots.release()
+
+    def release(self, conn, resp):
+        """Call when the response body has been read"""
+        if resp.will_close:
+            self.discard(conn)
+        else:
+            self.put(conn)
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request, returns (connection, response)
+        The caller must read the response and call release()
+
+        If a reused connection turns out to be closed by the server the
+        request is sent again, unless the request was sent and the method
+        is not idempotent, as the server may have handled it
+        """
+        while True:
+            conn, reused = self.get()
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                sent = True
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                self.discard(conn)
+                if not reused or (sent and method not in IDEMPOTENT):
+                    raise
+                # stale connection, closed by server. Try again
+
+    def close(self):
+        with self.lock:
+            for conn, lastused in self.idle:
+                conn.close()
+            self.idle = []
+
+
+class DecompressReader:
     """
-    Helper class, to implement HTTP GET, POST, PUT, DELETE
+    Wraps a gzip or deflate compressed response, and decompresses the
+    body incrementally while it is read
     """
-    def __init__(self, *args, **kwargs):
-        self._method = kwargs.pop('method', None)
-        urllib.request.Request.__init__(self, *args, **kwargs)
+    def __init__(self, resp, chunksize=65536):
+        self.resp = resp
+        self.chunksize = chunksize
+        # 32 + MAX_WBITS, detect zlib or gzip header automatically
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.buf = b""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        data = self.resp.read1(self.chunksize)
+        try:
+            if data:
+                data = self.decompressor.decompress(data)
+            else:
+                data = self.decompressor.flush()
+                self.eof = True
+        except zlib.error as e:
+            raise ValueError("Decompress error %s" % e)
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def readline(self):
+        while True:
+            ix = self.buf.find(b"\n", self.pos)
+            if ix >= 0:
+                line = self.buf[self.pos:ix + 1]
+                self.pos = ix + 1
+                return line
+            if self.eof:
+                line = self.buf[self.pos:]
+                self.buf = b""
+                self.pos = 0
+                return line
+            self.fill()
+
+    def read(self, size=-1):
+        if size < 0:
+            while not self.eof:
+                self.fill()
+            size = len(self.buf) - self.pos
+        while len(self.buf) - self.pos < size and not self.eof:
+            self.fill()
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
 
-    def get_method(self):
-        return self._method if self._method else super(RequestWithMethod, self).get_method()
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def bodyReader(resp):
+    """Returns an object to read the response body from, decompressing if needed"""
+    coding = resp.getheader("Content-Encoding", "").strip().lower()
+    if coding in ("gzip", "x-gzip", "deflate"):
+        return DecompressReader(resp)
+    return resp
+
+
+pools = {}      # key is (scheme, netloc, maxConnections, idleTimeout)
+poolsLock = threading.Lock()
+
+
+def getPool(scheme, netloc, maxConnections=4, idleTimeout=30):
+    """
+    Returns the pool for the server, shared by drivers with the same
+    pool settings
+    """
+    with poolsLock:
+        key = (scheme, netloc, maxConnections, idleTimeout)
+        if key not in pools:
+            pools[key] = ConnectionPool(scheme, netloc, maxConnections=maxConnections, idleTimeout=idleTimeout)
+        return pools[key]
 
 
 class BasiumDriver(basium_driver.BaseDriver):
+
+    threadSafe = True      # each request uses its own connection from the pool
+
     def __init__(self, log=None, dbconf=None):
         self.log = log
         self.dbconf = dbconf
 
-        self.uri = '%s/api' % (self.dbconf.host)
+        u = urllib.parse.urlsplit(self.dbconf.host)
+        self.uri = '%s/api' % (u.path.rstrip("/"))
+        self.pool = getPool(u.scheme, u.netloc, maxConnections=self.dbconf.maxConnections,
+                            idleTimeout=self.dbconf.idleTimeout)
+
+        # headers sent in every request
+        self.headers = {"Accept-Encoding": ACCEPT_ENCODING}
+        if self.dbconf.username is not None:
+            auth = '%s:%s' % (self.dbconf.username, self.dbconf.password)
+            auth = auth.encode("utf-8")
+            self.headers["Authorization"] = "Basic " + base64.b64encode(auth).decode("ascii")
+
+        if self.dbconf.wireFormat not in ("json", "binary"):
+            raise bc.Error(1, "Unknown wire format '%s'" % self.dbconf.wireFormat)
+        self.binary = self.dbconf.wireFormat == "binary"
+        # content types accepted for rows, in order of preference
+        if self.binary:
+            self.accept = "%s, %s, application/json" % (basium_wire.CONTENT_TYPE, NDJSON)
+        else:
+            self.accept = "%s, application/json" % NDJSON
+
+        # select responses, key is url, value is (etag, data). Least recently used first
+        self.cache = collections.OrderedDict()
+        self.cacheLock = threading.Lock()
+
+    def toSql(self, column, value):
+        """
+        With the binary wire format the values are sent typed, datetimes
+        without microseconds as DateTimeCol.toSql() does for JSON
+        """
+        if self.binary:
+            if isinstance(value, datetime.datetime):
+                return value.replace(microsecond=0)
+            return value
+        return column.toSql(value)
 
     def connect(self):
         """
         dummy, json api is stateless, we don't need connect
+        connections are opened when needed, and kept in the pool
 
         todo, could potentially check if server is reachable
         """
         pass
 
-    def execute(self, method=None, url=None, data=None, decode=False):
-        if self.debug & bc.DEBUG_SQL:
-            self.log.debug('Method=%s URL=%s Data=%s' % (method, url, data))
-        respdata = None
-        req = RequestWithMethod(url, method=method)
-        if self.dbconf.username is not None:
-            auth = '%s:%s' % (self.dbconf.username, self.dbconf.password)
-            auth = auth.encode("utf-8")
-            req.add_header(b"Authorization", b"Basic " + base64.b64encode(auth))
+    def disconnect(self):
+        """Close the idle connections in the pool"""
+        with self.pool.lock:
+            idle, self.pool.idle = self.pool.idle, []
+        for conn, lastused in idle:
+            conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Send a request, returns (connection, response) with the body unread
+        The caller must read the body and release the connection,
+        see readBody()
+        """
         try:
-            if data:
-                resp = urllib.request.urlopen(req, urllib.parse.urlencode(data, encoding="utf-8").encode("ascii") )
-            else:
-                resp = urllib.request.urlopen(req)
-        except urllib.error.HTTPError as e:
-            raise bc.Error(1, "HTTPerror %s" % e)
-        except urllib.error.URLError as e:
+            return self.pool.request(method, url, body=body, headers=headers)
+        except (http.client.HTTPException, OSError) as e:
             raise bc.Error(1, "URLerror %s" % e)
 
-        if decode:
-            encoding = resp.headers.get_content_charset()
-            if encoding is None:
-                encoding = "utf-8"
-            try:
-                tmp = resp.read().decode(encoding)
-                res = json.loads(tmp)
-                resp.close()
-            except ValueError:
-                raise bc.Error(1, "JSON ValueError for " + tmp)
-            except TypeError:
-                raise bc.Error(1, "JSON TypeError for " + tmp)
+    def readBody(self, conn, resp):
+        """
+        Read the complete response body, and return the connection to the pool
+        A compressed body is decompressed
+        """
+        try:
+            tmp = bodyReader(resp).read()
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            self.pool.discard(conn)
+            raise bc.Error(1, "URLerror %s" % e)
+        self.pool.release(conn, resp)
+        if resp.status >= 400:
+            raise bc.Error(1, "HTTPerror %s %s" % (resp.status, resp.reason))
+        return tmp
 
-            try:
-                if res['errno'] != 0:
-                    raise bc.Error(res['errno'], res['errmsg'])
-                respdata = res["data"]
-            except KeyError:
-                raise bc.Error(1, "Result keyerror, missing errno/errmsg")
+    def decodeJson(self, resp, tmp):
+        """
+        Decode a JSON response, returns the data
+        """
+        return self.parseJson(resp, tmp)["data"]
+
+    def parseJson(self, resp, tmp):
+        """
+        Decode a JSON response, returns the complete response object
+        """
+        encoding = resp.headers.get_content_charset()
+        if encoding is None:
+            encoding = "utf-8"
+        try:
+            tmp = tmp.decode(encoding)
+            res = json.loads(tmp)
+        except ValueError:
+            raise bc.Error(1, "JSON ValueError for " + tmp)
+        except TypeError:
+            raise bc.Error(1, "JSON TypeError for " + tmp)
 
+        try:
+            if res['errno'] != 0:
+                raise bc.Error(res['errno'], res['errmsg'])
+        except KeyError:
+            raise bc.Error(1, "Result keyerror, missing errno/errmsg")
+        if "data" not in res:
+            raise bc.Error(1, "Result keyerror, missing data")
+        return res
+
+    def isBinary(self, resp):
+        return resp.getheader("Content-Type", "").startswith(basium_wire.CONTENT_TYPE)
+
+    def decodePage(self, resp, tmp):
+        """
+        Decode a complete response with rows, JSON or binary wire format
+        Returns (rows, token), token is the continuation token for the
+        next page of a JSON response, or None
+        """
+        if not self.isBinary(resp):
+            res = self.parseJson(resp, tmp)
+            return res["data"], res.get("next")
+        pos = 0
+
+        def read(size):
+            nonlocal pos
+            pos += size
+            return tmp[pos - size:pos]
+        try:
+            return list(basium_wire.Decoder(read).rows()), None
+        except (ValueError, struct.error) as e:
+            raise bc.Error(1, "Error decoding response: %s" % e)
+
+    def execute(self, method=None, url=None, data=None, decode=False, jsondata=None, headers=None):
+        """
+        Send a request to the server
+        data is sent form encoded, or in the binary wire format if enabled.
+        jsondata is sent as JSON
+        headers are sent in addition to the default headers
+        """
+        if self.debug & bc.DEBUG_SQL:
+            self.log.debug('Method=%s URL=%s Data=%s' % (method, url, data or jsondata))
+        respdata = None
+        headers_ = self.headers
+        if headers:
+            headers_ = self.headers.copy()
+            headers_.update(headers)
+        body = None
+        if data and self.binary:
+            headers_ = headers_.copy()
+            headers_["Content-Type"] = basium_wire.CONTENT_TYPE
+            body = basium_wire.encodeValues(data)
+        elif data:
+            headers_ = headers_.copy()
+            headers_["Content-Type"] = "application/x-www-form-urlencoded"
+            body = urllib.parse.urlencode(data, encoding="utf-8").encode("ascii")
+        elif jsondata is not None:
+            headers_ = headers_.copy()
+            headers_["Content-Type"] = "application/json; charset=utf-8"
+            body = json.dumps(jsondata, default=jsonValue).encode("utf-8")
+
+        conn, resp = self.request(method, url, body=body, headers=headers_)
+        tmp = self.readBody(conn, resp)
+        if decode:
+            respdata = self.decodeJson(resp, tmp)
         return respdata, resp
 
+    def conditionalGet(self, url, etag=None):
+        """
+        GET rows from url. If etag is given and the server answers 304
+        (not modified) rows is None
+        Returns (rows, etag)
+        """
+        if self.debug & bc.DEBUG_SQL:
+            self.log.debug('Method=GET URL=%s' % url)
+        headers = self.headers.copy()
+        if self.binary:
+            headers["Accept"] = "%s, application/json" % basium_wire.CONTENT_TYPE
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        conn, resp = self.request("GET", url, headers=headers)
+        data = self.readBody(conn, resp)
+        if resp.status == 304 and etag is not None:
+            return None, etag
+        rows, token = self.decodePage(resp, data)
+        return self.readPages(url, rows, token), resp.getheader("ETag")
+
+    def readPages(self, url, rows, token):
+        """
+        Follow the continuation tokens of a paged JSON response until the
+        last page, the rows from each page are appended to rows
+        """
+        while token is not None:
+            pageurl = '%s%safter=%s' % (url, '&' if '?' in url else '?',
+                                        urllib.parse.quote(token))
+            if self.debug & bc.DEBUG_SQL:
+                self.log.debug('Method=GET URL=%s' % pageurl)
+            conn, resp = self.request("GET", pageurl, headers=self.headers)
+            page, token = self.decodePage(resp, self.readBody(conn, resp))
+            rows.extend(page)
+        return rows
+
+    def selectTable(self, table, etag=None):
+        """All rows in a table, see conditionalGet()"""
+        return self.conditionalGet('%s/%s' % (self.uri, table), etag)
+
+    def changes(self, obj, since=None):
+        """
+        Fetch what changed in a tracked table after sequence number since,
+        returns (rows, deleted, seq), see BaseDriver.changes()
+        """
+        url = '%s/%s/changes' % (self.uri, obj._table)
+        if since is not None:
+            url += '?since=%i' % since
+        data, resp = self.execute(method='GET', url=url, decode=True)
+        return data["rows"], data["deleted"], data["seq"]
+
+    def tableVersion(self, table):
+        """
+        Returns (version, time of last change) for a table, from the server
+        """
+        url = '%s/%s/version' % (self.uri, table)
+        data, resp = self.execute(method='GET', url=url, decode=True)
+        return data["version"], data["changed"]
+
+    def cachedGet(self, url):
+        """
+        GET url using the response cache. A cached response is revalidated
+        with If-None-Match, if the server answers 304 the cached data is
+        returned without transferring or decoding the body again
+        """
+        with self.cacheLock:
+            entry = self.cache.get(url)
+        data, etag = self.conditionalGet(url, entry[0] if entry is not None else None)
+        if data is None:
+            with self.cacheLock:
+                if url in self.cache:
+                    self.cache.move_to_end(url)
+            return list(entry[1])
+        if etag is not None:
+            with self.cacheLock:
+                self.cache[url] = (etag, data)
+                self.cache.move_to_end(url)
+                while len(self.cache) > self.dbconf.cacheSize:
+                    self.cache.popitem(last=False)
+        return list(data)
+
+    def selectStream(self, url):
+        """
+        Ask the server to stream the rows as newline delimited JSON, or
+        in the binary wire format if enabled
+        Returns a generator, the rows are decoded one at a time (one block
+        at a time for binary) when read from the connection. Falls back to
+        a normal JSON response if the server does not stream
+        """
+        if self.debug & bc.DEBUG_SQL:
+            self.log.debug('Method=GET URL=%s' % url)
+        headers = self.headers.copy()
+        headers["Accept"] = self.accept
+        conn, resp = self.request("GET", url, headers=headers)
+        if self.isBinary(resp) and resp.status < 400:
+            return self.iterBinary(conn, resp, basium_wire.Decoder(bodyReader(resp).read))
+        if not resp.getheader("Content-Type", "").startswith(NDJSON):
+            rows, token = self.decodePage(resp, self.readBody(conn, resp))
+            return self.readPages(url, rows, token)
+
+        if resp.status >= 400:
+            self.readBody(conn, resp)   # raises error
+        body = bodyReader(resp)
+        try:
+            header = json.loads(body.readline())
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            self.pool.discard(conn)
+            raise bc.Error(1, "Error reading stream header: %s" % e)
+        if header['errno'] != 0:
+            self.pool.discard(conn)
+            raise bc.Error(header['errno'], header['errmsg'])
+        return self.iterRows(conn, resp, body, header["columns"])
+
+    def iterRows(self, conn, resp, body, colnames):
+        done = False
+        try:
+            for line in body:
+                row = json.loads(line)
+                if isinstance(row, dict):
+                    # error after the stream started
+                    raise bc.Error(row['errno'], row['errmsg'])
+                yield dict(zip(colnames, row))
+            done = True
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            raise bc.Error(1, "Error reading stream: %s" % e)
+        finally:
+            if done:
+                self.pool.release(conn, resp)
+            else:
+                self.pool.discard(conn)     # not read to end, cannot be reused
+
+    def iterBinary(self, conn, resp, decoder):
+        done = False
+        try:
+            for block in decoder.blocks():
+                yield from block
+            done = True
+        except (http.client.HTTPException, OSError, ValueError, struct.error) as e:
+            raise bc.Error(1, "Error reading stream: %s" % e)
+        finally:
+            if done:
+                self.pool.release(conn, resp)
+            else:
+                self.pool.discard(conn)     # not read to end, cannot be reused
+
     def isDatabase(self, dbName):
         """
         Check if a database exist
@@ -334,14 +778,61 @@ class BasiumDriver(basium_driver.BaseDriver):
         else:
             # real query
             url = '%s/%s/filter?%s' % (self.uri, query.table(), query.encode())
-        data, resp = self.execute(method='GET', url=url, decode=True)
-        return data
+        if self.dbconf.cacheSize:
+            return self.cachedGet(url)
+        if query.isId() and not self.binary:
+            data, resp = self.execute(method='GET', url=url, decode=True)
+            return data
+        return self.selectStream(url)
+
+    def selectWithCount(self, query):
+        """
+        Fetch rows, the server returns the total number of matching rows
+        in the X-Result-Count header of the same response
+        """
+        if query.isId():
+            url = '%s/%s/%i' % (self.uri, query.table(), query._where[0].value)
+        else:
+            url = '%s/%s/filter?%s' % (self.uri, query.table(), query.encode())
+        if self.debug & bc.DEBUG_SQL:
+            self.log.debug('Method=GET URL=%s' % url)
+        headers = self.headers.copy()
+        headers["X-Want-Count"] = "1"
+        if self.binary:
+            headers["Accept"] = "%s, application/json" % basium_wire.CONTENT_TYPE
+        conn, resp = self.request("GET", url, headers=headers)
+        data, token = self.decodePage(resp, self.readBody(conn, resp))
+        count = resp.getheader("X-Result-Count")
+        if count is None:
+            raise bc.Error(1, "Server did not return X-Result-Count")
+        return self.readPages(url, data, token), int(count)
 
     def insert(self, table, values):
         url = '%s/%s' % (self.uri, table)
         data, resp = self.execute(method='POST', url=url, data=values, decode=True)
         return data
 
+    def insertMany(self, table, rows):
+        """
+        Insert rows in one request, the server inserts them in one
+        transaction. Sent as NDJSON, a header with the column names then
+        one line per row with the values in column order
+        """
+        if not rows:
+            return []
+        url = '%s/%s/bulk' % (self.uri, table)
+        colnames = [key for key in rows[0] if key != '_id']
+        lines = [json.dumps({"columns": colnames})]
+        for values in rows:
+            lines.append(json.dumps([values[colname] for colname in colnames], default=jsonValue))
+        lines.append("")
+        headers = self.headers.copy()
+        headers["Content-Type"] = "%s; charset=utf-8" % NDJSON
+        if self.debug & bc.DEBUG_SQL:
+            self.log.debug('Method=POST URL=%s, %d rows' % (url, len(rows)))
+        conn, resp = self.request("POST", url, body="\n".join(lines).encode("utf-8"), headers=headers)
+        return self.decodeJson(resp, self.readBody(conn, resp))
+
     def update(self, table, values):
         url = '%s/%s/%s' % (self.uri, table, values['_id'])
         data, resp = self.execute(method='PUT', url=url, data=values, decode=True)
@@ -362,3 +853,18 @@ class BasiumDriver(basium_driver.BaseDriver):
             url = '%s/%s/filter?%s' % (self.uri, query.table(), query.encode())
         data, resp = self.execute('DELETE', url, decode=True)
         return data
+
+    def executeBatch(self, ops):
+        """
+        Send all operations in one request, the server executes them
+        in one transaction
+        """
+        url = '%s/_batch' % (self.uri)
+        jsondata = []
+        for op, table, arg in ops:
+            if op in ("insert", "update"):
+                jsondata.append({"op": op, "table": table, "values": arg})
+            else:
+                jsondata.append({"op": op, "table": table, "query": arg.encode()})
+        data, resp = self.execute(method='POST', url=url, jsondata=jsondata, decode=True)
+        return data
@@ -39,11 +39,13 @@ To use this driver, install the mysql.connector
 
 """
 
+import time
 import datetime
 import decimal
 
 import basium_common as bc
 import basium_driver
+import basium_model
 
 err = None
 try:
@@ -255,6 +257,14 @@ class MySQLCursorDict(mysql.connector.cursor.MySQLCursor):
 
 
 class BasiumDriver(basium_driver.BaseDriver):
+    threadSafe = True
+
+    # each thread has its own connection
+    dbconnection = basium_driver.ThreadLocal()
+    cursor = basium_driver.ThreadLocal()
+    transaction = basium_driver.ThreadLocal(bool)
+    stream = basium_driver.ThreadLocal()   # unbuffered cursor being read, see selectStream()
+
     def __init__(self, log=None, dbconf=None):
         self.log = log
         self.dbconf = dbconf
@@ -263,6 +273,9 @@ class BasiumDriver(basium_driver.BaseDriver):
         self.dbconnection = None
         self.connectionStatus = None
         self.tables = None
+        self.transaction = False    # True when inside begin() .. commit()/rollback()
+        self.tracked = set()        # tracked tables, see BaseDriver.addClass()
+        self.versions = {}          # table versions, see BaseDriver.tableVersion()
 
     def connect(self):
         try:
@@ -293,6 +306,8 @@ class BasiumDriver(basium_driver.BaseDriver):
         Execute a query,
         if error try to reconnect and redo the query to handle timeouts
         """
+        if self.stream is not None:
+            raise bc.Error(1, "Cannot query the database while a stream of rows is read, see selectStream()")
         for i in range(0, 2):
             if self.dbconnection is None:
                 self.connect()
@@ -303,19 +318,41 @@ class BasiumDriver(basium_driver.BaseDriver):
                     self.cursor.execute(sql, values)
                 else:
                     self.cursor.execute(sql)
-                if commit:
+                if commit and not self.transaction:
                     self.dbconnection.commit()
                 return
             except mysql.connector.Error as err:
-                if self.dbconnection is not None:
+                if self.dbconnection is not None and not self.transaction:
                     try:
                         self.dbconnection.commit()
                     except mysql.connector.Error as err:
                         pass
-                if i == 1:
+                if i == 1 or self.transaction:
                     raise bc.Error(err.errno, str(err))
                 self.disconnect()
 
+    def begin(self):
+        """
+        Start a transaction, execute() does not commit until commit()
+        The connection runs with autocommit, so this is explicit
+        """
+        self.execute("START TRANSACTION")
+        self.transaction = True
+
+    def commit(self):
+        self.transaction = False
+        try:
+            self.dbconnection.commit()
+        except mysql.connector.Error as err:
+            raise bc.Error(err.errno, str(err))
+
+    def rollback(self):
+        self.transaction = False
+        try:
+            self.dbconnection.rollback()
+        except mysql.connector.Error as err:
+            raise bc.Error(err.errno, str(err))
+
     def isDatabase(self, dbName):
         """
         Returns True if the database exist
@@ -359,6 +396,7 @@ class BasiumDriver(basium_driver.BaseDriver):
         sql += "\n  ,".join(columnlist)
         sql += '\n)'
         self.execute(sql, commit=True)
+        self.tables = None      # isTable() reads the table list again
 
     def verifyTable(self, obj):
         """
@@ -461,7 +499,7 @@ class BasiumDriver(basium_driver.BaseDriver):
 
     def count(self, query):
         sql = "select count(*) from %s" % (query.table())
-        sql2, values = query.toSql()
+        sql2, values = query.toSql(self)
         sql += sql2
         self.execute(sql, values)
         try:
@@ -480,45 +518,141 @@ class BasiumDriver(basium_driver.BaseDriver):
         If there is any errors, an DriverError exception is raised
         """
         sql = "SELECT * FROM %s" % query.table()
-        sql2, values = query.toSql()
+        sql2, values = query.toSql(self)
         sql += sql2
+        if self.dbconf.itersize:
+            return self.selectStream(sql, values)
         self.execute(sql, values)
         return self.cursor
 
+    def selectStream(self, sql, values):
+        """
+        Use an unbuffered cursor, rows are read from the server
+        dbconf.itersize rows at a time
+        Note: mysql does not allow other queries on the connection until
+        all rows are read, execute() raises an error until the stream
+        is read to the end or closed
+        """
+        if self.stream is not None:
+            raise bc.Error(1, "Cannot query the database while a stream of rows is read, see selectStream()")
+        if self.dbconnection is None:
+            self.connect()
+        try:
+            cursor = self.dbconnection.cursor(cursor_class=MySQLCursorDict)
+            if self.debug & bc.DEBUG_SQL:
+                self.log.debug('SQL=%s, values=%s' % (sql, values))
+            cursor.execute(sql, values)
+        except mysql.connector.Error as err:
+            raise bc.Error(err.errno, str(err))
+        self.stream = cursor
+        rows = self.iterStream(cursor)
+        next(rows)      # started, the stream ends also if rows is discarded unread
+        return rows
+
+    def iterStream(self, cursor):
+        """
+        Generator, rows from the unbuffered cursor after a first None
+        Rows not read are discarded when the generator is closed
+        """
+        state = self.threadState()
+        try:
+            yield None
+            yield from self.iterCursor(cursor, self.dbconf.itersize)
+        finally:
+            try:
+                cursor.fetchall()
+                cursor.close()
+            except mysql.connector.Error:
+                pass
+            if state.stream is cursor:
+                state.stream = None
+
     def insert(self, table, values):
         """
         Insert a row in the table
         value is a dictionary with columns, primary key '_id' is ignored
         """
-        parms = []
-        holder = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append(key)
-                holder.append("%s")
-                vals.append(val)
-        sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(parms), ",".join(holder))
-        self.execute(sql, vals, commit=True)
-        return self.cursor.lastrowid
+        with self.writeTransaction(table):
+            values = self.stampChange(table, values)
+            parms = []
+            holder = []
+            vals = []
+            for key, val in values.items():
+                if key != '_id':
+                    parms.append(key)
+                    holder.append("%s")
+                    vals.append(val)
+            sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(parms), ",".join(holder))
+            self.execute(sql, vals, commit=True)
+            return self.cursor.lastrowid
+
+    def insertMany(self, table, rows):
+        """
+        Insert rows with executemany(), BULK_CHUNK rows at a time
+        mysql.connector sends each chunk as one multi-row INSERT, the rows
+        get consecutive _id and lastrowid is the first of them
+        """
+        if not rows:
+            return []
+        ids = []
+        with self.writeTransaction(table):
+            rows = self.stampChanges(table, rows)
+            colnames = [key for key in rows[0] if key != '_id']
+            sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(colnames), ",".join(["%s"] * len(colnames)))
+            if self.debug & bc.DEBUG_SQL:
+                self.log.debug('SQL=%s, %d rows' % (sql, len(rows)))
+            try:
+                for start in range(0, len(rows), basium_driver.BULK_CHUNK):
+                    chunk = [[values[colname] for colname in colnames]
+                             for values in rows[start:start + basium_driver.BULK_CHUNK]]
+                    self.cursor.executemany(sql, chunk)
+                    first = self.cursor.lastrowid
+                    ids.extend(range(first, first + len(chunk)))
+            except mysql.connector.Error as err:
+                raise bc.Error(err.errno, str(err))
+        return ids
 
     def update(self, table, values):
         """
         Update a row in the table
         """
-        parms = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append("%s=%%s" % key)
-                vals.append(val)
-            else:
-                primary_key_val = val
-        sql = "UPDATE %s SET %s WHERE %s=%%s" % (table, ",".join(parms), '_id')
-        vals.append(primary_key_val)
-        self.execute(sql, vals, commit=True)
+        with self.writeTransaction(table):
+            values = self.stampChange(table, values)
+            parms = []
+            vals = []
+            for key, val in values.items():
+                if key != '_id':
+                    parms.append("%s=%%s" % key)
+                    vals.append(val)
+                else:
+                    primary_key_val = val
+            sql = "UPDATE %s SET %s WHERE %s=%%s" % (table, ",".join(parms), '_id')
+            vals.append(primary_key_val)
+            self.execute(sql, vals, commit=True)
+
+    def bumpVersion(self, table):
+        """Increase the version of a table, see BaseDriver.bumpVersion()"""
+        sql = "UPDATE %s SET version=version+1, changed=%%s WHERE tablename=%%s" % basium_model.TableVersion._table
+        self.execute(sql, (time.time(), table), commit=True)
+
+    def allocateSeq(self, table, count):
+        """
+        Allocate sequence numbers, see BaseDriver.allocateSeq()
+        The updated row is locked, the select reads the new value
+        """
+        name = basium_driver.seqName(table)
+        sql = "UPDATE %s SET version=version+%%s WHERE tablename=%%s" % basium_model.TableVersion._table
+        self.execute(sql, (count, name))
+        self.execute("SELECT version FROM %s WHERE tablename=%%s" % basium_model.TableVersion._table, (name,))
+        try:
+            seqs = [int(row["version"]) for row in self.cursor.fetchall()]
+        except mysql.connector.Error as err:
+            raise bc.Error(err.errno, str(err))
+        if not seqs:
+            raise bc.Error(1, "Table '%s' has no sequence counter" % table)
+        return max(seqs) - count + 1
 
-    def delete(self, query):
+    def deleteRows(self, query):
         """
         delete a row from a table
         "DELETE FROM EMPLOYEE WHERE AGE > '%d'" % (20)
@@ -526,7 +660,7 @@ class BasiumDriver(basium_driver.BaseDriver):
         returns number of rows deleted
         """
         sql = "DELETE FROM %s" % query.table()
-        sql2, values = query.toSql()
+        sql2, values = query.toSql(self)
         if sql2 == '':
             raise bc.Error(1, 'delete() with empty query not accepted')
         sql += sql2
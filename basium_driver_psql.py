@@ -40,11 +40,13 @@ To use this driver, install the psycopg2 connector
 """
 
 import sys
+import time
 import datetime
 import decimal
 
 import basium_common as bc
 import basium_driver
+import basium_model
 
 err = None
 try:
@@ -282,12 +284,24 @@ class Action:
 
 
 class BasiumDriver(basium_driver.BaseDriver):
+    threadSafe = True
+
+    # each thread has its own connection
+    dbconnection = basium_driver.ThreadLocal()
+    cursor = basium_driver.ThreadLocal()
+    transaction = basium_driver.ThreadLocal(bool)
+    cursorcount = basium_driver.ThreadLocal(int)
+
     def __init__(self, log=None, dbconf=None):
         self.log = log
         self.dbconf = dbconf
         self.dbconnection = None
         self.connectionStatus = None
         self.tables = None
+        self.transaction = False    # True when inside begin() .. commit()/rollback()
+        self.tracked = set()        # tracked tables, see BaseDriver.addClass()
+        self.versions = {}          # table versions, see BaseDriver.tableVersion()
+        self.cursorcount = 0    # used to create unique names for server side cursors
 
     def connect(self):
         try:
@@ -318,12 +332,12 @@ class BasiumDriver(basium_driver.BaseDriver):
                     self.cursor.execute(sql, values)
                 else:
                     self.cursor.execute(sql)
-                if commit:
+                if commit and not self.transaction:
                     self.dbconnection.commit()
                 return
 
             except psycopg2.DatabaseError as e:
-                if i == 1:
+                if i == 1 or self.transaction:
                     raise bc.Error(1, str(e))
                 self.disconnect()
 #                    try:
@@ -331,6 +345,29 @@ class BasiumDriver(basium_driver.BaseDriver):
 #                    except psycopg2.DatabaseError, e:
 #                        pass
 
+    def begin(self):
+        """
+        Start a transaction, execute() does not commit until commit()
+        psycopg2 starts the transaction implicit, at first statement
+        """
+        if self.dbconnection is None:
+            self.connect()
+        self.transaction = True
+
+    def commit(self):
+        self.transaction = False
+        try:
+            self.dbconnection.commit()
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+
+    def rollback(self):
+        self.transaction = False
+        try:
+            self.dbconnection.rollback()
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+
     def isDatabase(self, dbName):
         """
         Returns True if the database exist
@@ -373,6 +410,7 @@ class BasiumDriver(basium_driver.BaseDriver):
         sql += ",".join(columnlist)
         sql += ')'
         self.execute(sql, commit=True)
+        self.tables = None      # isTable() reads the table list again
 
     def verifyTable(self, obj):
         """
@@ -476,7 +514,7 @@ class BasiumDriver(basium_driver.BaseDriver):
 
     def count(self, query):
         sql = "select count(*) from %s" % (query.table())
-        sql2, values = query.toSql()
+        sql2, values = query.toSql(self)
         sql += sql2
 
         self.execute(sql, values)
@@ -496,57 +534,159 @@ class BasiumDriver(basium_driver.BaseDriver):
         If there is any errors, an exception is raised
         """
         sql = "SELECT * FROM %s" % query.table()
-        sql2, values = query.toSql()
+        sql2, values = query.toSql(self)
         sql += sql2
+        if self.dbconf.itersize:
+            return self.selectStream(sql, values)
         self.execute(sql, values)
         return self.cursor
 
-    def insert(self, table, values):
+    def selectStream(self, sql, values):
         """
-        Insert a row in the table
-        value is a dictionary with columns, excluding primary key
+        Use a named (server side) cursor, rows are transferred from the
+        server dbconf.itersize rows at a time
+        The cursor is declared WITH HOLD and the transaction committed, so
+        the connection can be used for writes while the rows are read
         """
-        parms = []
-        holder = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append('"' + key + '"')
-                holder.append("%s")
-                vals.append(val)
-        sql = "INSERT INTO %s ( %s ) VALUES ( %s ) RETURNING _id" % (table, ",".join(parms), ",".join(holder))
-        self.execute(sql, vals, commit=True)
+        if self.dbconnection is None:
+            self.connect()
+        self.cursorcount += 1
         try:
-            data = self.cursor.fetchone()[0]
+            cursor = self.dbconnection.cursor(name="basium_cursor_%d" % self.cursorcount,
+                                              cursor_factory=psycopg2.extras.DictCursor, withhold=True)
+            cursor.itersize = self.dbconf.itersize
+            if self.debug & bc.DEBUG_SQL:
+                self.log.debug('SQL=%s, values=%s' % (sql, values))
+            cursor.execute(sql, values)
+            if not self.transaction:
+                self.dbconnection.commit()
         except psycopg2.DatabaseError as e:
             raise bc.Error(1, str(e))
-        return data
+        return self.iterStream(cursor)
+
+    def iterStream(self, cursor):
+        """
+        Generator, rows from a WITH HOLD cursor. Closing the cursor starts
+        a transaction, it is committed unless begin() was called
+        """
+        connection = self.dbconnection
+        try:
+            yield from self.iterCursor(cursor, self.dbconf.itersize)
+        finally:
+            if not self.transaction and self.dbconnection is connection:
+                try:
+                    connection.commit()
+                except psycopg2.DatabaseError as e:
+                    raise bc.Error(1, str(e))
+
+    def selectWithCount(self, query):
+        """
+        Fetch rows and the total number of matching rows in one statement,
+        using the window function COUNT(*) OVER ()
+        """
+        sql = "SELECT *, COUNT(*) OVER () AS _basium_count FROM %s" % query.table()
+        sql2, values = query.toSql(self)
+        sql += sql2
+        self.execute(sql, values)
+        try:
+            rows = self.cursor.fetchall()
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+        if rows:
+            return rows, rows[0]["_basium_count"]
+        if query._limit is not None and query._limit.offset:
+            # offset past the last row, no row to carry the count
+            return rows, self.count(query.countQuery())
+        return rows, 0
+
+    def insert(self, table, values):
+        """
+        Insert a row in the table
+        value is a dictionary with columns, excluding primary key
+        """
+        with self.writeTransaction(table):
+            values = self.stampChange(table, values)
+            parms = []
+            holder = []
+            vals = []
+            for key, val in values.items():
+                if key != '_id':
+                    parms.append('"' + key + '"')
+                    holder.append("%s")
+                    vals.append(val)
+            sql = "INSERT INTO %s ( %s ) VALUES ( %s ) RETURNING _id" % (table, ",".join(parms), ",".join(holder))
+            self.execute(sql, vals, commit=True)
+            try:
+                data = self.cursor.fetchone()[0]
+            except psycopg2.DatabaseError as e:
+                raise bc.Error(1, str(e))
+            return data
+
+    def insertMany(self, table, rows):
+        """
+        Insert rows with execute_values(), BULK_CHUNK rows per statement
+        RETURNING gives the _id of each row, in order
+        """
+        if not rows:
+            return []
+        with self.writeTransaction(table):
+            rows = self.stampChanges(table, rows)
+            colnames = [key for key in rows[0] if key != '_id']
+            sql = "INSERT INTO %s ( %s ) VALUES %%s RETURNING _id" % (table, ",".join('"%s"' % colname for colname in colnames))
+            if self.debug & bc.DEBUG_SQL:
+                self.log.debug('SQL=%s, %d rows' % (sql, len(rows)))
+            try:
+                result = psycopg2.extras.execute_values(
+                    self.cursor, sql, [[values[colname] for colname in colnames] for values in rows],
+                    page_size=basium_driver.BULK_CHUNK, fetch=True)
+            except psycopg2.DatabaseError as e:
+                raise bc.Error(1, str(e))
+        return [row[0] for row in result]
 
     def update(self, table, values):
         """
         Update a row in the table
         """
-        parms = []
-        vals = []
-        
-        for key, val in values.items():
-            if key != '_id':
-                parms.append('"%s"=%%s' % key)
-                vals.append(val)
-            else:
-                primary_key_val = val
-        sql = "UPDATE %s SET %s WHERE %s=%%s" % (table, ",".join(parms), '_id')
-        vals.append(primary_key_val)
-        self.execute(sql, vals, commit=True)
+        with self.writeTransaction(table):
+            values = self.stampChange(table, values)
+            parms = []
+            vals = []
+
+            for key, val in values.items():
+                if key != '_id':
+                    parms.append('"%s"=%%s' % key)
+                    vals.append(val)
+                else:
+                    primary_key_val = val
+            sql = "UPDATE %s SET %s WHERE %s=%%s" % (table, ",".join(parms), '_id')
+            vals.append(primary_key_val)
+            self.execute(sql, vals, commit=True)
+
+    def bumpVersion(self, table):
+        """Increase the version of a table, see BaseDriver.bumpVersion()"""
+        sql = "UPDATE %s SET version=version+1, changed=%%s WHERE tablename=%%s" % basium_model.TableVersion._table
+        self.execute(sql, (time.time(), table), commit=True)
+
+    def allocateSeq(self, table, count):
+        """Allocate sequence numbers, see BaseDriver.allocateSeq()"""
+        sql = "UPDATE %s SET version=version+%%s WHERE tablename=%%s RETURNING version" % basium_model.TableVersion._table
+        self.execute(sql, (count, basium_driver.seqName(table)))
+        try:
+            seqs = [int(row[0]) for row in self.cursor.fetchall()]
+        except psycopg2.DatabaseError as e:
+            raise bc.Error(1, str(e))
+        if not seqs:
+            raise bc.Error(1, "Table '%s' has no sequence counter" % table)
+        return max(seqs) - count + 1
 
-    def delete(self, query):
+    def deleteRows(self, query):
         """
         delete a row from a table
         "DELETE FROM EMPLOYEE WHERE AGE > '%s'", (20, )
         returns number of rows deleted
         """
         sql = "DELETE FROM %s" % query.table()
-        sql2, values = query.toSql()
+        sql2, values = query.toSql(self)
         if sql2 == '':
             raise bc.Error(1, 'Missing query on delete(), empty query is not accepted')
         sql += sql2
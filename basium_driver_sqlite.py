@@ -37,11 +37,13 @@ SQLite only handles direct files, but the file can be located on a remote
 media that needs to be reconnected
 """
 
+import time
 import datetime
 import decimal
 
 import basium_common as bc
 import basium_driver
+import basium_model
 
 err = None
 try:
@@ -51,6 +53,42 @@ except ImportError:
 if err:
     raise bc.Error(1, err)
 
+# COUNT(*) OVER () needs sqlite 3.25 or later
+WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)
+
+ITERSIZE = 500      # rows fetched at a time by select(), if not dbconf.itersize
+
+
+#
+# Tuning profiles, selected with DbConf.sqliteProfile
+#
+# server     concurrent readers and one writer, WAL journal so readers
+#            don't block the writer. Wait instead of failing with
+#            "database is locked"
+# bulk-load  a single process loading lots of data, durability is traded
+#            for speed. A crash during load can corrupt the database
+#
+PROFILES = {
+    "server": {
+        "busy_timeout": 5000,           # ms
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,       # negative means KiB
+        "temp_store": "MEMORY",
+    },
+    "bulk-load": {
+        "busy_timeout": 5000,
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -256 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+
+PRAGMAS = ["busy_timeout", "journal_mode", "synchronous", "mmap_size", "cache_size", "temp_store"]
+
 
 class ColumnInfo:
     def __init__(self, arg):
@@ -146,30 +184,77 @@ class DecimalCol(basium_driver.Column):
     Stores a fixed precision number
     we cheat and represent this as a float in python
     sqlite does not handle decimal, so we use varchar instead
+
+    With scaled (DbConf.scaledDecimal, passed by the driver) the number
+    is instead stored as an INTEGER, multiplied with 10**decimal. This is
+    exact, and comparisons, ORDER BY and SUM() runs natively and can use
+    indexes
     """
 
-    def typeToSql(self):
-        sql = 'varchar'
+    def typeToSql(self, scaled=False):
+        if scaled:
+            sql = 'INTEGER'
+        else:
+            sql = 'varchar'
         if self.nullable:
             sql += " null"
         else:
             sql += " not null"
         if self.default is not None:
-            sql += " default '%s'" % str(self.default)
+            if scaled:
+                sql += " default %i" % DecimalCol.toSql(self, self.default, scaled=True)
+            else:
+                sql += " default '%s'" % str(self.default)
         return sql
 
-    def toPython(self, value):
+    def toPython(self, value, scaled=False):
         if value is None:
             return None
         if isinstance(value, decimal.Decimal):
             return value
+        if scaled and isinstance(value, int):
+            return decimal.Decimal(value).scaleb(-self.decimal)
         return decimal.Decimal(value)
 
-    def toSql(self, value):
+    def toSql(self, value, scaled=False):
+        if scaled:
+            if value is None:
+                return None     # a real NULL, so SUM() etc works
+            value = decimal.Decimal(value).scaleb(self.decimal)
+            return int(value.to_integral_value(rounding=decimal.ROUND_HALF_EVEN))
         if value is None:
             return "NULL"
         return float(value)
 
+    def migrateSql(self, colname, tabletype, scaled=False):
+        """
+        Convert between varchar and scaled INTEGER storage
+        """
+        oldscaled = tabletype.upper().startswith('INTEGER')
+        if oldscaled == scaled:
+            return colname
+        if scaled:
+            expr = "basium_scale(%s, %d)" % (colname, self.decimal)
+        else:
+            expr = "basium_unscale(%s, %d)" % (colname, self.decimal)
+        return "CASE WHEN %s IS NULL OR %s = 'NULL' THEN NULL ELSE %s END" % (colname, colname, expr)
+
+
+def scaleDecimal(value, decimals):
+    """
+    SQL function basium_scale(), the text of a decimal number as an
+    INTEGER multiplied with 10**decimals. Converted exactly, not as REAL
+    """
+    scaled = decimal.Decimal(value).scaleb(decimals).to_integral_value(rounding=decimal.ROUND_HALF_EVEN)
+    if not -2**63 <= scaled < 2**63:
+        raise ValueError("Decimal %s does not fit in a 64 bit INTEGER" % value)
+    return int(scaled)
+
+
+def unscaleDecimal(value, decimals):
+    """SQL function basium_unscale(), the scaled INTEGER as decimal text"""
+    return format(decimal.Decimal(value).scaleb(-decimals), "f")
+
 
 class FloatCol(basium_driver.Column):
     """
@@ -245,26 +330,99 @@ class VarcharCol(basium_driver.Column):
 
 
 class Action:
-    def __init__(self, msg=None, unattended=None, sqlcmd=None):
+    def __init__(self, msg=None, unattended=None, sqlcmd=None, rebuild=False):
         self.msg = msg
         self.unattended = unattended
         self.sqlcmd = sqlcmd
+        self.rebuild = rebuild      # sqlite cannot change column type, table must be rebuilt
 
 
 class BasiumDriver(basium_driver.BaseDriver):
+    threadSafe = True
+
+    # each thread has its own connection
+    dbconnection = basium_driver.ThreadLocal()
+    cursor = basium_driver.ThreadLocal()
+    transaction = basium_driver.ThreadLocal(bool)
+    dataVersion = basium_driver.ThreadLocal()
+    versions = basium_driver.ThreadLocal(dict)    # read with the connection, see versionsChanged()
+
     def __init__(self, log=None, dbconf=None):
         self.log = log
         self.dbconf = dbconf
+        if self.dbconf.database == ":memory:":
+            self.threadSafe = False     # the database is in the connection, it is shared
 
         self.dbconnection = None
         self.tables = None
         self.connectionStatus = None
+        self.transaction = False    # True when inside begin() .. commit()/rollback()
+        self.tracked = set()        # tracked tables, see BaseDriver.addClass()
+        self.versions = {}          # table versions, see BaseDriver.tableVersion()
+        self.dataVersion = None     # PRAGMA data_version when versions was read
+        self.scaledDecimal = self.dbconf.scaledDecimal
+
+    def isScaled(self, column):
+        """True if column is a DecimalCol stored as a scaled INTEGER"""
+        return self.scaledDecimal and isinstance(column, basium_model.DecimalCol)
+
+    def toPython(self, column, value):
+        if self.isScaled(column):
+            return DecimalCol.toPython(column, value, scaled=True)
+        return column.toPython(value)
+
+    def toSql(self, column, value):
+        if self.isScaled(column):
+            return DecimalCol.toSql(column, value, scaled=True)
+        return column.toSql(value)
+
+    def typeToSql(self, column):
+        if isinstance(column, basium_model.DecimalCol):
+            return DecimalCol.typeToSql(column, scaled=self.scaledDecimal)
+        return column.typeToSql()
+
+    def migrateSql(self, column, colname, tabletype):
+        if isinstance(column, basium_model.DecimalCol):
+            return DecimalCol.migrateSql(column, colname, tabletype, scaled=self.scaledDecimal)
+        return column.migrateSql(colname, tabletype)
+
+    def getProfile(self):
+        """
+        Return list of (pragma, value) to apply on connect
+        """
+        profile = self.dbconf.sqliteProfile
+        if profile is None:
+            return []
+        if isinstance(profile, str):
+            if profile not in PROFILES:
+                raise bc.Error(1, "Unknown sqlite profile '%s'" % profile)
+            profile = PROFILES[profile]
+        pragmas = []
+        for pragma in PRAGMAS:       # apply in this order, busy_timeout first
+            if pragma in profile:
+                value = profile[pragma]
+                if not isinstance(value, int) and not str(value).isalnum():
+                    raise bc.Error(1, "Illegal value '%s' for sqlite pragma %s" % (value, pragma))
+                pragmas.append((pragma, value))
+        for pragma in profile:
+            if pragma not in PRAGMAS:
+                raise bc.Error(1, "Unknown sqlite pragma '%s'" % pragma)
+        return pragmas
 
     def connect(self):
         try:
-            self.dbconnection = sqlite3.connect(self.dbconf.database,  check_same_thread=False)
+            # a write takes the database lock when its transaction starts,
+            # so connections in other threads wait for it instead of
+            # failing when a read lock can't be upgraded
+            self.dbconnection = sqlite3.connect(self.dbconf.database,  check_same_thread=False,
+                                                isolation_level="IMMEDIATE")
             self.dbconnection.row_factory = sqlite3.Row   # return querys as dictionaries
             self.cursor = self.dbconnection.cursor()
+            for pragma, value in self.getProfile():
+                sql = "PRAGMA %s=%s" % (pragma, value)
+                if self.debug & bc.DEBUG_SQL:
+                    self.log.debug('SQL=%s' % sql)
+                self.cursor.execute(sql)
         except sqlite3.Error as e:
             raise bc.Error(1, e.args[0])
 
@@ -289,14 +447,37 @@ class BasiumDriver(basium_driver.BaseDriver):
                     self.cursor.execute(sql, values)
                 else:
                     self.cursor.execute(sql)
-                if commit:
+                if commit and not self.transaction:
                     self.dbconnection.commit()
                 return
 
             except sqlite3.Error as e:
-                if i == 1:
+                if i == 1 or self.transaction:
                     raise bc.Error(1, e.args[0])
 
+    def begin(self):
+        """
+        Start a transaction, execute() does not commit until commit()
+        sqlite3 starts the transaction implicit, at first modifying statement
+        """
+        if self.dbconnection is None:
+            self.connect()
+        self.transaction = True
+
+    def commit(self):
+        self.transaction = False
+        try:
+            self.dbconnection.commit()
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+
+    def rollback(self):
+        self.transaction = False
+        try:
+            self.dbconnection.rollback()
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+
     def isDatabase(self, dbName):
         """
         Returns True if the database exist
@@ -320,19 +501,70 @@ class BasiumDriver(basium_driver.BaseDriver):
                 raise bc.Error( 1, e.args[0] )
         return tableName in self.tables
 
-    def createTable(self, obj):
-        """
-        Create a table
-        """
-        sql = 'CREATE TABLE %s (' % obj._table
+    def createTableSql(self, obj, table=None):
+        if table is None:
+            table = obj._table
+        sql = 'CREATE TABLE %s (' % table
         columnlist = []
         for colname, column in obj._iterNameColumn():
-            columnlist.append('%s %s' % (colname, column.typeToSql()))
+            columnlist.append('%s %s' % (colname, self.typeToSql(column)))
         sql += "  ,".join(columnlist)
         sql += ')'
-        self.execute(sql)
+        return sql
+
+    def createTable(self, obj):
+        """
+        Create a table
+        """
+        self.execute(self.createTableSql(obj))
+        self.tables = None      # isTable() reads the table list again
         return True
 
+    def rebuildTable(self, obj, tabletypes):
+        """
+        Create a new table from the object, copy all rows from the old table
+        converting each column that exist in both, then remove the old table
+        This is the sqlite way of doing ALTER TABLE ... CHANGE
+        """
+        table = obj._table
+        oldtable = "%s_basium_old" % table
+        colnames = []
+        exprs = []
+        for colname, column in obj._iterNameColumn():
+            if colname in tabletypes:
+                colnames.append(colname)
+                exprs.append(self.migrateSql(column, colname, tabletypes[colname][2]))
+        errors = []
+
+        def sqlFunction(func):
+            # sqlite reports only that the function failed, keep the reason
+            def call(value, decimals):
+                try:
+                    return func(value, decimals)
+                except (ValueError, decimal.InvalidOperation) as e:
+                    errors.append("Cannot convert column value %r: %s" % (value, e))
+                    raise
+            return call
+
+        self.dbconnection.create_function("basium_scale", 2, sqlFunction(scaleDecimal))
+        self.dbconnection.create_function("basium_unscale", 2, sqlFunction(unscaleDecimal))
+        sqls = [
+            "BEGIN",
+            "ALTER TABLE %s RENAME TO %s" % (table, oldtable),
+            self.createTableSql(obj),
+            "INSERT INTO %s ( %s ) SELECT %s FROM %s" % (table, ",".join(colnames), ",".join(exprs), oldtable),
+            "DROP TABLE %s" % oldtable,
+        ]
+        try:
+            for sql in sqls:
+                if self.debug & bc.DEBUG_TABLE_MGMT:
+                    self.log.debug("  Cmd: %s" % sql)
+                self.cursor.execute(sql)
+            self.dbconnection.commit()
+        except sqlite3.Error as e:
+            self.dbconnection.rollback()
+            raise bc.Error(1, errors[0] if errors else e.args[0])
+
     def tableTypeToSql(self, tabletype):
         """
         Map from sql query to table types
@@ -372,7 +604,7 @@ class BasiumDriver(basium_driver.BaseDriver):
         for colname, column in obj._iterNameColumn():
             if colname in tabletypes:
                 tabletype = tabletypes[colname]
-                columntype_str = column.typeToSql()
+                columntype_str = self.typeToSql(column)
                 tabletype_str = self.tableTypeToSql(tabletype)
                 if columntype_str != tabletype_str:
                     msg = "Error: Column '%s' has incorrect type in SQL Table. Action: Change column type in SQL Table" % (colname)
@@ -383,7 +615,8 @@ class BasiumDriver(basium_driver.BaseDriver):
                     actions.append(Action(
                             msg=msg,
                             unattended=True,
-                            sqlcmd='ALTER TABLE %s CHANGE %s %s %s' % (obj._table, colname, colname, columntype_str)
+                            sqlcmd='ALTER TABLE %s CHANGE %s %s %s' % (obj._table, colname, colname, columntype_str),
+                            rebuild=True
                             ))
             else:
                 msg = "Error: Column '%s' does not exist in the SQL Table. Action: Add column to SQL Table" % (colname)
@@ -392,7 +625,7 @@ class BasiumDriver(basium_driver.BaseDriver):
                 actions.append(Action(
                         msg=msg,
                         unattended=True,
-                        sqlcmd='ALTER TABLE %s ADD COLUMN %s %s' % (obj._table, colname, column.typeToSql())
+                        sqlcmd='ALTER TABLE %s ADD COLUMN %s %s' % (obj._table, colname, self.typeToSql(column))
                         ))
 
         for colname, tabletype in tabletypes.items():
@@ -431,6 +664,15 @@ class BasiumDriver(basium_driver.BaseDriver):
             if a != 'yes':
                 raise bc.Error(1, "Aborted!")
 
+        if any(action.rebuild for action in actions):
+            # a rebuild also adds and removes columns
+            self.execute("PRAGMA table_info([%s])" % obj._table)
+            tabletypes = {}
+            for row in self.cursor.fetchall():
+                tabletypes[row[1]] = row
+            self.rebuildTable(obj, tabletypes)
+            return
+
         # we first remove columns, so we dont get into conflicts
         # with the new columns, for example changing primary key (there can only be one primary key)
         for action in actions:
@@ -448,11 +690,14 @@ class BasiumDriver(basium_driver.BaseDriver):
 
     def count(self, query):
         sql = "select count(*) from %s" % (query.table())
-        sql2, values = query.toSql()
-        sql += sql2
+        sql2, values = query.toSql(self)
+        sql += sql2.replace("%s", "?")
         self.execute(sql, values)
         try:
-            row = self.cursor.fetchone()
+            # fetchall() ends the statement, so the connection does not
+            # keep a read lock that blocks writes from other threads
+            rows = self.cursor.fetchall()
+            row = rows[0] if rows else None
             if row is not None:
                 key = 'count(*)'
                 rows = int(row[key])
@@ -467,52 +712,153 @@ class BasiumDriver(basium_driver.BaseDriver):
         Fetch one or multiple rows from a database
         Returns an object that can be iterated over, returning rows
         If there is any errors, an exception is raised
+        The rows are read with an own cursor, closed when all rows are
+        read or the result is discarded. An unfinished statement keeps a
+        read lock, that blocks commits from connections in other threads
         """
         sql = "SELECT * FROM %s" % query.table()
-        sql2, values = query.toSql()
+        sql2, values = query.toSql(self)
+        sql += sql2.replace("%s", "?")
+        if self.dbconnection is None:
+            self.connect()
+        if self.debug & bc.DEBUG_SQL:
+            self.log.debug('SQL=%s' % sql)
+            if values:
+                self.log.debug('   =%s' % values)
+        try:
+            cursor = self.dbconnection.execute(sql, values or [])
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+        return self.iterCursor(cursor, self.dbconf.itersize or ITERSIZE)
+
+    def selectWithCount(self, query):
+        """
+        Fetch rows and the total number of matching rows in one statement,
+        using the window function COUNT(*) OVER ()
+        """
+        if not WINDOW_FUNCTIONS:
+            return super().selectWithCount(query)
+        sql = "SELECT *, COUNT(*) OVER () AS _basium_count FROM %s" % query.table()
+        sql2, values = query.toSql(self)
         sql += sql2.replace("%s", "?")
         self.execute(sql, values)
-        return self.cursor
+        try:
+            rows = self.cursor.fetchall()
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+        if rows:
+            return rows, rows[0]["_basium_count"]
+        if query._limit is not None and query._limit.offset:
+            # offset past the last row, no row to carry the count
+            return rows, self.count(query.countQuery())
+        return rows, 0
 
     def insert(self, table, values):
         """
         Insert a row in the table
         value is a dictionary with columns, primary key '_id' is ignored
         """
-        parms = []
-        holder = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append(key)
-                holder.append("?")
-                vals.append(val)
-        sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(parms), ",".join(holder))
-        self.execute(sql, vals, commit=True)
-        return self.cursor.lastrowid
+        with self.writeTransaction(table):
+            values = self.stampChange(table, values)
+            parms = []
+            holder = []
+            vals = []
+            for key, val in values.items():
+                if key != '_id':
+                    parms.append(key)
+                    holder.append("?")
+                    vals.append(val)
+            sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(parms), ",".join(holder))
+            self.execute(sql, vals, commit=True)
+            return self.cursor.lastrowid
+
+    def insertMany(self, table, rows):
+        """
+        Insert rows with executemany(), BULK_CHUNK rows at a time
+        The rows get consecutive _id, the last is from last_insert_rowid()
+        """
+        if not rows:
+            return []
+        ids = []
+        with self.writeTransaction(table):
+            rows = self.stampChanges(table, rows)
+            colnames = [key for key in rows[0] if key != '_id']
+            sql = "INSERT INTO %s ( %s ) VALUES ( %s )" % (table, ",".join(colnames), ",".join("?" * len(colnames)))
+            if self.debug & bc.DEBUG_SQL:
+                self.log.debug('SQL=%s, %d rows' % (sql, len(rows)))
+            try:
+                for start in range(0, len(rows), basium_driver.BULK_CHUNK):
+                    chunk = [[values[colname] for colname in colnames]
+                             for values in rows[start:start + basium_driver.BULK_CHUNK]]
+                    self.cursor.executemany(sql, chunk)
+                    self.cursor.execute("SELECT last_insert_rowid()")
+                    last = self.cursor.fetchone()[0]
+                    ids.extend(range(last - len(chunk) + 1, last + 1))
+            except sqlite3.Error as e:
+                raise bc.Error(1, e.args[0])
+        return ids
 
     def update(self, table, values):
         """Update a row in the table"""
-        parms = []
-        vals = []
-        for key, val in values.items():
-            if key != '_id':
-                parms.append("%s=?" % key)
-                vals.append(val)
-            else:
-                primary_key_val = val
-        sql = "UPDATE %s SET %s WHERE _id=?" % (table, ",".join(parms))
-        vals.append(primary_key_val)
-        self.execute(sql, vals)
+        with self.writeTransaction(table):
+            values = self.stampChange(table, values)
+            parms = []
+            vals = []
+            for key, val in values.items():
+                if key != '_id':
+                    parms.append("%s=?" % key)
+                    vals.append(val)
+                else:
+                    primary_key_val = val
+            sql = "UPDATE %s SET %s WHERE _id=?" % (table, ",".join(parms))
+            vals.append(primary_key_val)
+            self.execute(sql, vals)
+
+    def bumpVersion(self, table):
+        """Increase the version of a table, see BaseDriver.bumpVersion()"""
+        self.execute("UPDATE %s SET version=version+1, changed=? WHERE tablename=?" %
+                     basium_model.TableVersion._table, [time.time(), table])
+        self.dataVersion = None     # our own commits does not change data_version
+
+    def allocateSeq(self, table, count):
+        """Allocate sequence numbers, see BaseDriver.allocateSeq()"""
+        name = basium_driver.seqName(table)
+        self.execute("UPDATE %s SET version=version+? WHERE tablename=?" %
+                     basium_model.TableVersion._table, [count, name], commit=False)
+        self.execute("SELECT version FROM %s WHERE tablename=?" %
+                     basium_model.TableVersion._table, [name], commit=False)
+        try:
+            seqs = [int(row["version"]) for row in self.cursor.fetchall()]
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+        if not seqs:
+            raise bc.Error(1, "Table '%s' has no sequence counter" % table)
+        return max(seqs) - count + 1
+
+    def versionsChanged(self):
+        """
+        PRAGMA data_version changes when another connection commits, so
+        the version table is only read again after a write
+        """
+        if self.dbconnection is None:
+            self.connect()
+        try:
+            # own cursor, self.cursor can be in use by a select
+            dataVersion = self.dbconnection.execute("PRAGMA data_version").fetchone()[0]
+        except sqlite3.Error as e:
+            raise bc.Error(1, e.args[0])
+        changed = dataVersion != self.dataVersion
+        self.dataVersion = dataVersion
+        return changed
 
-    def delete(self, query):
+    def deleteRows(self, query):
         """
         delete a row from a table
          "DELETE FROM EMPLOYEE WHERE AGE > '%d'" % (20)
         returns number of rows deleted
         """
         sql = "DELETE FROM %s" % query.table()
-        sql2, values = query.toSql()
+        sql2, values = query.toSql(self)
         if sql2 == '':
             raise bc.Error(1, 'Missing query on delete(), empty query is not accepted')
         sql += sql2.replace("%s", "?")
@@ -0,0 +1,348 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012-2013, Anders Lowinger, Abundo AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Basium database driver, the json driver with a local sqlite copy of
+selected tables
+
+Reads of a cached table are answered from the local copy. Writes are
+sent to the server, and the local copy is updated with the written values
+and the _id returned by the server (write-through)
+
+A table is cached if the model class sets _cacheMaxAge, the number of
+seconds the local copy is used before it is refreshed from the server.
+With 0 each read checks the server first, which is cheap when nothing
+changed (the server answers 304). Larger values bound how stale a read
+may be, and saves the round trip. If the model also sets _trackChanges,
+a refresh fetches only the rows changed since the last refresh
+
+    class Country(basium_model.Model):
+        _cacheMaxAge = 300
+        name = basium_model.VarcharCol()
+
+DbConf.host is the server, as for the json driver, DbConf.localDatabase
+is the sqlite file for the local copy
+"""
+
+import copy
+import time
+
+import basium_common as bc
+import basium_driver
+import basium_driver_json
+import basium_driver_sqlite
+
+#
+# The column classes converts values as the json driver, the values are
+# sent to the server. The local table is defined as in the sqlite driver,
+# values stored locally are converted explicit with the sqlite classes.
+# The sqlite classes are not inherited, the sqlite driver may mix them
+# into the model classes in the same process
+#
+
+
+class BooleanCol(basium_driver_json.BooleanCol):
+    typeToSql = basium_driver_sqlite.BooleanCol.typeToSql
+
+
+class DateCol(basium_driver_json.DateCol):
+    typeToSql = basium_driver_sqlite.DateCol.typeToSql
+
+
+class DateTimeCol(basium_driver_json.DateTimeCol):
+    typeToSql = basium_driver_sqlite.DateTimeCol.typeToSql
+
+
+class DecimalCol(basium_driver_json.DecimalCol):
+    # the local copy is always stored as varchar, the default of the sqlite class
+    typeToSql = basium_driver_sqlite.DecimalCol.typeToSql
+    migrateSql = basium_driver_sqlite.DecimalCol.migrateSql
+
+
+class FloatCol(basium_driver_json.FloatCol):
+    typeToSql = basium_driver_sqlite.FloatCol.typeToSql
+
+
+class IntegerCol(basium_driver_json.IntegerCol):
+    typeToSql = basium_driver_sqlite.IntegerCol.typeToSql
+
+
+class VarcharCol(basium_driver_json.VarcharCol):
+    typeToSql = basium_driver_sqlite.VarcharCol.typeToSql
+
+
+class CachedTable:
+    """
+    State of one locally cached table
+    """
+    def __init__(self, obj, maxAge):
+        self.obj = obj
+        self.maxAge = maxAge
+        self.refreshed = None   # time.monotonic() of last refresh
+        self.etag = None        # from the server, for conditional refresh
+        self.seq = None         # last change fetched, tables with _trackChanges
+
+        # (colname, column, sqlite column class) for each column
+        self.columns = []
+        for colname, column in obj._iterNameColumn():
+            self.columns.append((colname, column, getattr(basium_driver_sqlite, type(column).__name__)))
+        colnames = [colname for colname, column, sqliteCls in self.columns]
+        self.insertSql = "INSERT OR REPLACE INTO %s ( %s ) VALUES ( %s )" % (
+            obj._table, ",".join(colnames), ",".join("?" * len(colnames)))
+
+    def isStale(self):
+        return self.refreshed is None or time.monotonic() - self.refreshed >= self.maxAge
+
+    def toLocal(self, values):
+        """
+        Convert a row from the server, or values sent to the server, to
+        a list of values for the local table, in column order
+        """
+        row = []
+        for colname, column, sqliteCls in self.columns:
+            value = values.get(colname)
+            if value is not None:
+                try:
+                    value = column.toPython(value)
+                except (ValueError, ArithmeticError):
+                    value = None    # "NULL" from the server
+            if value is not None:
+                value = sqliteCls.toSql(column, value)
+            row.append(value)
+        return row
+
+    def fromLocal(self, row):
+        """Convert a row from the local table to python values"""
+        values = {}
+        for colname, column, sqliteCls in self.columns:
+            value = row[colname]
+            if value is not None:
+                value = sqliteCls.toPython(column, value)
+            values[colname] = value
+        return values
+
+    def localValue(self, column, value):
+        """Convert a python value, as in a query, for the local table"""
+        if value is None:
+            return None
+        return getattr(basium_driver_sqlite, type(column).__name__).toSql(column, value)
+
+
+class BasiumDriver(basium_driver.BaseDriver):
+    def __init__(self, log=None, dbconf=None):
+        self.log = log
+        self.dbconf = dbconf
+        self.remote = basium_driver_json.BasiumDriver(log=log, dbconf=dbconf)
+        localconf = copy.copy(dbconf)
+        localconf.database = dbconf.localDatabase
+        self.local = basium_driver_sqlite.BasiumDriver(log=log, dbconf=localconf)
+        self.cached = {}    # key is table, value is CachedTable
+
+    @property
+    def debug(self):
+        return self.remote.debug
+
+    @debug.setter
+    def debug(self, value):
+        self.remote.debug = value
+        self.local.debug = value
+
+    def connect(self):
+        self.remote.connect()
+        self.local.connect()
+
+    def disconnect(self):
+        self.remote.disconnect()
+        self.local.disconnect()
+
+    def addClass(self, cls):
+        """
+        Create the local table for classes that should be cached
+        The local table is only a copy, if the definition has changed it
+        is recreated
+        """
+        if cls._cacheMaxAge is None:
+            return
+        obj = cls()
+        if self.local.isTable(obj._table):
+            actions = self.local.verifyTable(obj)
+            if actions:
+                self.local.execute("DROP TABLE %s" % obj._table)
+                self.local.createTable(obj)
+        else:
+            self.local.createTable(obj)
+        self.cached[obj._table] = CachedTable(obj, cls._cacheMaxAge)
+
+    def refresh(self, table):
+        """
+        Update the local copy of a table from the server, if changed
+        Tables with _trackChanges fetch only the changed rows
+        """
+        state = self.cached[table]
+        if state.obj._trackChanges:
+            rows, deleted, seq = self.remote.changes(state.obj, state.seq)
+        else:
+            rows, etag = self.remote.selectTable(table, state.etag)
+            deleted = None
+        if rows is not None:
+            self.local.begin()
+            try:
+                if deleted is None:
+                    self.local.execute("DELETE FROM %s" % table)
+                else:
+                    self.local.cursor.executemany("DELETE FROM %s WHERE _id=?" % table,
+                                                  [(_id,) for _id in deleted])
+                self.local.cursor.executemany(state.insertSql, [state.toLocal(row) for row in rows])
+            except Exception as e:
+                self.local.rollback()
+                raise bc.Error(1, "Cannot refresh local table '%s': %s" % (table, e))
+            self.local.commit()
+            if state.obj._trackChanges:
+                state.seq = seq
+            else:
+                state.etag = etag
+        state.refreshed = time.monotonic()
+
+    def getCached(self, table):
+        """Returns the CachedTable, refreshed if too old, or None if the table is not cached"""
+        state = self.cached.get(table)
+        if state is not None and state.isStale():
+            self.refresh(table)
+        return state
+
+    def querySql(self, state, query, whereOnly=False):
+        """
+        As Query.toSql(), with values converted for the local table
+        """
+        values = []
+        sql = ""
+        if query._where:
+            where = []
+            for w in query._where:
+                where.append("%s %s ?" % (w.column.name, w.operand))
+                values.append(state.localValue(w.column, w.value))
+            sql += " where (%s)" % " and ".join(where)
+        if whereOnly:
+            return sql, values
+        if query._order:
+            sql += " ORDER BY " + ",".join(order.toSql() for order in query._order)
+        if query._limit is not None:
+            sql += query._limit.toSql()
+        return sql, values
+
+    def writeLocal(self, table, values, _id):
+        state = self.cached[table]
+        values = dict(values)
+        values["_id"] = _id
+        self.local.execute(state.insertSql, state.toLocal(values))
+
+    def deleteLocal(self, query):
+        state = self.cached[query.table()]
+        sql, values = self.querySql(state, query, whereOnly=True)
+        self.local.execute("DELETE FROM %s%s" % (query.table(), sql), values)
+
+    def isDatabase(self, dbName):
+        return self.remote.isDatabase(dbName)
+
+    def isTable(self, tableName):
+        return self.remote.isTable(tableName)
+
+    def changes(self, obj, since=None):
+        return self.remote.changes(obj, since)
+
+    def tableVersion(self, table):
+        return self.remote.tableVersion(table)
+
+    def count(self, query):
+        state = self.getCached(query.table())
+        if state is None:
+            return self.remote.count(query)
+        sql, values = self.querySql(state, query, whereOnly=True)
+        self.local.execute("SELECT count(*) FROM %s%s" % (query.table(), sql), values)
+        return self.local.cursor.fetchone()[0]
+
+    def select(self, query):
+        state = self.getCached(query.table())
+        if state is None:
+            return self.remote.select(query)
+        sql, values = self.querySql(state, query)
+        self.local.execute("SELECT * FROM %s%s" % (query.table(), sql), values)
+        return [state.fromLocal(row) for row in self.local.cursor.fetchall()]
+
+    def selectWithCount(self, query):
+        if self.getCached(query.table()) is None:
+            return self.remote.selectWithCount(query)
+        return self.select(query), self.count(query.countQuery())
+
+    def insert(self, table, values):
+        _id = self.remote.insert(table, values)
+        if table in self.cached:
+            self.writeLocal(table, values, _id)
+        return _id
+
+    def insertMany(self, table, rows):
+        ids = self.remote.insertMany(table, rows)
+        state = self.cached.get(table)
+        if state is not None:
+            local = []
+            for values, _id in zip(rows, ids):
+                values = dict(values)
+                values["_id"] = _id
+                local.append(state.toLocal(values))
+            with self.local.inTransaction():
+                self.local.cursor.executemany(state.insertSql, local)
+        return ids
+
+    def update(self, table, values):
+        data = self.remote.update(table, values)
+        if table in self.cached:
+            self.writeLocal(table, values, values["_id"])
+        return data
+
+    def delete(self, query):
+        data = self.remote.delete(query)
+        if query.table() in self.cached:
+            self.deleteLocal(query)
+        return data
+
+    def executeBatch(self, ops):
+        """
+        The operations are executed by the server, then the writes
+        are applied to the local copy
+        """
+        results = self.remote.executeBatch(ops)
+        for (op, table, arg), result in zip(ops, results):
+            if table not in self.cached:
+                continue
+            if op == "insert":
+                self.writeLocal(table, arg, result)
+            elif op == "update":
+                self.writeLocal(table, arg, arg["_id"])
+            elif op == "delete":
+                self.deleteLocal(arg)
+        return results
@@ -155,6 +155,15 @@ class Model(metaclass=ModelMetaClass):
     """
     __metaclass__ = ModelMetaClass
 
+    # tiered driver, number of seconds the local copy of the table is used
+    # before it is refreshed from the server. None, the table is not cached
+    _cacheMaxAge = None
+
+    # If True, the drivers maintain a _seq column with the sequence number
+    # of the last change of the row, and a tombstone for each deleted row.
+    # Used by Basium.changes() to fetch only what changed since last time
+    _trackChanges = False
+
     def __init__(self, id_value=-1):
         _id = IntegerCol(primary_key=True)
         _id._model = self
@@ -165,6 +174,13 @@ class Model(metaclass=ModelMetaClass):
         # create instance variables of the class columns
         q = Q()
         q._id = _id
+        if self._trackChanges:
+            _seq = IntegerCol()
+            _seq._model = self
+            _seq.name = '_seq'
+            columns['_seq'] = _seq
+            values['_seq'] = None
+            q._seq = _seq
         for colname, column in inspect.getmembers(self):
             if colname[0] != "_" and isinstance(column, Column):
                 column.name = colname
@@ -195,7 +211,7 @@ class Model(metaclass=ModelMetaClass):
         if other is None:
             return False
         for colname in self._iterName():
-            if colname != '_id':
+            if colname[0] != '_':       # _id, _seq are maintained by basium
                 if getattr(self, colname) != getattr(other, colname):
                     return False
         return True
@@ -233,3 +249,24 @@ class Model(metaclass=ModelMetaClass):
     def _iterNameColumn(self):
         for colname, column in self._columns.items():
             yield colname, column
+
+
+class Tombstone(Model):
+    """
+    A deleted row in a table with _trackChanges
+    """
+    _table = "basium_tombstone"
+    tablename = VarcharCol(nullable=False)
+    rowid = IntegerCol(nullable=False)
+    seq = IntegerCol(nullable=False)
+
+
+class TableVersion(Model):
+    """
+    The version of a table, increased after each write through basium
+    changed is the time of the last write, seconds since the epoch
+    """
+    _table = "basium_version"
+    tablename = VarcharCol(nullable=False)
+    version = IntegerCol(nullable=False)
+    changed = FloatCol(nullable=False)
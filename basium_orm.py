@@ -36,6 +36,8 @@ before calling database driver, or returning objects
 
 import inspect
 import urllib
+import contextlib
+import concurrent.futures
 
 import basium_common as bc
 import basium_model
@@ -133,6 +135,23 @@ class BasiumOrm:
         self.driver.modifyTable(obj, actions)
         return True
 
+    def tableVersion(self, table):
+        """
+        Returns (version, time of last change) for a table
+        The version is kept in the database and increases after each
+        write through basium, by any process. Compare it to the version
+        a cached result was created with, to see if the cache is valid
+        """
+        return self.driver.tableVersion(table)
+
+    def tableChanged(self, table):
+        """
+        Increment the version of a table, for writes that are not made
+        through basium. The drivers increase the version in the
+        transaction of each write, so it is committed with the data
+        """
+        self.driver.bumpVersion(table)
+
     def count(self, query_):
         if isinstance(query_, basium_model.Model):
             query = Query(query_)
@@ -158,28 +177,69 @@ class BasiumOrm:
         Note: when loading a single object, an error is returned if not found. 
         Workaround is to use a query instead
         """
-        one = False
+        data = list(self.loadIter(query_))
+        if isinstance(query_, basium_model.Model) and len(data) < 1:
+            raise bc.Error(1, "Unknown ID %s in table %s" % (query_._id, query_._table))
+        return data
+
+    def loadWithCount(self, query_):
+        """
+        As load(), but also returns the total number of matching rows,
+        ignoring the limit in the query. Useful for pagination, one
+        request to the database instead of a count() and a load()
+
+        query_ can be an instance of Model(), the object with its _id as
+        in load(), or Query()
+        Returns (list of objects, total)
+        """
         if isinstance(query_, basium_model.Model):
             query = Query().filter(query_.q._id, EQ, query_._id)
-            one = True
         elif isinstance(query_, Query):
             query = query_
         else:
             raise bc.Error(1, "Fatal: incorrect object type")
+        rows, total = self.driver.selectWithCount(query)
+        data = list(self._iterObjects(query, rows))
+        if isinstance(query_, basium_model.Model) and len(data) < 1:
+            raise bc.Error(1, "Unknown ID %s in table %s" % (query_._id, query_._table))
+        return data, total
 
-        data = []
-        for row in self.driver.select(query):
+    def loadIter(self, query_):
+        """
+        As load(), but returns a generator that creates one object at a time
+        Together with a streaming driver (dbconf.itersize) only one chunk
+        of rows is held in memory
+
+        While the rows are read, psql can store and delete on the same
+        thread. mysql cannot, other operations raise bc.Error until the
+        generator is read to the end or discarded
+        """
+        if isinstance(query_, basium_model.Model):
+            query = Query().filter(query_.q._id, EQ, query_._id)
+        elif isinstance(query_, Query):
+            query = query_
+        else:
+            raise bc.Error(1, "Fatal: incorrect object type")
+
+        return self._iterObjects(query, self.driver.select(query))
+
+    def _iterObjects(self, query, rows):
+        toPython = self.driver.toPython
+        for row in rows:
             newobj = query._model.__class__()
             for colname, column in newobj._iterNameColumn():
                 try:
-                    newobj._values[colname] = column.toPython(row[colname])
+                    newobj._values[colname] = toPython(column, row[colname])
                 except (KeyError, ValueError):
                     pass
-            data.append(newobj)
-        if one and len(data) < 1:
-            raise bc.Error(1, "Unknown ID %s in table %s" % (query_._id, query_._table))
+            yield newobj
 
-        return data
+    def _storeValues(self, obj):
+        """Return all columns in obj, converted for the driver"""
+        columns = {}
+        for colname, column in obj._iterNameColumn():
+            columns[colname] = self.driver.toSql(column, obj._values[colname])
+        return columns
 
     def store(self, obj):
         """
@@ -187,9 +247,7 @@ class BasiumOrm:
         If the objects _id is set, we update the current row in the table,
         otherwise we create a new row
         """
-        columns = {}
-        for colname, column in obj._iterNameColumn():
-            columns[colname] = column.toSql(obj._values[colname])
+        columns = self._storeValues(obj)
 
         if obj._id >= 0:
             # update
@@ -200,6 +258,25 @@ class BasiumOrm:
             obj._id = self.driver.insert(obj._table, columns)
         return obj._id
 
+    def storeMany(self, objs):
+        """
+        Store a list of objects, in one transaction
+        With the json driver this is one request to the server
+        If all objects are new and in the same table, they are inserted
+        with the drivers insertMany()
+        Returns list of _id
+        """
+        if objs and all(obj._id < 0 and obj._table == objs[0]._table for obj in objs):
+            ids = self.driver.insertMany(objs[0]._table, [self._storeValues(obj) for obj in objs])
+            for obj, _id in zip(objs, ids):
+                obj._id = _id
+            return ids
+        batch = self.batch()
+        for obj in objs:
+            batch.store(obj)
+        batch.execute()
+        return [obj._id for obj in objs]
+
     def delete(self, query_):
         """
         Delete objects in the table.
@@ -223,6 +300,62 @@ class BasiumOrm:
             query_._id = -1
         return rowcount
 
+    def changes(self, obj, since=None):
+        """
+        Fetch what changed in a table with _trackChanges
+        since is the seq returned by the previous call, None the first time
+        Returns (list of objects, deleted, seq)
+            deleted  list of _id removed since last time, or None if the
+                     objects is the complete table and any local copy
+                     should be replaced
+            seq      pass as since in the next call
+        """
+        rows, deleted, seq = self.driver.changes(obj, since)
+        return list(self._iterObjects(Query(obj), rows)), deleted, seq
+
+    def batch(self):
+        """
+        Create and return a Batch, that collects operations and
+        executes them in one transaction
+        """
+        return Batch(self)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager, the operations added to the batch are executed
+        in one transaction when the block exits without an exception
+
+            with db.transaction() as t:
+                t.store(obj1)
+                t.delete(obj2)
+        """
+        batch = self.batch()
+        yield batch
+        batch.execute()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) in a worker thread, returns a
+        concurrent.futures.Future. Independent operations can then run
+        at the same time, each worker uses its own connection
+
+            f1 = db.submit(db.load, query1)
+            f2 = db.submit(db.load, query2)
+            rows1, rows2 = f1.result(), f2.result()
+
+        Drivers that are not thread safe share one connection between
+        threads, the operations must run in the calling thread
+        """
+        if not self.driver.threadSafe:
+            raise bc.Error(1, "submit() needs a thread safe driver, %s shares one connection" % self.drivername)
+        with self.executorLock:
+            if self.executor is None:
+                workers = self.dbconf.workers or self.dbconf.maxConnections
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="basium")
+        return self.executor.submit(fn, *args, **kwargs)
+
     def query(self, obj=None):
         """
         Create and return a query object. This is a convenience method,
@@ -233,6 +366,93 @@ class BasiumOrm:
         return q
 
 
+class Batch:
+    """
+    A list of operations that are executed in one transaction
+    With the json driver, all operations are sent in one request
+
+    The methods corresponds to the methods in BasiumOrm. The results
+    are available after execute(), stored objects gets their _id
+    and execute() returns one result per operation
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.ops = []       # (op, table, arg), sent to driver
+        self.handlers = []  # converts driver result for each op
+
+    def store(self, obj):
+        columns = self.db._storeValues(obj)
+        if obj._id >= 0:
+            self.ops.append(("update", obj._table, columns))
+            self.handlers.append(lambda result: obj._id)
+        else:
+            self.ops.append(("insert", obj._table, columns))
+
+            def setId(result):
+                obj._id = result
+                return obj._id
+            self.handlers.append(setId)
+
+    def delete(self, query_):
+        if isinstance(query_, basium_model.Model):
+            query = Query().filter(query_.q._id, EQ, query_._id)
+
+            def clearId(result):
+                query_._id = -1
+                return result
+            self.handlers.append(clearId)
+        elif isinstance(query_, Query):
+            query = query_
+            self.handlers.append(lambda result: result)
+        else:
+            raise bc.Error(1, "Fatal: incorrect object type passed")
+        self.ops.append(("delete", query.table(), query))
+
+    def load(self, query_):
+        if isinstance(query_, basium_model.Model):
+            query = Query().filter(query_.q._id, EQ, query_._id)
+
+            def toObjects(rows):
+                data = list(self.db._iterObjects(query, rows))
+                if len(data) < 1:
+                    raise bc.Error(1, "Unknown ID %s in table %s" % (query_._id, query_._table))
+                return data
+        elif isinstance(query_, Query):
+            query = query_
+
+            def toObjects(rows):
+                return list(self.db._iterObjects(query, rows))
+        else:
+            raise bc.Error(1, "Fatal: incorrect object type")
+        self.ops.append(("select", query.table(), query))
+        self.handlers.append(toObjects)
+
+    def count(self, query_):
+        if isinstance(query_, basium_model.Model):
+            query = Query(query_)
+        elif isinstance(query_, Query):
+            query = query_
+        else:
+            raise bc.Error(1, "Fatal: incorrect object type in count")
+        self.ops.append(("count", query.table(), query))
+        self.handlers.append(lambda result: result)
+
+    def execute(self):
+        """
+        Execute all operations, returns list of results
+        """
+        if len(self.ops) == 0:
+            return []
+        results = self.db.driver.executeBatch(self.ops)
+        data = []
+        for handler, result in zip(self.handlers, results):
+            data.append(handler(result))
+        self.ops = []
+        self.handlers = []
+        return data
+
+
 class Query():
     """
     Class that build queries
@@ -265,15 +485,29 @@ class Query():
     def table(self):
         return self._table
 
+    def countQuery(self):
+        """
+        Return a copy of the query without order and limit, used to
+        count all matching rows
+        """
+        query = Query()
+        query._model = self._model
+        query._table = self._table
+        query._where = list(self._where)
+        return query
+
     class _Where:
         def __init__(self, column=None, operand=None, value=None):
             self.column = column
             self.operand = operand
             self.value = value
 
-        def toSql(self):
+        def toSql(self, driver=None):
             sql = '%s %s %%s' % (self.column.name, self.operand)
-            value = self.column.toSql(self.value)
+            if driver is not None:
+                value = driver.toSql(self.column, self.value)
+            else:
+                value = self.column.toSql(self.value)
             return (sql, value)
 
         def encode(self):
@@ -387,9 +621,10 @@ class Query():
         self._limit = self._Limit(offset, rowcount)
         return self
 
-    def toSql(self):
+    def toSql(self, driver=None):
         """
-        Return the query as SQL
+        Return the query as SQL, values are converted with driver.toSql()
+        if a driver is given
         Handles
         - WHERE
         - GROUP BY (todo)
@@ -407,7 +642,7 @@ class Query():
                         sql += ' and '
                     else:
                         addComma = True
-                    sql2, value2 = where.toSql()
+                    sql2, value2 = where.toSql(driver)
                     sql += sql2
                     value.append(value2)
                 sql += ')'
@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012-2013, Anders Lowinger, Abundo AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compact binary wire format for rows, used by the json driver and api.py
+as an alternative to JSON
+
+A message is a header followed by blocks of rows
+
+  header   "BSR1", uint16 number of columns, then per column
+           uint8 type, uint16 length of name, name in utf-8
+  block    uint32 number of rows, then per column
+           null bitmap, one bit per row, and the non null values
+  end      a block with 0 rows
+  error    uint32 ERROR, int32 errno, string errmsg
+
+Values are packed little endian with struct, per column so each column
+is packed and unpacked with one struct call
+  BOOL      uint8
+  INT       int64
+  FLOAT     double
+  DATE      int32, proleptic Gregorian ordinal
+  DATETIME  int64, microseconds since 0001-01-01
+  DECIMAL   as STRING
+  STRING    uint32 length per value, then all values in utf-8
+"""
+
+import struct
+import decimal
+import datetime
+
+import basium_common as bc
+import basium_model
+
+CONTENT_TYPE = "application/x-basium-rows"
+MAGIC = b"BSR1"
+ERROR = 0xffffffff
+
+BOOL, INT, FLOAT, DATE, DATETIME, DECIMAL, STRING = range(1, 8)
+
+# model column -> type
+columnTypeMap = [
+    (basium_model.BooleanCol, BOOL),
+    (basium_model.IntegerCol, INT),
+    (basium_model.FloatCol, FLOAT),
+    (basium_model.DateTimeCol, DATETIME),
+    (basium_model.DateCol, DATE),
+    (basium_model.DecimalCol, DECIMAL),
+    (basium_model.VarcharCol, STRING),
+]
+
+# python value -> type, bool before int and datetime before date
+valueTypeMap = [
+    (bool, BOOL),
+    (int, INT),
+    (float, FLOAT),
+    (datetime.datetime, DATETIME),
+    (datetime.date, DATE),
+    (decimal.Decimal, DECIMAL),
+]
+
+EPOCH = datetime.datetime(1, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def columnTypes(obj):
+    """Returns list of (name, type) for the columns in a model"""
+    columns = []
+    for colname, column in obj._iterNameColumn():
+        for cls, typ in columnTypeMap:
+            if isinstance(column, cls):
+                break
+        else:
+            typ = STRING
+        columns.append((colname, typ))
+    return columns
+
+
+def valueType(value):
+    for cls, typ in valueTypeMap:
+        if isinstance(value, cls):
+            return typ
+    return STRING
+
+
+def bitmapSize(rows):
+    return (rows + 7) // 8
+
+
+def packStrings(values):
+    data = [value.encode("utf-8") for value in values]
+    return struct.pack("<%dI" % len(data), *[len(d) for d in data]) + b"".join(data)
+
+
+def toOrdinal(value):
+    if isinstance(value, str):
+        value = datetime.date.fromisoformat(value[:10])
+    return value.toordinal()
+
+
+def toMicroseconds(value):
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return (value.replace(tzinfo=None) - EPOCH) // MICROSECOND
+
+
+def packValues(typ, values):
+    """Pack non null values, raises an exception if a value has the wrong type"""
+    count = len(values)
+    if typ == BOOL:
+        return bytes(values)
+    if typ == INT:
+        return struct.pack("<%dq" % count, *values)
+    if typ == FLOAT:
+        return struct.pack("<%dd" % count, *values)
+    if typ == DATE:
+        return struct.pack("<%di" % count, *[toOrdinal(value) for value in values])
+    if typ == DATETIME:
+        return struct.pack("<%dq" % count, *[toMicroseconds(value) for value in values])
+    return packStrings([str(value) for value in values])
+
+
+def convertValue(convert, value):
+    try:
+        return convert(value)
+    except (ValueError, ArithmeticError):
+        return None
+
+
+def packColumn(typ, values, convert=None):
+    """
+    Pack one column, returns the null bitmap and values
+    convert is an optional function, that converts a value from the
+    database to the python type. It is used for decimals, which may be
+    stored in a database specific way, and for values that cannot be packed
+    as they are
+    """
+    if convert is not None and typ == DECIMAL:
+        values = [convertValue(convert, value) for value in values]
+        convert = None
+    rows = len(values)
+    nulls = 0
+    for ix, value in enumerate(values):
+        if value is None:
+            nulls |= 1 << ix
+    try:
+        if nulls:
+            data = packValues(typ, [value for value in values if value is not None])
+        else:
+            data = packValues(typ, values)
+    except (struct.error, TypeError, AttributeError, ValueError):
+        if convert is None:
+            raise
+        return packColumn(typ, [convertValue(convert, value) for value in values])
+    return nulls.to_bytes(bitmapSize(rows), "little") + data
+
+
+class Encoder:
+    """
+    Encodes rows, each row is a sequence of values in column order
+    converters is an optional list with one function per column, see packColumn()
+    """
+    def __init__(self, columns, converters=None):
+        self.columns = columns
+        self.converters = converters or [None] * len(columns)
+
+    def header(self):
+        out = [MAGIC, struct.pack("<H", len(self.columns))]
+        for name, typ in self.columns:
+            name = name.encode("utf-8")
+            out.append(struct.pack("<BH", typ, len(name)))
+            out.append(name)
+        return b"".join(out)
+
+    def block(self, rows):
+        out = [struct.pack("<I", len(rows))]
+        for ix, (name, typ) in enumerate(self.columns):
+            out.append(packColumn(typ, [row[ix] for row in rows], self.converters[ix]))
+        return b"".join(out)
+
+    def end(self):
+        return struct.pack("<I", 0)
+
+    def error(self, errno, errmsg):
+        return struct.pack("<Ii", ERROR, errno) + packStrings([errmsg])
+
+
+def toDecimal(value):
+    try:
+        return decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        return None
+
+
+class Decoder:
+    """
+    Decodes a message, read(n) is called to get the next n bytes
+    """
+    def __init__(self, read):
+        self._read = read
+        self.columns = None
+
+    def read(self, size):
+        data = self._read(size)
+        if len(data) != size:
+            raise ValueError("Truncated message, expected %d bytes got %d" % (size, len(data)))
+        return data
+
+    def readHeader(self):
+        if self.read(4) != MAGIC:
+            raise ValueError("Not a %s message" % CONTENT_TYPE)
+        count, = struct.unpack("<H", self.read(2))
+        self.columns = []
+        for i in range(count):
+            typ, length = struct.unpack("<BH", self.read(3))
+            self.columns.append((self.read(length).decode("utf-8"), typ))
+        return self.columns
+
+    def readStrings(self, count):
+        lengths = struct.unpack("<%dI" % count, self.read(4 * count))
+        data = self.read(sum(lengths))
+        values = []
+        pos = 0
+        for length in lengths:
+            values.append(data[pos:pos + length].decode("utf-8"))
+            pos += length
+        return values
+
+    def readColumn(self, typ, rows):
+        nulls = int.from_bytes(self.read(bitmapSize(rows)), "little")
+        count = rows - bin(nulls).count("1")
+        if typ == BOOL:
+            values = [value != 0 for value in self.read(count)]
+        elif typ == INT:
+            values = struct.unpack("<%dq" % count, self.read(8 * count))
+        elif typ == FLOAT:
+            values = struct.unpack("<%dd" % count, self.read(8 * count))
+        elif typ == DATE:
+            values = [datetime.date.fromordinal(value)
+                      for value in struct.unpack("<%di" % count, self.read(4 * count))]
+        elif typ == DATETIME:
+            values = [EPOCH + datetime.timedelta(microseconds=value)
+                      for value in struct.unpack("<%dq" % count, self.read(8 * count))]
+        elif typ == DECIMAL:
+            values = [toDecimal(value) for value in self.readStrings(count)]
+        else:
+            values = self.readStrings(count)
+        if nulls:
+            it = iter(values)
+            values = [None if nulls >> ix & 1 else next(it) for ix in range(rows)]
+        return values
+
+    def blocks(self):
+        """
+        Generator, returns one list of rows per block. Each row is a dict
+        column name -> value
+        """
+        if self.columns is None:
+            self.readHeader()
+        names = [name for name, typ in self.columns]
+        while True:
+            rows, = struct.unpack("<I", self.read(4))
+            if rows == 0:
+                return
+            if rows == ERROR:
+                errno, = struct.unpack("<i", self.read(4))
+                raise bc.Error(errno, self.readStrings(1)[0])
+            columns = [self.readColumn(typ, rows) for name, typ in self.columns]
+            yield [dict(zip(names, values)) for values in zip(*columns)]
+
+    def rows(self):
+        """Generator, returns all rows"""
+        for block in self.blocks():
+            yield from block
+
+
+def encodeValues(values):
+    """
+    Encode a dictionary column name -> value as a message with one row
+    The column types are taken from the values
+    """
+    columns = [(name, valueType(value)) for name, value in values.items()]
+    encoder = Encoder(columns)
+    return encoder.header() + encoder.block([list(values.values())]) + encoder.end()
+
+
+def decodeValues(data):
+    """Decode a message with one row, returns dictionary column name -> value"""
+    pos = 0
+
+    def read(size):
+        nonlocal pos
+        pos += size
+        return data[pos - size:pos]
+    for row in Decoder(read).rows():
+        return row
+    raise ValueError("Message has no rows")
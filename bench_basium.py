@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012-2013, Anders Lowinger, Abundo AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Benchmarks for basium
+
+Usage:
+    ./bench_basium.py <benchmark> [options]
+
+Run with --help to list the available benchmarks
+"""
+
+import os
+import time
+import argparse
+import logging
+import tempfile
+import urllib.request
+import http.client
+import json
+import multiprocessing
+import concurrent.futures
+
+import basium
+import basium_wire
+import basium_driver_json
+import test_tables
+import wsgi.common
+import wsgi.handler
+
+from test_basium import objFactory
+
+log = basium.log
+log.logger.setLevel(logging.ERROR)  # Keep the basium logger quiet
+
+
+class Timer:
+    def __init__(self):
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def report(name, count, elapsed):
+    print("  %-30s %8d ops %8.3f s %10.0f ops/s" % (name, count, elapsed, count / elapsed))
+
+
+def benchSqliteProfile(args):
+    """
+    Compare insert and select throughput for the sqlite tuning profiles
+    """
+    for profile in [None, "server", "bulk-load"]:
+        print("sqlite profile %s" % profile)
+        fd, dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            dbconf = basium.DbConf(database=dbfile, sqliteProfile=profile)
+            db = basium.Basium(driver="sqlite", dbconf=dbconf)
+            db.log.logger.setLevel(logging.ERROR)
+            db.addClass(test_tables.BasiumTest)
+            db.start()
+
+            with Timer() as t:
+                for p in range(args.rows):
+                    db.store(objFactory.new(test_tables.BasiumTest, p))
+            report("insert, commit per row", args.rows, t.elapsed)
+
+            with Timer() as t:
+                for i in range(args.loops):
+                    rows = db.load(db.query(test_tables.BasiumTest()))
+            report("select all", args.loops * len(rows), t.elapsed)
+        finally:
+            for suffix in ["", "-wal", "-shm"]:
+                if os.path.exists(dbfile + suffix):
+                    os.remove(dbfile + suffix)
+
+
+def startServer(port, production=False, asyncServer=False, database=True):
+    """
+    Start the embedded WSGI server in a thread, with a sqlite database
+    Returns the name of the database file
+    """
+    db = dbfile = None
+    if database:
+        fd, dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        dbconf = basium.DbConf(database=dbfile)
+        db = basium.Basium(driver="sqlite", dbconf=dbconf)
+        db.log.logger.setLevel(logging.ERROR)
+        db.addClass(test_tables.BasiumTest)
+        db.start()
+
+    documentroot = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+    server = wsgi.handler.Server(basium=db, documentroot=documentroot, host="127.0.0.1", port=port,
+                                 asyncServer=asyncServer)
+    server.app.production = production
+    server.daemon = True
+    server.start()
+    while not server.ready:
+        time.sleep(0.1)
+    return dbfile
+
+
+def startClient(port, **kwargs):
+    dbconf = basium.DbConf(host="http://127.0.0.1:%d" % port, database="basium_db", **kwargs)
+    db = basium.Basium(driver="json", dbconf=dbconf, checkTables=False)
+    db.log.logger.setLevel(logging.ERROR)
+    db.addClass(test_tables.BasiumTest)
+    db.start()
+    return db
+
+
+def benchJsonPool(args):
+    """
+    Compare the pooled JSON driver with one urlopen() per request,
+    against the embedded WSGI server
+    """
+    dbfile = startServer(args.port)
+    try:
+        db = startClient(args.port)
+        for p in range(args.rows):
+            db.store(objFactory.new(test_tables.BasiumTest, p))
+        obj = test_tables.BasiumTest(1)
+
+        url = "http://127.0.0.1:%d/api/basiumtest/1" % args.port
+        with Timer() as t:
+            for i in range(args.loops):
+                urllib.request.urlopen(url).read()
+        report("urlopen() per request", args.loops, t.elapsed)
+
+        connects = db.driver.pool.connects
+        with Timer() as t:
+            for i in range(args.loops):
+                db.load(obj)
+        report("pooled driver", args.loops, t.elapsed)
+        print("  %d new connections for %d requests" % (db.driver.pool.connects - connects, args.loops))
+    finally:
+        os.remove(dbfile)
+
+
+def benchWireFormat(args):
+    """
+    Compare the JSON and binary wire formats, selecting all rows with
+    the json driver. Server and client runs in this process, so the CPU
+    time includes both encoding and decoding
+    """
+    dbfile = startServer(args.port)
+    try:
+        db = startClient(args.port)
+        db.storeMany([objFactory.new(test_tables.BasiumTest, p) for p in range(args.rows)])
+
+        for accept in [basium_driver_json.NDJSON, basium_wire.CONTENT_TYPE]:
+            conn = http.client.HTTPConnection("127.0.0.1", args.port)
+            conn.request("GET", "/api/basiumtest", headers={"Accept": accept})
+            print("  %-30s %8d bytes" % (accept, len(conn.getresponse().read())))
+            conn.close()
+
+        for wireFormat in ["json", "binary"]:
+            db = startClient(args.port, wireFormat=wireFormat)
+            obj = test_tables.BasiumTest()
+            query = db.query(obj)
+            columns = list(obj._iterNameColumn())
+            cpu = time.process_time()
+            with Timer() as t:
+                for i in range(args.loops):
+                    # the values as python types, as the ORM does in load()
+                    rows = [[column.toPython(row[colname]) for colname, column in columns]
+                            for row in db.driver.select(query)]
+            report("select rows, %s" % wireFormat, args.loops * len(rows), t.elapsed)
+            print("  %-30s %8.3f s cpu" % ("", time.process_time() - cpu))
+    finally:
+        os.remove(dbfile)
+
+
+def benchBulkInsert(args):
+    """
+    Compare one request per row with the bulk insert, through the json
+    driver and the embedded WSGI server
+    """
+    dbfile = startServer(args.port)
+    try:
+        db = startClient(args.port)
+        with Timer() as t:
+            for p in range(args.rows):
+                db.store(objFactory.new(test_tables.BasiumTest, p))
+        report("store(), request per row", args.rows, t.elapsed)
+
+        objs = [objFactory.new(test_tables.BasiumTest, p) for p in range(args.rows)]
+        with Timer() as t:
+            db.storeMany(objs)
+        report("storeMany(), bulk insert", args.rows, t.elapsed)
+    finally:
+        os.remove(dbfile)
+
+
+def benchJsonSerialize(args):
+    """
+    Compare the ways to serialize rows as JSON in api.py, for rows with
+    python typed values, as the psql driver returns them
+        JsonOrmEncoder  json.dumps() with the default() hook
+        codec.encode    values converted per column, then json.dumps()
+        serializer      the compiled serializer, streamed in chunks
+    """
+    fd, dbfile = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        db = basium.Basium(driver="sqlite", dbconf=basium.DbConf(database=dbfile))
+        db.log.logger.setLevel(logging.ERROR)
+        db.addClass(test_tables.BasiumTest)
+        db.start()
+        codec = db.codecs[test_tables.BasiumTest._table]
+        rows = []
+        for p in range(args.rows):
+            row = dict(objFactory.new(test_tables.BasiumTest, p)._values)
+            row["_id"] = p
+            rows.append(row)
+
+        with Timer() as t:
+            data = [{colname: row[colname] for colname in codec.colnames} for row in rows]
+            text1 = json.dumps({"errno": 0, "errmsg": "", "data": data}, cls=db.JsonOrmEncoder)
+        report("JsonOrmEncoder", args.rows, t.elapsed)
+
+        with Timer() as t:
+            text2 = json.dumps({"errno": 0, "errmsg": "", "data": [codec.encode(row) for row in rows]})
+        report("codec.encode + json.dumps", args.rows, t.elapsed)
+
+        with Timer() as t:
+            chunks = ['{"errno": 0, "errmsg": "", "data": [']
+            chunks.extend(codec.serialize(rows))
+            chunks.append("]}")
+            text3 = "".join(chunks)
+        report("compiled serializer", args.rows, t.elapsed)
+        if not json.loads(text1) == json.loads(text2) == json.loads(text3):
+            print("  Error, the outputs differ")
+    finally:
+        os.remove(dbfile)
+
+
+def benchWsgiProduction(args):
+    """
+    Compare requests to the embedded WSGI server in development mode,
+    the controller is imported on each request, and production mode
+    where the imported controller is cached
+    """
+    for production in [False, True]:
+        port = args.port + production
+        dbfile = startServer(port, production=production)
+        try:
+            db = startClient(port)
+            obj = objFactory.new(test_tables.BasiumTest, 1)
+            db.store(obj)
+            with Timer() as t:
+                for i in range(args.loops):
+                    db.load(obj)
+            report("production" if production else "development", args.loops, t.elapsed)
+        finally:
+            os.remove(dbfile)
+
+
+def benchRoutes(args):
+    """
+    Route lookup in a page with a few hundred routes, with new paths
+    each time and with paths found in the lookup cache
+    """
+    page = wsgi.common.Page()
+    for i in range(args.routes):
+        func = lambda request, response, **kwargs: None
+        page.add(path="/r%d/<id:int>" % i, methods=["GET", "PUT"], func=func)
+        page.add(path="/r%d/<name>/<count:int:o>" % i, methods=["GET"], func=func)
+    request = wsgi.common.Request()
+    request.method = "GET"
+    last = args.routes - 1
+    paths = ["/r%d/item/%d" % (last, i) for i in range(args.loops)]
+
+    with Timer() as t:
+        for path in paths:
+            page.getFunction(path, request)
+    report("new paths", args.loops, t.elapsed)
+
+    with Timer() as t:
+        for i in range(args.loops):
+            page.getFunction(paths[i % 100], request)
+    report("cached paths", args.loops, t.elapsed)
+
+
+def benchUrlRouter(args):
+    """
+    Find the controller file for URLs in the example application, in
+    development mode where each directory is checked for changes, and
+    in production mode
+    """
+    documentroot = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+    app = wsgi.common.App(documentroot=documentroot)
+    urls = ["/", "/ex01/info", "/api/basiumtest/12", "/test/bbb/x", "/nofile"]
+    for production in [False, True]:
+        app.production = production
+        router = wsgi.handler.URLRouter(app.controller_dir, app=app)
+        with Timer() as t:
+            for i in range(args.loops):
+                router.route(urls[i % len(urls)])
+        report("production" if production else "development", args.loops, t.elapsed)
+
+
+def loadClients(port, path, clients, loops):
+    """
+    GET path loops times from each client thread, each client uses one
+    connection if the server keeps it open. Returns the elapsed time
+    """
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        for i in range(loops):
+            conn.request("GET", path)
+            conn.getresponse().read()
+        conn.close()
+
+    with Timer() as t:
+        with concurrent.futures.ThreadPoolExecutor(clients) as executor:
+            for future in [executor.submit(client) for i in range(clients)]:
+                future.result()
+    return t.elapsed
+
+
+def loadServer(args, asyncServer, name, path):
+    port = args.port + asyncServer
+    database = path.startswith("/api/")
+    dbfile = startServer(port, production=True, asyncServer=asyncServer, database=database)
+    try:
+        if database:
+            db = startClient(port)
+            db.store(objFactory.new(test_tables.BasiumTest, 1))
+        elapsed = loadClients(port, path, args.clients, args.loops)
+        report("%s %s" % ("asyncio" if asyncServer else "wsgiref", name),
+               args.clients * args.loops, elapsed)
+    finally:
+        if dbfile:
+            os.remove(dbfile)
+
+
+def benchWsgiAsync(args):
+    """
+    Load the wsgiref server and the asyncio server with concurrent
+    clients, on the API and on controllers waiting 10 ms on a backend.
+    With the sqlite driver the API requests are handled one at a time,
+    the wait controllers run without a database
+    """
+    loads = [
+        (False, "api", "/api/basiumtest/1"),
+        (False, "wait", "/test/wait/10"),
+        (True, "api", "/api/basiumtest/1"),
+        (True, "wait", "/test/wait/10"),
+        (True, "async wait", "/test/await/10"),
+    ]
+    for asyncServer, name, path in loads:
+        # the controllers register their routes in the one application
+        # of the process, so each server runs in its own process
+        process = multiprocessing.Process(target=loadServer, args=(args, asyncServer, name, path))
+        process.start()
+        process.join()
+
+
+benchmarks = {
+    "bulk-insert": benchBulkInsert,
+    "json-pool": benchJsonPool,
+    "json-serialize": benchJsonSerialize,
+    "routes": benchRoutes,
+    "sqlite-profile": benchSqliteProfile,
+    "url-router": benchUrlRouter,
+    "wire-format": benchWireFormat,
+    "wsgi-async": benchWsgiAsync,
+    "wsgi-production": benchWsgiProduction,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(benchmarks.keys()))
+    parser.add_argument("--rows",  dest="rows",  default=2000, type=int)
+    parser.add_argument("--loops", dest="loops", default=10, type=int)
+    parser.add_argument("--port",  dest="port",  default=8052, type=int)
+    parser.add_argument("--routes", dest="routes", default=300, type=int,
+                        help="routes in the page, routes")
+    parser.add_argument("--clients", dest="clients", default=16, type=int,
+                        help="concurrent clients, wsgi-async")
+    args = parser.parse_args()
+
+    benchmarks[args.benchmark](args)
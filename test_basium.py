@@ -65,17 +65,42 @@ Preparation to database before testing:
 
 """
 
+import io
+import os
+import json
 import sys
+import gzip
+import zlib
 import time
+import types
+import signal
+import socket
+import shutil
+import tempfile
+import importlib
 import decimal
 import datetime
 import unittest
 import logging
+import threading
+import concurrent.futures
+import builtins
+import asyncio
+import urllib.request
+import http.client
+import wsgiref.util
+import multiprocessing
 
 import basium_common as bc
 import basium
 import basium_model
+import basium_driver
+import basium_driver_json
+import basium_wire
+import wsgi.common
 import wsgi.handler
+import wsgi.view
+import wsgi.asyncserver
 
 import test_tables
 
@@ -293,6 +318,214 @@ class TestFunctions(unittest.TestCase):
             self.assertTrue(True, msg="Expected error when loading deleted object %s" % e)
 
 
+    def testBatch(self):
+        """
+        Test batch and transaction, several operations in one transaction
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(200, 205)]
+        try:
+            ids = self.db.storeMany(objs)
+        except bc.Error as e:
+            self.assertFalse(True, msg="Can't store objects in batch %s" % e)
+        self.assertEqual(ids, [obj._id for obj in objs])
+        self.assertTrue(all(_id >= 0 for _id in ids))
+
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q._id, '>=', ids[0]).filter(obj.q._id, '<=', ids[-1])
+        with self.db.transaction() as t:
+            t.delete(objs[0])
+            t.load(query)
+            t.count(query)
+        self.assertEqual(objs[0]._id, -1)
+
+        batch = self.db.batch()
+        batch.load(query)
+        batch.count(query)
+        rows, count = batch.execute()
+        self.assertEqual(count, 4)
+        self.assertEqual(rows, objs[1:])
+
+        # a failing operation rolls back the whole batch
+        batch = self.db.batch()
+        batch.delete(objs[1])
+        batch.delete(self.db.query(self.Cls()))   # empty query is refused
+        self.assertRaises(bc.Error, batch.execute)
+        self.assertEqual(self.db.count(query), 4)
+
+    def testInsertMany(self):
+        """
+        Test inserting many new objects, more than one executemany() chunk
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(1000, 3500)]
+        ids = self.db.storeMany(objs)
+        self.assertEqual(len(set(ids)), len(objs))
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q._id, '>=', min(ids)).filter(obj.q._id, '<=', max(ids))
+        self.assertEqual(self.db.count(query), len(objs))
+        for ix in [0, 1000, 2499]:
+            obj._id = ids[ix]
+            self.assertEqual(self.db.load(obj), [objs[ix]])
+
+    def testLoadWithCount(self):
+        """
+        Test loading a page of objects together with the total count
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(400, 405)]
+        self.db.storeMany(objs)
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q._id, '>=', objs[0]._id).order(obj.q._id)
+        query.limit(1, 2)
+        data, total = self.db.loadWithCount(query)
+        self.assertEqual(data, objs[1:3])
+        self.assertEqual(total, 5)
+
+        query.limit(10, 2)
+        data, total = self.db.loadWithCount(query)
+        self.assertEqual(data, [])
+        self.assertEqual(total, 5)
+
+        # a Model instance loads the object with its _id, as load()
+        self.assertEqual(self.db.loadWithCount(self.Cls(objs[2]._id)), ([objs[2]], 1))
+        obj._id = objs[-1]._id + 1000
+        self.assertRaises(bc.Error, self.db.loadWithCount, obj)
+
+    def testLoadPages(self):
+        """
+        Test loading more rows than the server page size, the json
+        driver follows the continuation tokens to get all pages
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(4000, 6500)]
+        self.db.storeMany(objs)
+        obj = self.Cls()
+        query = self.db.query().filter(obj.q._id, '>=', objs[0]._id).order(obj.q._id)
+        data, total = self.db.loadWithCount(query)
+        self.assertEqual(data, objs)
+        self.assertEqual(total, len(objs))
+
+        query.limit(10, 1500)
+        data, total = self.db.loadWithCount(query)
+        self.assertEqual(data, objs[10:1510])
+        self.assertEqual(total, len(objs))
+
+    def testSubmit(self):
+        """
+        Test running operations in worker threads
+        """
+        objs = [objFactory.new(self.Cls, p) for p in range(500, 505)]
+        self.db.storeMany(objs)
+        futures = [self.db.submit(self.db.load, obj) for obj in objs]
+        query = self.db.query().filter(objs[0].q._id, '>=', objs[0]._id)
+        count = self.db.submit(self.db.count, query)
+        self.assertEqual([future.result()[0] for future in futures], objs)
+        self.assertEqual(count.result(), 5)
+
+        obj = self.Cls()
+        obj._id = objs[-1]._id + 1000
+        self.assertRaises(bc.Error, self.db.submit(self.db.load, obj).result)
+
+    def testTableVersion(self):
+        """
+        Test that writes change the table version
+        """
+        obj = objFactory.new(self.Cls, 1)
+        table = obj._table
+        version, mtime = self.db.tableVersion(table)
+        self.db.store(obj)
+        self.assertGreater(self.db.tableVersion(table)[0], version)
+        version, mtime = self.db.tableVersion(table)
+        self.db.delete(obj)
+        self.assertGreater(self.db.tableVersion(table)[0], version)
+
+        if self.driver == 'json':
+            # cached response is revalidated, and refetched after a change
+            self.dbconf.cacheSize = 10
+            objs = [objFactory.new(self.Cls, p) for p in range(300, 303)]
+            self.db.storeMany(objs)
+            query = self.db.query().filter(obj.q._id, '>=', objs[0]._id)
+            self.assertEqual(self.db.load(query), objs)
+            self.assertEqual(len(self.db.driver.cache), 1)
+            self.assertEqual(self.db.load(query), objs)
+            self.db.delete(objs[0])
+            self.assertEqual(self.db.load(query), objs[1:])
+
+    def testChanges(self):
+        """
+        Test fetching only what changed in a table with _trackChanges
+        """
+        db = basium.Basium(driver=self.driver, dbconf=self.dbconf, checkTables=True)
+        db.log.logger.setLevel(logging.ERROR)
+        db.addClass(test_tables.BasiumTestChanges)
+        if not db.start():
+            self.fail("Cannot start database driver")
+        objs = [objFactory.new(test_tables.BasiumTestChanges, p) for p in range(400, 403)]
+        for obj in objs:
+            db.store(obj)
+
+        # first time, all rows
+        rows, deleted, seq = db.changes(objs[0])
+        self.assertIsNone(deleted)
+        self.assertTrue(set(obj._id for obj in objs) <= set(row._id for row in rows))
+        self.assertEqual(db.changes(objs[0], seq), ([], [], seq))
+
+        objs[0].intTest = 4711
+        db.store(objs[0])
+        deletedId = objs[1]._id
+        db.delete(objs[1])
+        obj = objFactory.new(test_tables.BasiumTestChanges, 403)
+        db.store(obj)
+        rows, deleted, seq2 = db.changes(obj, seq)
+        self.assertEqual(sorted(row._id for row in rows), [objs[0]._id, obj._id])
+        self.assertEqual(deleted, [deletedId])
+        self.assertEqual(seq2, seq + 3)     # update, delete, insert
+
+        # unknown sequence number, all rows
+        self.assertIsNone(db.changes(obj, seq2 + 1000)[1])
+
+
+class TestTiered(unittest.TestCase):
+    """
+    Test the tiered driver, json driver with a local sqlite copy
+    Needs the server, as the json driver
+    """
+
+    def setUp(self):
+        test_tables.BasiumTest._cacheMaxAge = 60
+        self.dbconf = basium.DbConf(host='http://localhost:8051', username='basium_user',
+                                    password='secret', database='basium_db')
+        self.db = basium.Basium(driver="tiered", dbconf=self.dbconf)
+        self.db.log.logger.setLevel(logging.ERROR)
+        self.db.addClass(test_tables.BasiumTest)
+        if not self.db.start():
+            self.fail("Cannot start database driver")
+
+    def tearDown(self):
+        test_tables.BasiumTest._cacheMaxAge = None
+
+    def testReadLocal(self):
+        objs = [objFactory.new(test_tables.BasiumTest, p) for p in range(600, 603)]
+        self.db.storeMany(objs)
+        self.assertEqual(self.db.load(objs[0])[0], objs[0])
+
+        # a change on the server is not seen until the local copy is refreshed
+        remote = self.db.driver.remote
+        values = objs[1]._getValues()
+        values["intTest"] = "12345"
+        remote.update(objs[1]._table, values)
+        self.assertEqual(self.db.load(objs[1])[0].intTest, objs[1].intTest)
+        self.db.driver.cached[objs[1]._table].refreshed = None
+        self.assertEqual(self.db.load(objs[1])[0].intTest, 12345)
+
+        # writes go to the server and the local copy
+        objs[2].varcharTest = "changed"
+        self.db.store(objs[2])
+        query = self.db.query().filter(objs[2].q.varcharTest, '=', "changed")
+        self.assertEqual(self.db.load(query), [objs[2]])
+        self.assertEqual(len(list(remote.select(query))), 1)
+        self.db.delete(objs[2])
+        self.assertEqual(self.db.count(query), 0)
+        self.assertEqual(remote.count(query), 0)
+
+
 class TestModel(unittest.TestCase):
     """
     Test the ORM model class
@@ -340,6 +573,1157 @@ class TestModel(unittest.TestCase):
         self.assertEqual(t.varcharTest, "default string")
 
 
+class TestSqliteScaledDecimal(unittest.TestCase):
+    """
+    Test DecimalCol stored as scaled INTEGER in sqlite
+    """
+
+    def setUp(self):
+        fd, self.dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.dbfile)
+
+    def start(self, scaledDecimal):
+        dbconf = basium.DbConf(database=self.dbfile, scaledDecimal=scaledDecimal)
+        db = basium.Basium(driver="sqlite", dbconf=dbconf, checkTables=True)
+        db.log.logger.setLevel(logging.ERROR)
+        db.addClass(test_tables.BasiumTest)
+        if not db.start():
+            self.fail("Cannot start database driver")
+        return db
+
+    def testScaled(self):
+        db = self.start(True)
+        values = ["1.23", "45.60", "-3.01"]
+        for value in values:
+            obj = objFactory.new(test_tables.BasiumTest, 1)
+            obj.decimalTest = decimal.Decimal(value)
+            db.store(obj)
+
+        db.driver.execute("SELECT SUM(decimalTest), typeof(decimalTest) FROM basiumtest")
+        row = db.driver.cursor.fetchone()
+        self.assertEqual(row[0], 4382)
+        self.assertEqual(row[1], "integer")
+
+        obj = test_tables.BasiumTest()
+        query = db.query().filter(obj.q.decimalTest, '>', decimal.Decimal("0")).order(obj.q.decimalTest)
+        data = db.load(query)
+        self.assertEqual([o.decimalTest for o in data], [decimal.Decimal("1.23"), decimal.Decimal("45.60")])
+
+    def testMigrate(self):
+        db = self.start(False)
+        obj = objFactory.new(test_tables.BasiumTest, 1)
+        obj.decimalTest = decimal.Decimal("12.34")
+        db.store(obj)
+
+        db = self.start(True)   # converts the varchar column
+        data = db.load(test_tables.BasiumTest(obj._id))
+        self.assertEqual(data[0].decimalTest, decimal.Decimal("12.34"))
+        self.assertEqual(data[0].varcharTest, obj.varcharTest)
+
+        db = self.start(False)  # and back again
+        data = db.load(test_tables.BasiumTest(obj._id))
+        self.assertEqual(data[0].decimalTest, decimal.Decimal("12.34"))
+
+    def testMigrateExact(self):
+        # more digits than a REAL holds
+        db = self.start(False)
+        obj = objFactory.new(test_tables.BasiumTest, 1)
+        db.store(obj)
+        db.driver.execute("UPDATE basiumtest SET decimalTest='12345678901234567.89'")
+
+        db = self.start(True)
+        db.driver.execute("SELECT decimalTest FROM basiumtest")
+        self.assertEqual(db.driver.cursor.fetchone()[0], 1234567890123456789)
+        db = self.start(False)
+        data = db.load(test_tables.BasiumTest(obj._id))
+        self.assertEqual(data[0].decimalTest, decimal.Decimal("12345678901234567.89"))
+
+        # too large for INTEGER, the table is left as it was
+        db.driver.execute("UPDATE basiumtest SET decimalTest='99999999999999999999.99'")
+        dbconf = basium.DbConf(database=self.dbfile, scaledDecimal=True)
+        db = basium.Basium(driver="sqlite", dbconf=dbconf, checkTables=True)
+        db.log.logger.setLevel(logging.CRITICAL)
+        db.addClass(test_tables.BasiumTest)
+        with self.assertRaises(bc.Error) as cm:
+            db.start()
+        self.assertIn("does not fit", cm.exception.errmsg)
+        db = self.start(False)
+        data = db.load(test_tables.BasiumTest(obj._id))
+        self.assertEqual(data[0].decimalTest, decimal.Decimal("99999999999999999999.99"))
+
+    def testJsonClient(self):
+        # server and clients run in fresh processes, the column driver
+        # classes are mixed in per process, see BasiumOrm.startOrm()
+        ctx = multiprocessing.get_context("spawn")
+        queue = ctx.Queue()
+        server = ctx.Process(target=runScaledServer, args=(self.dbfile, queue), daemon=True)
+        server.start()
+        try:
+            url = "http://127.0.0.1:%d" % queue.get(timeout=30)
+            for wireFormat in ["json", "binary"]:
+                client = ctx.Process(target=runScaledClient, args=(url, wireFormat, queue))
+                client.start()
+                result = queue.get(timeout=30)
+                client.join()
+                self.assertEqual(result[:3], [decimal.Decimal("7.07")] * 3, wireFormat)
+                stored = datetime.datetime(2024, 1, 1, 10, 0, 0)   # microseconds are ignored
+                self.assertEqual(result[3:5], [stored] * 2, wireFormat)
+        finally:
+            server.terminate()
+            server.join()
+
+
+class TestSqliteProfile(unittest.TestCase):
+    """
+    Test that the sqlite tuning profile is applied on connect
+    """
+
+    def testServerProfile(self):
+        fd, dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            dbconf = basium.DbConf(database=dbfile, sqliteProfile="server")
+            db = basium.Basium(driver="sqlite", dbconf=dbconf)
+            db.log.logger.setLevel(logging.ERROR)
+            db.addClass(test_tables.BasiumTest)
+            self.assertTrue(db.start())
+            db.driver.execute("PRAGMA journal_mode")
+            self.assertEqual(db.driver.cursor.fetchone()[0], "wal")
+            db.driver.execute("PRAGMA busy_timeout")
+            self.assertEqual(db.driver.cursor.fetchone()[0], 5000)
+        finally:
+            for suffix in ["", "-wal", "-shm"]:
+                if os.path.exists(dbfile + suffix):
+                    os.remove(dbfile + suffix)
+
+    def testUnknownProfile(self):
+        dbconf = basium.DbConf(database=":memory:", sqliteProfile="nosuchprofile")
+        db = basium.Basium(driver="sqlite", dbconf=dbconf)
+        db.log.logger.setLevel(logging.ERROR)
+        db.addClass(test_tables.BasiumTest)
+        self.assertRaises(bc.Error, db.start)
+
+
+class TestSqliteTableVersion(unittest.TestCase):
+    """
+    Test that the table version is shared by connections to the same
+    database, as by two processes
+    """
+
+    def setUp(self):
+        fd, self.dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.dbs = []
+        for i in range(2):
+            db = basium.Basium(driver="sqlite", dbconf=basium.DbConf(database=self.dbfile))
+            db.log.logger.setLevel(logging.ERROR)
+            db.addClass(test_tables.BasiumTest)
+            db.addClass(test_tables.BasiumTestChanges)
+            self.assertTrue(db.start())
+            self.dbs.append(db)
+
+    def tearDown(self):
+        os.remove(self.dbfile)
+
+    def testShared(self):
+        db1, db2 = self.dbs
+        table = test_tables.BasiumTest._table
+        version, mtime = db2.tableVersion(table)
+        self.assertEqual(db1.tableVersion(table), (version, mtime))
+        db1.store(objFactory.new(test_tables.BasiumTest, 1))
+        self.assertEqual(db1.tableVersion(table)[0], version + 1)
+        self.assertEqual(db2.tableVersion(table)[0], version + 1)
+        # unchanged, answered from the cache in the driver
+        self.assertEqual(db2.tableVersion(table)[0], version + 1)
+        db2.storeMany([objFactory.new(test_tables.BasiumTest, p) for p in range(2, 5)])
+        self.assertEqual(db1.tableVersion(table)[0], version + 2)
+
+    def testAtomic(self):
+        """
+        The version is increased in the transaction of the write, if that
+        fails the data is not changed either
+        """
+        db1, db2 = self.dbs
+        table = test_tables.BasiumTest._table
+        version = db1.tableVersion(table)[0]
+        count = db1.count(test_tables.BasiumTest())
+
+        def fail(table):
+            raise bc.Error(1, "bump failed")
+
+        db1.driver.bumpVersion = fail
+        self.assertRaises(bc.Error, db1.store, objFactory.new(test_tables.BasiumTest, 1))
+        self.assertEqual(db2.count(test_tables.BasiumTest()), count)
+        self.assertEqual(db2.tableVersion(table)[0], version)
+
+    def testChangeSeq(self):
+        """
+        The change sequence is allocated in the database, stores from two
+        connections get distinct sequence numbers and changes() sees them all
+        """
+        db1, db2 = self.dbs
+        obj = objFactory.new(test_tables.BasiumTestChanges, 1)
+        db1.store(obj)
+        rows, deleted, seq = db2.changes(obj)
+        for p in range(2, 6):
+            self.dbs[p % 2].store(objFactory.new(test_tables.BasiumTestChanges, p))
+        db2.storeMany([objFactory.new(test_tables.BasiumTestChanges, p) for p in range(6, 8)])
+        rows, deleted, seq2 = db1.changes(obj, seq)
+        self.assertEqual(deleted, [])
+        self.assertEqual(seq2, seq + 6)
+        self.assertEqual(sorted(row._seq for row in rows), list(range(seq + 1, seq2 + 1)))
+
+
+class FakeCursor:
+    """
+    DB-API cursor, returns rows from a list and records how they are fetched
+    """
+    def __init__(self, rows, name=None, withhold=False):
+        self.rows = rows
+        self.name = name
+        self.withhold = withhold
+        self.itersize = None
+        self.fetches = []
+        self.closed = False
+        self.dropped = False    # named cursor without hold, after commit
+        self.sql = None
+        self.pos = 0
+        self.lastrowid = 1
+        self.many = []          # rows in each executemany()
+
+    def execute(self, sql, values=None):
+        self.sql = sql
+
+    def executemany(self, sql, values):
+        self.sql = sql
+        self.many.append(len(values))
+        self.lastrowid += 10
+
+    def fetchone(self):
+        return [self.lastrowid]
+
+    def fetchmany(self, size):
+        if self.dropped:
+            raise Exception("cursor %s does not exist" % self.name)
+        self.fetches.append(size)
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.cursors = []
+        self.commits = 0
+
+    def cursor(self, name=None, withhold=False, **kwargs):
+        cursor = FakeCursor(self.rows, name=name, withhold=withhold)
+        self.cursors.append(cursor)
+        return cursor
+
+    def commit(self):
+        self.commits += 1
+        for cursor in self.cursors:
+            if cursor.name and not cursor.withhold:
+                cursor.dropped = True
+
+
+class TestStreamingCursor(unittest.TestCase):
+    """
+    Test select() with dbconf.itersize on psql and mysql, using fake
+    DB-API modules instead of the real database connectors
+    """
+
+    def setUp(self):
+        self.rows = [{"_id": i, "intTest": i} for i in range(10)]
+        self.connection = FakeConnection(self.rows)
+        self.savedModules = sys.modules.copy()
+
+    def tearDown(self):
+        sys.modules.clear()
+        sys.modules.update(self.savedModules)
+
+    def addModule(self, name, **attrs):
+        module = types.ModuleType(name)
+        for key, val in attrs.items():
+            setattr(module, key, val)
+        sys.modules[name] = module
+        return module
+
+    def runSelect(self, drivermodule):
+        dbconf = basium.DbConf(host="localhost", database="basium_db", itersize=3)
+        driver = drivermodule.BasiumDriver(log=log, dbconf=dbconf)
+        driver.debug = 0
+        query = basium.basium_orm.Query(test_tables.BasiumTest())
+        rows = driver.select(query)
+        cursor = self.connection.cursors[-1]
+
+        self.assertEqual(next(rows)["_id"], 0)
+        self.assertEqual(cursor.fetches, [3])   # only first chunk fetched
+        self.assertEqual([row["_id"] for row in rows], list(range(1, 10)))
+        self.assertTrue(cursor.closed)
+        return cursor
+
+    def psqlModule(self):
+        psycopg2 = self.addModule("psycopg2", DatabaseError=Exception,
+                                  connect=lambda **kwargs: self.connection)
+        psycopg2.extensions = self.addModule("psycopg2.extensions", UNICODE=None, UNICODEARRAY=None,
+                                             register_type=lambda typ: None)
+        psycopg2.extras = self.addModule("psycopg2.extras", DictCursor=dict)
+        sys.modules.pop("basium_driver_psql", None)
+        return importlib.import_module("basium_driver_psql")
+
+    def mysqlModule(self):
+        mysql = self.addModule("mysql")
+        mysql.connector = self.addModule("mysql.connector", Error=Exception,
+                                         connect=lambda **kwargs: self.connection)
+        mysql.connector.cursor = self.addModule("mysql.connector.cursor", MySQLCursor=FakeCursor)
+        sys.modules.pop("basium_driver_mysql", None)
+        return importlib.import_module("basium_driver_mysql")
+
+    def storeWhileStreaming(self, drivermodule):
+        """Start reading a stream, then insert a row on the same thread"""
+        dbconf = basium.DbConf(host="localhost", database="basium_db", itersize=3)
+        driver = drivermodule.BasiumDriver(log=log, dbconf=dbconf)
+        driver.debug = 0
+        rows = driver.select(basium.basium_orm.Query(test_tables.BasiumTest()))
+        self.assertEqual(next(rows)["_id"], 0)
+        return driver, rows
+
+    def testPsql(self):
+        cursor = self.runSelect(self.psqlModule())
+        self.assertIsNotNone(cursor.name)     # named, server side cursor
+
+    def testPsqlStore(self):
+        driver, rows = self.storeWhileStreaming(self.psqlModule())
+        self.assertEqual(self.connection.commits, 1)    # not idle in transaction
+        driver.insert("basiumtest", {"intTest": 1})
+        self.assertEqual([row["_id"] for row in rows], list(range(1, 10)))
+        # closing the cursor is committed too
+        self.assertEqual(self.connection.commits, 3)
+
+    def testMysql(self):
+        self.runSelect(self.mysqlModule())
+
+    def testMysqlStore(self):
+        driver, rows = self.storeWhileStreaming(self.mysqlModule())
+        self.assertRaises(bc.Error, driver.insert, "basiumtest", {"intTest": 1})
+        rows.close()
+        self.assertEqual(driver.insert("basiumtest", {"intTest": 1}), 1)
+
+    def testMysqlInsertMany(self):
+        # one executemany() per chunk, lastrowid is the first _id of the chunk
+        dbconf = basium.DbConf(host="localhost", database="basium_db")
+        driver = self.mysqlModule().BasiumDriver(log=log, dbconf=dbconf)
+        driver.debug = 0
+        rows = [{"_id": -1, "intTest": i} for i in range(basium_driver.BULK_CHUNK + 2)]
+        ids = driver.insertMany("basiumtest", rows)
+        self.assertEqual(driver.cursor.many, [basium_driver.BULK_CHUNK, 2])
+        self.assertEqual(ids, list(range(11, 11 + basium_driver.BULK_CHUNK)) + [21, 22])
+
+
+class FakeHTTPResponse(io.BytesIO):
+    def __init__(self, data, headers):
+        super().__init__(data)
+        self.headers = headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class TestCompression(unittest.TestCase):
+    """
+    Test gzip/deflate compression of responses, and decompression in the
+    json driver
+    """
+
+    def testAcceptEncoding(self):
+        acceptEncoding = wsgi.common.acceptEncoding
+        self.assertEqual(acceptEncoding("gzip, deflate"), "gzip")
+        self.assertEqual(acceptEncoding("deflate"), "deflate")
+        self.assertEqual(acceptEncoding("gzip;q=0.5, deflate"), "deflate")
+        self.assertEqual(acceptEncoding("gzip;q=0, *"), "deflate")
+        self.assertIsNone(acceptEncoding("identity"))
+        self.assertIsNone(acceptEncoding(None))
+
+    def testCompress(self):
+        response = wsgi.common.Response()
+        response.content_type = "application/json"
+        response.write("x" * 2000)
+        self.assertTrue(response.compressible(1024))
+        response.compress("gzip")
+        data = b"".join(response.iter())
+        self.assertEqual(len(data), response.content_length)
+        self.assertEqual(gzip.decompress(data), b"x" * 2000)
+        self.assertIn(("Content-Encoding", "gzip"), response.headers)
+
+        response = wsgi.common.Response()
+        response.content_type = "image/png"
+        response.write("x" * 2000)
+        self.assertFalse(response.compressible(1024))
+
+    def testCompressStream(self):
+        response = wsgi.common.Response()
+        response.content_type = basium_driver_json.NDJSON
+        response.stream("%d\n" % i for i in range(1000))
+        response.compress("deflate")
+        data = b"".join(response.iter())
+        self.assertEqual(zlib.decompress(data), "".join("%d\n" % i for i in range(1000)).encode())
+
+    def testDecompressReader(self):
+        lines = [b"%d\n" % i for i in range(10000)]
+        resp = FakeHTTPResponse(gzip.compress(b"".join(lines)), {"Content-Encoding": "gzip"})
+        body = basium_driver_json.bodyReader(resp)
+        self.assertEqual(body.readline(), b"0\n")
+        self.assertEqual(list(body), lines[1:])
+
+        resp = FakeHTTPResponse(b"plain", {})
+        self.assertIs(basium_driver_json.bodyReader(resp), resp)
+
+
+class FakeHTTPConnection:
+    """
+    http.client connection, failing when sending or when reading the
+    response, as a connection closed by the server
+    """
+    def __init__(self, failSend=False, failResponse=False):
+        self.failSend = failSend
+        self.failResponse = failResponse
+        self.requests = []
+
+    def request(self, method, path, body=None, headers=None):
+        if self.failSend:
+            raise BrokenPipeError()
+        self.requests.append(method)
+
+    def getresponse(self):
+        if self.failResponse:
+            raise http.client.RemoteDisconnected()
+        return "response"
+
+    def close(self):
+        pass
+
+
+class TestConnectionPool(unittest.TestCase):
+    """
+    Test retries on stale connections and pool sharing in the json driver
+    """
+
+    def pool(self, stale):
+        pool = basium_driver_json.ConnectionPool("http", "127.0.0.1:1")
+        pool.newConnection = FakeHTTPConnection
+        pool.idle = [(stale, time.monotonic())]
+        return pool
+
+    def testRetry(self):
+        # not sent, always retried
+        stale = FakeHTTPConnection(failSend=True)
+        conn, resp = self.pool(stale).request("POST", "/api/x")
+        self.assertEqual(conn.requests, ["POST"])
+
+        # sent, retried only if idempotent
+        stale = FakeHTTPConnection(failResponse=True)
+        conn, resp = self.pool(stale).request("PUT", "/api/x")
+        self.assertEqual((stale.requests, conn.requests), (["PUT"], ["PUT"]))
+        stale = FakeHTTPConnection(failResponse=True)
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.pool(stale).request("POST", "/api/x")
+
+    def testGetPool(self):
+        getPool = basium_driver_json.getPool
+        pool = getPool("http", "127.0.0.1:1", maxConnections=2)
+        self.assertIs(getPool("http", "127.0.0.1:1", maxConnections=2), pool)
+        self.assertIsNot(getPool("http", "127.0.0.1:1", maxConnections=8), pool)
+        self.assertIsNot(getPool("http", "127.0.0.1:1", maxConnections=2, idleTimeout=5), pool)
+
+
+class TestModuleCache(unittest.TestCase):
+    """
+    Test that controller modules are cached in production mode, and
+    imported again when the file is changed
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "controller"))
+        self.file = os.path.join(self.tmpdir, "controller", "cachetest.py")
+        self.app = wsgi.common.App(documentroot=self.tmpdir)
+        self.app.production = True
+        # the controller finds app in builtins, as when run by AppServer
+        self.savedApp = getattr(builtins, "app", None)
+        builtins.app = self.app
+
+    def tearDown(self):
+        builtins.app = self.savedApp
+        sys.modules.pop("cachetest", None)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, text, mtime):
+        with open(self.file, "w") as f:
+            f.write("@app.route('/')\ndef index(request, response):\n    return %r\n" % text)
+        os.utime(self.file, (mtime, mtime))
+
+    def testReload(self):
+        cache = wsgi.common.ModuleCache(self.app)
+        self.write("one", 1000000)
+        mod = cache.get(self.file, "cachetest")
+        self.assertIs(cache.get(self.file, "cachetest"), mod)
+        self.assertEqual(self.call(), "one")
+
+        # changed, but not checked until reloadInterval has passed
+        self.write("two", 2000000)
+        self.assertIs(cache.get(self.file, "cachetest"), mod)
+        self.assertEqual(self.call(), "one")
+        self.app.reloadInterval = 0
+        cache.get(self.file, "cachetest")
+        self.assertEqual(self.call(), "two")
+
+    def testSwap(self):
+        # while the changed module is imported, requests see the old routes
+        cache = wsgi.common.ModuleCache(self.app)
+        self.write("one", 1000000)
+        cache.get(self.file, "cachetest")
+        with open(self.file, "a") as f:
+            f.write("import wsgi.common\n"
+                    "request = wsgi.common.Request()\n"
+                    "request.method = 'GET'\n"
+                    "seen = app.getMethodFunction('cachetest', '/', request)[0](None, None)\n")
+        os.utime(self.file, (2000000, 2000000))
+        self.app.reloadInterval = 0
+        self.assertEqual(cache.get(self.file, "cachetest").seen, "one")
+        self.assertEqual(self.call(), "one")
+
+    def call(self):
+        routes = self.app._modules["cachetest"]._routerFunctions
+        self.assertEqual(len(routes), 1)
+        return routes[0].func(None, None)
+
+
+class TestViewCompile(unittest.TestCase):
+    """
+    Test that a view compiled by several requests at the same time is
+    always loaded complete
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "view"))
+        with open(os.path.join(self.tmpdir, "view", "page.html"), "w") as f:
+            f.write("".join("<p>line %d</p>\n" % i for i in range(500)))
+        self.app = wsgi.common.App(documentroot=self.tmpdir)
+        self.savedApp = getattr(builtins, "app", None)
+        builtins.app = self.app
+
+    def tearDown(self):
+        builtins.app = self.savedApp
+        shutil.rmtree(self.tmpdir)
+
+    def compileAndLoad(self, count):
+        for i in range(count):
+            wsgi.view.CompileView().compileFile("page.html")
+            wsgi.view.loadView("page")
+
+    def testConcurrent(self):
+        # development mode, the view is compiled on each request
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(self.compileAndLoad, 20) for i in range(4)]
+            for future in futures:
+                future.result()
+        self.assertEqual(os.listdir(self.app.view_code_dir), ["page.py"])
+
+
+class TestRequestContext(unittest.TestCase):
+    """
+    Test that requests handled at the same time each see their own
+    request, response and output
+    """
+
+    def setUp(self):
+        self.streams = sys.stdout, sys.stderr
+        wsgi.common.captureOutput()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.streams
+
+    def testConcurrent(self):
+        app = wsgi.common.App(documentroot=tempfile.gettempdir())
+        barrier = threading.Barrier(2)
+
+        def page():
+            barrier.wait()      # both requests are running
+            print(wsgi.common.request.path)
+            wsgi.common.response.status_code = "201 " + wsgi.common.request.path
+
+        def handle(path):
+            request = wsgi.common.Request()
+            request.path = path
+            response = wsgi.common.Response()
+            wsgi.common.RequestContext(app, request, response).run(page)
+            return response
+
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            responses = list(executor.map(handle, ["/a", "/b"]))
+        for path, response in zip(["/a", "/b"], responses):
+            self.assertEqual(b"".join(response.iter()), (path + "\n").encode())
+            self.assertEqual(response.status_code, "201 " + path)
+        self.assertIsNone(wsgi.common.currentContext())
+
+
+class TestThreadPoolServer(unittest.TestCase):
+    """
+    Test that the thread pool server handles requests at the same time
+    """
+
+    def testConcurrent(self):
+        barrier = threading.Barrier(3, timeout=10)
+
+        def app(environ, start_response):
+            barrier.wait()      # all requests are running
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [environ["PATH_INFO"].encode()]
+
+        httpd = wsgi.handler.ThreadPoolServer(("127.0.0.1", 0), threads=3)
+        httpd.set_app(app)
+        thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.1})
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%d" % httpd.server_address[1]
+
+            def get(path):
+                with urllib.request.urlopen(url + path, timeout=10) as f:
+                    return f.read()
+
+            with concurrent.futures.ThreadPoolExecutor(3) as executor:
+                paths = ["/a", "/b", "/c"]
+                self.assertEqual(list(executor.map(get, paths)), [p.encode() for p in paths])
+        finally:
+            httpd.shutdown()
+            thread.join()
+            httpd.server_close()
+        self.assertEqual(httpd.requests, 3)
+
+    def testBounded(self):
+        # one request running and one waiting for a thread, the other
+        # connections are not accepted until a thread is free
+        release = threading.Event()
+
+        def app(environ, start_response):
+            release.wait(10)
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [b"ok"]
+
+        httpd = wsgi.handler.ThreadPoolServer(("127.0.0.1", 0), threads=1, backlog=1)
+        httpd.set_app(app)
+        thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.1})
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%d/" % httpd.server_address[1]
+
+            def get(i):
+                with urllib.request.urlopen(url, timeout=10) as f:
+                    return f.read()
+
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                futures = [executor.submit(get, i) for i in range(4)]
+                time.sleep(1)
+                self.assertEqual(httpd.requests, 2)
+                release.set()
+                self.assertEqual([future.result() for future in futures], [b"ok"] * 4)
+        finally:
+            release.set()
+            httpd.shutdown()
+            thread.join()
+            httpd.server_close()
+        self.assertEqual(httpd.requests, 4)
+
+    def testConnectionPerThread(self):
+        fd, dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            db = basium.Basium(driver="sqlite", dbconf=basium.DbConf(database=dbfile))
+            db.log.logger.setLevel(logging.ERROR)
+            db.addClass(test_tables.BasiumTest)
+            if not db.start():
+                self.fail("Cannot start database driver")
+            self.assertTrue(db.driver.threadSafe)
+
+            def load(i):
+                obj = objFactory.new(test_tables.BasiumTest, i)
+                db.store(obj)
+                return db.driver.dbconnection, db.load(test_tables.BasiumTest(obj._id))[0].varcharTest
+
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                results = list(executor.map(load, range(2)))
+            self.assertIsNot(results[0][0], results[1][0])
+            self.assertEqual([r[1] for r in results], [objFactory.new(test_tables.BasiumTest, i).varcharTest for i in range(2)])
+
+            def readOne():
+                rows = db.driver.select(db.query(test_tables.BasiumTest()))
+                return next(rows)["_id"]
+
+            # a discarded select in another thread does not block writes
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                executor.submit(readOne).result()
+                db.store(objFactory.new(test_tables.BasiumTest, 2))
+        finally:
+            os.remove(dbfile)
+
+    def testSubmitShared(self):
+        # the in-memory database is in the connection, shared by all threads
+        db = basium.Basium(driver="sqlite", dbconf=basium.DbConf(database=":memory:"))
+        db.log.logger.setLevel(logging.ERROR)
+        db.addClass(test_tables.BasiumTest)
+        if not db.start():
+            self.fail("Cannot start database driver")
+        self.assertFalse(db.driver.threadSafe)
+        self.assertRaises(bc.Error, db.submit, db.count, db.query(test_tables.BasiumTest()))
+
+
+class TestPreforkServer(unittest.TestCase):
+    """
+    Test that the prefork server starts workers again when they exit,
+    after maxRequests or when killed, and restarts them on SIGHUP
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "controller"))
+        with open(os.path.join(self.tmpdir, "controller", "prefork.py"), "w") as f:
+            f.write("import os\n"
+                    "@app.route('/pid')\n"
+                    "def pid(request, response):\n"
+                    "    print(os.getpid(), end='')\n")
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.url = "http://127.0.0.1:%d/prefork/pid" % sock.getsockname()[1]
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.terminate()     # SIGTERM, stops the workers
+            self.server.join(30)
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, workers, maxRequests=0):
+        ctx = multiprocessing.get_context("spawn")
+        self.server = ctx.Process(target=runPreforkServer, args=(self.tmpdir, self.url, workers, maxRequests))
+        self.server.start()
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                return self.get()
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+
+    def get(self):
+        """Returns the pid of the worker that handled the request"""
+        with urllib.request.urlopen(self.url, timeout=10) as f:
+            return int(f.read())
+
+    def waitExit(self, pids):
+        deadline = time.monotonic() + 30
+        while pids and time.monotonic() < deadline:
+            self.get()      # requests are handled while workers restart
+            pids = [pid for pid in pids if isRunning(pid)]
+            time.sleep(0.2)
+        self.assertEqual(pids, [])
+
+    def testProduction(self):
+        app = wsgi.common.App(documentroot=self.tmpdir)
+        wsgi.handler.PreforkServer(app)
+        self.assertTrue(app.production)
+
+    def testMaxRequests(self):
+        pids = {self.start(workers=1, maxRequests=2)}
+        deadline = time.monotonic() + 30
+        while len(pids) < 3 and time.monotonic() < deadline:
+            pids.add(self.get())
+            time.sleep(0.2)
+        self.assertGreaterEqual(len(pids), 3)
+
+    def testRestart(self):
+        # more workers killed than started, the last request is handled
+        # by a worker started again
+        for i in range(3):
+            pid = self.get() if i else self.start(workers=2)
+            os.kill(pid, signal.SIGKILL)
+            self.waitExit([pid])
+
+        pids = {self.get() for i in range(10)}
+        os.kill(self.server.pid, signal.SIGHUP)
+        self.waitExit(list(pids))
+        self.assertNotIn(self.get(), pids)
+
+
+class TestAsyncServer(unittest.TestCase):
+    """
+    Test the asyncio server with pipelined requests, to sync and async
+    controllers, on one connection
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "controller"))
+        with open(os.path.join(self.tmpdir, "controller", "asynctest.py"), "w") as f:
+            f.write("import asyncio\n"
+                    "import threading\n"
+                    "@app.route('/sync')\n"
+                    "def sync(request, response):\n"
+                    "    print('sync')\n"
+                    "@app.route('/async/<ms:int>')\n"
+                    "async def async_(request, response, ms=None):\n"
+                    "    await asyncio.sleep(ms / 1000)\n"
+                    "    print('async', ms)\n"
+                    "@app.route('/stream')\n"
+                    "def stream(request, response):\n"
+                    "    ident = threading.get_ident()\n"
+                    "    response.stream(str(threading.get_ident() == ident) for i in range(3))\n")
+        with open(os.path.join(self.tmpdir, "controller", "static.txt"), "w") as f:
+            f.write("static")
+        self.streams = sys.stdout, sys.stderr
+        self.savedApp = getattr(builtins, "app", None)
+        self.app = wsgi.common.App(documentroot=self.tmpdir)
+        self.app.production = True
+        self.appServer = wsgi.handler.AppServer(app=self.app)
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.streams
+        builtins.app = self.savedApp
+        sys.path.remove(self.app.controller_dir)
+        sys.modules.pop("asynctest", None)
+        shutil.rmtree(self.tmpdir)
+
+    def testPipelined(self):
+        async def run():
+            server = wsgi.asyncserver.AsyncServer(self.appServer, port=0, timeout=10)
+            await server.start()
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+                writer.write(b"GET /asynctest/async/20 HTTP/1.1\r\nHost: test\r\n\r\n"
+                             b"GET /asynctest/sync HTTP/1.1\r\nHost: test\r\n\r\n"
+                             b"GET /asynctest/async/1 HTTP/1.1\r\nConnection: close\r\n\r\n")
+                data = await asyncio.wait_for(reader.read(), 10)   # until closed
+                writer.close()
+            finally:
+                await server.stop()
+            return data
+
+        data = asyncio.run(run())
+        responses = data.split(b"HTTP/1.1 ")[1:]
+        self.assertEqual(len(responses), 3)
+        for response, body in zip(responses, [b"async 20\n", b"sync\n", b"async 1\n"]):
+            self.assertTrue(response.startswith(b"200 OK\r\n"))
+            self.assertTrue(response.endswith(b"\r\n\r\n" + body))
+        self.assertIn(b"Connection: close", responses[2])
+        self.assertNotIn(b"Connection: close", responses[0])
+
+    def testStreamAndLock(self):
+        async def get(server, path):
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"GET %s HTTP/1.0\r\n\r\n" % path)
+            data = await asyncio.wait_for(reader.read(), 10)
+            writer.close()
+            return data.split(b"\r\n\r\n", 1)[1]
+
+        async def run():
+            server = wsgi.asyncserver.AsyncServer(self.appServer, port=0, timeout=10)
+            await server.start()
+            try:
+                results = [await get(server, b"/asynctest/stream")]
+                if server.lock is not None:
+                    async with server.lock:
+                        results.append(await get(server, b"/static.txt"))
+                else:
+                    results.append(await get(server, b"/static.txt"))
+            finally:
+                await server.stop()
+            return results
+
+        # the stream is read in the thread of the controller
+        self.assertEqual(asyncio.run(run()), [b"TrueTrueTrue", b"static"])
+        # a driver that is not threadSafe, static files do not wait for the lock
+        self.appServer.lock = threading.Lock()
+        self.assertEqual(asyncio.run(run()), [b"TrueTrueTrue", b"static"])
+
+
+class TestRoutes(unittest.TestCase):
+    """
+    Test route lookup in a Page, the first matching route is used
+    """
+
+    def setUp(self):
+        self.page = wsgi.common.Page()
+        for path, methods in [("/bbb/<ccc>", ["GET"]),
+                              ("/bbb", ["GET"]),
+                              ("/<table>/<id:int>", ["GET", "PUT"]),
+                              ("/<table>/<name>/<count:int:o>", ["GET"]),
+                              ("/<value:float>", ["GET"]),
+                              ("/", ["GET"])]:
+            self.page.add(path=path, methods=methods, func=path)
+
+    def lookup(self, path, method="GET"):
+        request = wsgi.common.Request()
+        request.method = method
+        return self.page.getFunction(path, request)
+
+    def testMatch(self):
+        self.assertEqual(self.lookup("/bbb/x"), ("/bbb/<ccc>", {"ccc": "x"}))
+        self.assertEqual(self.lookup("/bbb/1"), ("/bbb", {}))   # 1 is not a str
+        self.assertEqual(self.lookup("/t/7"), ("/<table>/<id:int>", {"table": "t", "id": 7}))
+        self.assertEqual(self.lookup("/t/7", "PUT"), ("/<table>/<id:int>", {"table": "t", "id": 7}))
+        self.assertEqual(self.lookup("/t/n"), ("/<table>/<name>/<count:int:o>", {"table": "t", "name": "n"}))
+        self.assertEqual(self.lookup("/t/n/3"),
+                         ("/<table>/<name>/<count:int:o>", {"table": "t", "name": "n", "count": 3}))
+        self.assertEqual(self.lookup("/1.5/x"), ("/<value:float>", {"value": 1.5}))
+        self.assertEqual(self.lookup("/7/7"), ("/", {}))
+        self.assertEqual(self.lookup("/t/n", "PUT"), (None, None))
+
+    def testCache(self):
+        func, kwargs = self.lookup("/t/7")
+        kwargs["id"] = 8
+        self.assertEqual(self.lookup("/t/7")[1], {"table": "t", "id": 7})
+        # a new route is used, also for a path looked up before
+        self.assertEqual(self.lookup("/t/7", "DELETE"), (None, None))
+        self.page.add(path="/t/<x:int>", methods=["DELETE"], func="delete")
+        self.assertEqual(self.lookup("/t/7", "DELETE"), ("delete", {"x": 7}))
+
+
+class TestURLRouter(unittest.TestCase):
+    """
+    Test that the URL router sees new files in development mode, and
+    uses the directories listed at startup in production mode
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "sub"))
+        self.touch("sub", "page.py")
+        self.app = wsgi.common.App(documentroot=self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, *path):
+        open(os.path.join(self.tmpdir, *path), "w").close()
+
+    def testRoute(self):
+        router = wsgi.handler.URLRouter(self.tmpdir, app=self.app)
+        r = router.route("/sub/page/1/x")
+        self.assertEqual((r.file, r.path), ("page.py", "/1/x"))
+        self.assertEqual(r.abspath, os.path.join(self.tmpdir, "sub", "page.py"))
+        self.assertIsNone(router.route("/sub/new").file)
+        self.touch("sub", "new.py")
+        self.assertEqual(router.route("/sub/new").file, "new.py")
+
+    def testProduction(self):
+        self.app.production = True
+        router = wsgi.handler.URLRouter(self.tmpdir, app=self.app)
+        router.prebuild()
+        self.touch("sub", "index.py")
+        self.assertIsNone(router.route("/sub").file)
+        self.assertEqual(router.route("/sub/page").file, "page.py")
+
+
+class TestStaticFile(unittest.TestCase):
+    """
+    Test that static files are sent unchanged, in chunks or with
+    wsgi.file_wrapper, and not read for HEAD requests
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "controller"))
+        self.data = bytes(range(256)) * 1000
+        with open(os.path.join(self.tmpdir, "controller", "image.png"), "wb") as f:
+            f.write(self.data)
+        self.streams = sys.stdout, sys.stderr
+        self.savedApp = getattr(builtins, "app", None)
+        self.app = wsgi.common.App(documentroot=self.tmpdir)
+        self.appServer = wsgi.handler.AppServer(app=self.app)
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.streams
+        builtins.app = self.savedApp
+        sys.path.remove(self.app.controller_dir)
+        shutil.rmtree(self.tmpdir)
+
+    def get(self, method="GET", **environ):
+        environ.setdefault("PATH_INFO", "/image.png")
+        environ.update({"REQUEST_METHOD": method, "CONTENT_TYPE": "", "QUERY_STRING": "", "CONTENT_LENGTH": ""})
+        wsgiref.util.setup_testing_defaults(environ)
+        headers = []
+        result = self.appServer(environ, lambda status, h: headers.extend(h))
+        chunks = list(result)
+        if hasattr(result, "close"):
+            result.close()
+        return dict(headers), result, chunks
+
+    def testSend(self):
+        headers, result, chunks = self.get()
+        self.assertEqual(b"".join(chunks), self.data)
+        self.assertEqual(len(chunks[0]), wsgi.common.FILE_CHUNK)
+        self.assertEqual(headers["Content-Length"], str(len(self.data)))
+        self.assertEqual(headers["Content-type"], "image/png")
+
+        headers, result, chunks = self.get(**{"wsgi.file_wrapper": wsgiref.util.FileWrapper})
+        self.assertIsInstance(result, wsgiref.util.FileWrapper)
+        self.assertEqual(b"".join(chunks), self.data)
+
+        headers, result, chunks = self.get("HEAD")
+        self.assertEqual(chunks, [])
+        self.assertEqual(headers["Content-Length"], str(len(self.data)))
+
+    def testLock(self):
+        # a driver that is not threadSafe, the lock is held only while
+        # the controller runs, and not for static files
+        with open(os.path.join(self.tmpdir, "controller", "page.py"), "w") as f:
+            f.write("@app.route('/')\n"
+                    "def index(request, response):\n"
+                    "    response.write(str(app.appServer.lock.locked()))\n")
+        self.app.appServer = self.appServer
+        self.appServer.lock = threading.Lock()
+        headers, result, chunks = self.get(PATH_INFO="/page")
+        self.assertEqual(chunks, [b"True"])
+        self.assertFalse(self.appServer.lock.locked())
+
+        with self.appServer.lock:
+            headers, result, chunks = self.get()
+        self.assertEqual(b"".join(chunks), self.data)
+
+    def testWriteBytes(self):
+        response = wsgi.common.Response()
+        response.write(b"\x00\xff")
+        response.write("\u00e5")
+        self.assertEqual(b"".join(response.iter()), b"\x00\xff\xc3\xa5")
+        self.assertEqual(response.content_length, 4)
+
+
+class TestWire(unittest.TestCase):
+    """
+    Test the binary wire format
+    """
+
+    def testRoundtrip(self):
+        obj = test_tables.BasiumTest()
+        columns = basium_wire.columnTypes(obj)
+        names = [name for name, typ in columns]
+        rows = []
+        for p in range(10):
+            values = objFactory.new(test_tables.BasiumTest, p)._values
+            if p % 3 == 0:
+                values["varcharTest"] = None
+                values["dateTest"] = None
+            rows.append([values[name] for name in names])
+        encoder = basium_wire.Encoder(columns)
+        data = encoder.header() + encoder.block(rows[:4]) + encoder.block(rows[4:]) + encoder.end()
+        decoded = list(basium_wire.Decoder(io.BytesIO(data).read).rows())
+        self.assertEqual(decoded, [dict(zip(names, row)) for row in rows])
+
+        data = encoder.header() + encoder.block(rows) + encoder.error(2, "failed")
+        with self.assertRaises(bc.Error):
+            list(basium_wire.Decoder(io.BytesIO(data).read).rows())
+        self.assertRaises(ValueError, list, basium_wire.Decoder(io.BytesIO(data[:-5]).read).rows())
+
+    def testDriverFormat(self):
+        """
+        The wire format is per driver, a json and a binary driver can be
+        used in the same process
+        """
+        column = basium_driver_json.DateTimeCol()
+        value = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        drivers = [basium_driver_json.BasiumDriver(dbconf=basium.DbConf(host="http://127.0.0.1:1", wireFormat=w))
+                   for w in ("json", "binary")]
+        self.assertEqual([driver.toSql(column, value) for driver in drivers], ["2020-01-02 03:04:05", value])
+
+    def testConvert(self):
+        columns = [("d", basium_wire.DATE), ("i", basium_wire.INT), ("m", basium_wire.DECIMAL)]
+        encoder = basium_wire.Encoder(columns, [lambda value: None, int, lambda value: decimal.Decimal(value) / 100])
+        rows = [["2013-01-02", "12", 150], [datetime.date(2013, 1, 3), 13, 250]]
+        data = encoder.header() + encoder.block(rows) + encoder.end()
+        decoded = list(basium_wire.Decoder(io.BytesIO(data).read).rows())
+        self.assertEqual(decoded[0], {"d": datetime.date(2013, 1, 2), "i": 12, "m": decimal.Decimal("1.5")})
+        self.assertEqual(decoded[1], {"d": datetime.date(2013, 1, 3), "i": 13, "m": decimal.Decimal("2.5")})
+
+    def testValues(self):
+        values = {"b": True, "i": None, "f": 1.5, "t": datetime.datetime(2013, 1, 2, 3, 4, 5), "s": "räksmörgås"}
+        self.assertEqual(basium_wire.decodeValues(basium_wire.encodeValues(values)), values)
+
+
+class TestCodec(unittest.TestCase):
+    """
+    Test the per table conversion between the JSON API and the driver
+    """
+
+    def setUp(self):
+        fd, self.dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        db = basium.Basium(driver="sqlite", dbconf=basium.DbConf(database=self.dbfile))
+        db.log.logger.setLevel(logging.ERROR)
+        db.addClass(test_tables.BasiumTest)
+        if not db.start():
+            self.fail("Cannot start database driver")
+        self.codec = db.codecs["basiumtest"]
+        self.columns = test_tables.BasiumTest()._columns
+
+    def tearDown(self):
+        os.remove(self.dbfile)
+
+    def toSql(self, colname, value):
+        return self.columns[colname].toSql(value)
+
+    def testDecode(self):
+        values = {"intTest": "12", "decimalTest": "1.25", "dateTest": "2013-01-02",
+                  "booleanTest": "True", "floatTest": "NULL", "varcharTest": "NULL", "unknown": "1"}
+        self.assertEqual(self.codec.decode(values), {
+            "intTest": self.toSql("intTest", 12),
+            "decimalTest": self.toSql("decimalTest", decimal.Decimal("1.25")),
+            "dateTest": self.toSql("dateTest", datetime.date(2013, 1, 2)),
+            "booleanTest": self.toSql("booleanTest", True),
+            "floatTest": self.toSql("floatTest", None),
+            "varcharTest": self.toSql("varcharTest", "NULL"),
+        })
+        self.assertEqual(self.codec.decode({"intTest": 12}, typed=True), {"intTest": self.toSql("intTest", 12)})
+        self.assertRaises(KeyError, self.codec.decodeRow, {"intTest": "12"})
+
+    def testEncode(self):
+        obj = objFactory.new(test_tables.BasiumTest, 3)
+        values = self.codec.encode(obj._values)
+        self.assertEqual(values["datetimeTest"], "2012-04-04 03:03:03")
+        self.assertEqual(values["dateTest"], "2012-04-04 00:00:00")
+        self.assertEqual(values["decimalTest"], "3.03")
+        self.assertEqual(self.codec.encodeList(obj._values), [values[colname] for colname in self.codec.colnames])
+
+    def testSerialize(self):
+        rows = []
+        for p in range(7):
+            row = dict(objFactory.new(test_tables.BasiumTest, p)._values)
+            if p == 3:
+                # values without the column type, as strings from sqlite
+                row.update(intTest="12", dateTest="2013-01-02", varcharTest=None, floatTest="1.5")
+            rows.append(row)
+        serialize = self.codec.rowSerializer()
+        for row in rows:
+            self.assertEqual(serialize(row), json.dumps(self.codec.encode(row)))
+        text = "[%s]" % "".join(self.codec.serialize(rows, chunk=3))
+        self.assertEqual(json.loads(text), [self.codec.encode(row) for row in rows])
+        text = "".join(self.codec.serialize(rows, asList=True, separator="\n", end=True, chunk=3))
+        self.assertEqual([json.loads(line) for line in text.splitlines()],
+                         [json.loads(json.dumps(self.codec.encodeList(row))) for row in rows])
+
+
 def get_suite():
     """
     Return a testsuite with this modules all tests
@@ -348,6 +1732,26 @@ def get_suite():
     testloader = unittest.TestLoader()
 
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestModel))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSqliteScaledDecimal))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSqliteProfile))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSqliteTableVersion))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestStreamingCursor))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestCompression))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestConnectionPool))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestModuleCache))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestViewCompile))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestRequestContext))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestThreadPoolServer))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestPreforkServer))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestAsyncServer))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestRoutes))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestURLRouter))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestStaticFile))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestWire))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestCodec))
+
+    if "json" in drivers:
+        suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestTiered))
 
     for driver in drivers:
         testnames = testloader.getTestCaseNames(TestFunctions)
@@ -360,6 +1764,77 @@ def get_suite():
     return suite
 
 
+def runScaledServer(dbfile, queue):
+    """
+    Serve the API from a sqlite database with scaled decimals, used
+    by TestSqliteScaledDecimal in a separate process. The port is put
+    in queue
+    """
+    dbconf = basium.DbConf(database=dbfile, scaledDecimal=True)
+    db = basium.Basium(driver="sqlite", dbconf=dbconf, checkTables=True)
+    db.log.logger.setLevel(logging.ERROR)
+    db.addClass(test_tables.BasiumTest)
+    if not db.start():
+        return
+    app = wsgi.common.App(documentroot=os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"), db=db)
+    app.production = True
+    httpd = wsgi.handler.ThreadPoolServer(("127.0.0.1", 0), threads=2)
+    httpd.set_app(wsgi.handler.AppServer(app=app))
+    queue.put(httpd.server_address[1])
+    httpd.serve_forever()
+
+
+def runPreforkServer(documentroot, url, workers, maxRequests):
+    """
+    Serve the controllers in documentroot with a PreforkServer, used by
+    TestPreforkServer in a separate process
+    """
+    port = urllib.parse.urlsplit(url).port
+    app = wsgi.common.App(documentroot=documentroot)
+    wsgi.handler.PreforkServer(app, host="127.0.0.1", port=port, workers=workers, threads=2,
+                               timeout=5, maxRequests=maxRequests).serve()
+
+
+def isRunning(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def runScaledClient(url, wireFormat, queue):
+    """
+    Store a decimal with the json driver and load it back by id, with
+    a filter and with loadIter(). The values are put in queue
+    """
+    dbconf = basium.DbConf(host=url, username="basium_user", password="secret",
+                           database="basium_db", wireFormat=wireFormat)
+    db = basium.Basium(driver="json", dbconf=dbconf)
+    db.log.logger.setLevel(logging.ERROR)
+    db.addClass(test_tables.BasiumTest)
+    if not db.start():
+        queue.put(None)
+        return
+    obj = objFactory.new(test_tables.BasiumTest, 1)
+    obj.decimalTest = decimal.Decimal("7.07")
+    db.store(obj)
+    query = db.query().filter(obj.q._id, '=', obj._id)
+    values = [db.load(test_tables.BasiumTest(obj._id))[0].decimalTest,
+              db.load(query)[0].decimalTest]
+    values += [o.decimalTest for o in db.loadIter(query)]
+    # a datetime with microseconds, stored with the bulk insert and a batch
+    objs = [objFactory.new(test_tables.BasiumTest, p) for p in range(2, 4)]
+    for o in objs:
+        o.datetimeTest = datetime.datetime(2024, 1, 1, 10, 0, 0, 123456)
+    db.storeMany(objs)
+    with db.transaction() as t:
+        t.store(objFactory.new(test_tables.BasiumTest, 4))
+        t.store(objs[0])
+    values += [o.datetimeTest for o in db.loadIter(db.query().filter(obj.q._id, '>', obj._id).order(obj.q._id))]
+    queue.put(values)
+
+
 def runServer():
     """
     Start an WSGI server as a separate thread,
@@ -373,6 +1848,7 @@ def runServer():
     db.setDebug(bc.DEBUG_ALL)
     db.log.logger.setLevel(logging.ERROR)
     db.addClass(test_tables.BasiumTest)
+    db.addClass(test_tables.BasiumTestChanges)
     if not db.start():
         log.error("Cannot start database driver for wsgi server")
 
@@ -41,3 +41,7 @@ class BasiumTest(basium_model.Model):
     floatTest = basium_model.FloatCol()
     intTest = basium_model.IntegerCol()
     varcharTest = basium_model.VarcharCol()
+
+
+class BasiumTestChanges(BasiumTest):
+    _trackChanges = True
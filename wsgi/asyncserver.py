@@ -0,0 +1,423 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012-2013, Anders Lowinger, Abundo AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+asyncio HTTP/1.1 server for the AppServer
+Keeps connections open and answers pipelined requests in order.
+Async controllers are awaited in the event loop, other controllers
+run in a thread pool
+"""
+
+import io
+import sys
+import time
+import http
+import signal
+import asyncio
+import traceback
+import email.utils
+import urllib.parse
+import wsgiref.util
+import concurrent.futures
+
+import basium
+
+import wsgi.common
+
+log = basium.log
+
+
+class AsyncServer:
+    """
+    HTTP/1.1 server on asyncio
+      threads      controllers that are not async, handled at the same time
+      backlog      connections waiting to be accepted
+      timeout      seconds before an idle or slow client is disconnected
+      maxActive    requests handled at the same time, a connection waits
+                   for a slot before its request is handled
+      maxBody      largest request body accepted
+      maxHeader    largest request header accepted, also limits how much
+                   of pipelined requests is read ahead
+      bufferSize   bytes of response buffered for a client, before the
+                   server waits for the client to read
+
+    An async controller should not block, use asyncio.to_thread() to
+    call the database from it. Other controllers run in a pool of
+    threads, and a streamed response is read in the thread that ran its
+    controller, as the SQL drivers have one connection per thread
+    With a driver that is not thread safe the controllers run one at a
+    time, like in AppServer. Static files are sent without the lock
+    """
+
+    def __init__(self, appServer, host="127.0.0.1", port=8051, threads=8, backlog=128,
+                 timeout=30, maxActive=256, maxBody=16 * 1024 * 1024, maxHeader=64 * 1024,
+                 bufferSize=256 * 1024):
+        self.appServer = appServer
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.backlog = backlog
+        self.timeout = timeout
+        self.maxActive = maxActive
+        self.maxBody = maxBody
+        self.maxHeader = maxHeader
+        self.bufferSize = bufferSize
+        self.requests = 0
+        self.server = None
+        self.executors = []
+        self._date = None
+        self._dateTime = None
+
+    async def start(self):
+        """Start listening, the port is updated if 0 was used"""
+        self.loop = asyncio.get_running_loop()
+        # threads, a request keeps one while its stream is read
+        self.executors = [concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="async")
+                          for i in range(self.threads)]
+        self.workers = asyncio.Queue()
+        for executor in self.executors:
+            self.workers.put_nowait(executor)
+        self.active = asyncio.Semaphore(self.maxActive)
+        self.lock = asyncio.Lock() if self.appServer.lock is not None else None
+        self.server = await asyncio.start_server(
+            self.handleConnection, self.host, self.port,
+            backlog=self.backlog, limit=self.maxHeader)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop listening, and wait for the controllers that are running"""
+        self.server.close()
+        await self.server.wait_closed()
+        for executor in self.executors:
+            await self.loop.run_in_executor(None, executor.shutdown)
+
+    def serve(self):
+        """Run the server until SIGTERM or SIGINT"""
+        asyncio.run(self.serveForever())
+
+    async def serveForever(self):
+        await self.start()
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(sig, stop.set)
+        log.info("Async server with %d threads, on %s:%d" % (self.threads, self.host, self.port))
+        await stop.wait()
+        await self.stop()
+
+    def date(self):
+        """Date header, formatted once a second"""
+        now = int(time.time())
+        if now != self._dateTime:
+            self._date = email.utils.formatdate(now, usegmt=True)
+            self._dateTime = now
+        return self._date
+
+    async def handleConnection(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=self.bufferSize)
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try:
+            while True:
+                try:
+                    environ = await asyncio.wait_for(self.readRequest(reader, writer, peer), self.timeout)
+                except wsgi.common.WsgiError as err:
+                    await self.sendError(writer, err.status_code, err.message)
+                    break
+                if environ is None:
+                    break   # client closed the connection
+                if not await self.handleRequest(writer, environ):
+                    break
+        except (ConnectionError, asyncio.TimeoutError):
+            pass    # client went away, or is too slow
+        except Exception:
+            traceback.print_exc(file=sys.__stderr__)
+        finally:
+            writer.close()
+
+    async def readRequest(self, reader, writer, peer):
+        """
+        Read the request line, headers and body
+        Returns the WSGI environ, or None if the connection was closed
+        """
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as err:
+            if err.partial.strip():
+                raise wsgi.common.WsgiError("Incomplete request", 400)
+            return None
+        except asyncio.LimitOverrunError:
+            raise wsgi.common.WsgiError("Request header too large", 431)
+
+        lines = head.decode("latin-1").lstrip("\r\n").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise wsgi.common.WsgiError("Bad request line", 400)
+        if not version.startswith("HTTP/1."):
+            raise wsgi.common.WsgiError("HTTP version not supported", 505)
+
+        if target.startswith(("http://", "https://")):
+            target = urllib.parse.urlsplit(target)._replace(scheme="", netloc="").geturl()
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote(path, "latin-1"),
+            "QUERY_STRING": query,
+            "CONTENT_TYPE": "text/plain",
+            "CONTENT_LENGTH": "",
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": wsgiref.util.FileWrapper,
+        }
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep or name != name.strip():
+                raise wsgi.common.WsgiError("Bad header line", 400)
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            value = value.strip()
+            if key in environ and key.startswith("HTTP_"):
+                value = environ[key] + "," + value
+            environ[key] = value
+
+        body = await self.readBody(reader, writer, environ)
+        if body:
+            environ["CONTENT_LENGTH"] = str(len(body))
+        environ["wsgi.input"] = io.BytesIO(body)
+        return environ
+
+    async def readBody(self, reader, writer, environ):
+        chunked = environ.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked"
+        length = environ["CONTENT_LENGTH"]
+        if not chunked and not length:
+            return b""
+        if not chunked:
+            try:
+                length = int(length)
+            except ValueError:
+                raise wsgi.common.WsgiError("Bad Content-Length", 400)
+            if length < 0:
+                raise wsgi.common.WsgiError("Bad Content-Length", 400)
+            if length > self.maxBody:
+                raise wsgi.common.WsgiError("Request body too large", 413)
+        if environ.get("HTTP_EXPECT", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        try:
+            if not chunked:
+                return await reader.readexactly(length)
+            body = []
+            size = 0
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                try:
+                    length = int(line.split(b";")[0], 16)
+                except ValueError:
+                    raise wsgi.common.WsgiError("Bad chunk size", 400)
+                if length == 0:
+                    # skip trailers
+                    while await reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    return b"".join(body)
+                size += length
+                if size > self.maxBody:
+                    raise wsgi.common.WsgiError("Request body too large", 413)
+                body.append(await reader.readexactly(length))
+                if await reader.readexactly(2) != b"\r\n":
+                    raise wsgi.common.WsgiError("Bad chunk", 400)
+        except asyncio.IncompleteReadError:
+            raise wsgi.common.WsgiError("Incomplete request body", 400)
+        except asyncio.LimitOverrunError:
+            raise wsgi.common.WsgiError("Bad chunk", 400)
+
+    def keepAlive(self, environ):
+        tokens = [t.strip() for t in environ.get("HTTP_CONNECTION", "").lower().split(",")]
+        if environ["SERVER_PROTOCOL"] == "HTTP/1.0":
+            return "keep-alive" in tokens
+        return "close" not in tokens
+
+    async def handleRequest(self, writer, environ):
+        """
+        Handle one request, returns True if the connection is kept open
+        """
+        async with self.active:
+            self.requests += 1
+            return await self.respond(writer, environ)
+
+    async def call(self, environ):
+        """
+        Run the controller, returns context, status, headers, body and
+        the executor whose thread ran it, or None if the body does not
+        need it
+        """
+        appServer = self.appServer
+        loop = self.loop
+        executor = await self.workers.get()
+        try:
+            context = await loop.run_in_executor(executor, appServer.begin, environ)
+            if context.pending is not None:
+                # async controller, the thread is not used while it runs
+                self.workers.put_nowait(executor)
+                executor = None
+                # the task runs in a copy of the request context, create_task(context=)
+                # needs python 3.11
+                await context.context.run(loop.create_task, appServer.callAsync(context))
+                executor = await self.workers.get()
+            status, headers, body = await loop.run_in_executor(
+                executor, appServer.finish, context, environ)
+        except:
+            if executor is not None:
+                self.workers.put_nowait(executor)
+            raise
+        if not context.response.isStream() or environ["REQUEST_METHOD"] == "HEAD":
+            self.workers.put_nowait(executor)   # the body is in memory or a file
+            executor = None
+        return context, status, headers, body, executor
+
+    async def respond(self, writer, environ):
+        loop = self.loop
+        lock = self.lock
+        if lock is not None and self.appServer.isStatic(environ["PATH_INFO"]):
+            lock = None     # static files do not use the database
+        try:
+            if lock is None:
+                context, status, headers, body, executor = await self.call(environ)
+            else:
+                async with lock:
+                    context, status, headers, body, executor = await self.call(environ)
+                    if executor is not None:
+                        # the stream reads the shared connection, read it
+                        # all before the lock is released
+                        try:
+                            body = await loop.run_in_executor(executor, list, body)
+                        finally:
+                            self.workers.put_nowait(executor)
+                            executor = None
+        except Exception:
+            traceback.print_exc(file=sys.__stderr__)
+            await self.sendError(writer, 500, "Internal server error")
+            return False
+        try:
+            return await self.send(writer, environ, context, status, headers, body, executor)
+        finally:
+            if executor is not None:
+                self.workers.put_nowait(executor)
+
+    async def send(self, writer, environ, context, status, headers, body, executor):
+        """
+        Send the response, returns True if the connection is kept open
+        A stream is read in the thread of executor, if not None
+        """
+        loop = self.loop
+        keepAlive = self.keepAlive(environ)
+        stream = context.response.isStream()
+        chunked = stream and environ["SERVER_PROTOCOL"] != "HTTP/1.0"
+        if stream and not chunked:
+            keepAlive = False   # the end of the body is when the connection closes
+
+        head = ["HTTP/1.1 %s\r\nDate: %s\r\n" % (status, self.date())]
+        head.extend("%s: %s\r\n" % header for header in headers)
+        if chunked:
+            head.append("Transfer-Encoding: chunked\r\n")
+        if not keepAlive:
+            head.append("Connection: close\r\n")
+        elif environ["SERVER_PROTOCOL"] == "HTTP/1.0":
+            head.append("Connection: keep-alive\r\n")
+        head.append("\r\n")
+        writer.write("".join(head).encode("latin-1"))
+
+        if environ["REQUEST_METHOD"] == "HEAD":
+            pass
+        elif isinstance(body, wsgiref.util.FileWrapper):
+            # static file, sent by the kernel if possible
+            try:
+                await loop.sendfile(writer.transport, body.filelike)
+            finally:
+                body.close()
+        elif not stream:
+            writer.writelines(body)
+        else:
+            # the stream can use the database, read it in the thread of the controller
+            it = iter(body)
+            try:
+                while True:
+                    if executor is None:
+                        data = next(it, None)
+                    else:
+                        data = await loop.run_in_executor(executor, next, it, None)
+                    if data is None:
+                        break
+                    if not data:
+                        continue
+                    if chunked:
+                        writer.writelines((b"%x\r\n" % len(data), data, b"\r\n"))
+                    else:
+                        writer.write(data)
+                    await self.drain(writer)
+            finally:
+                if hasattr(body, "close"):
+                    # also when the client is gone, the stream releases the database
+                    if executor is None:
+                        body.close()
+                    else:
+                        await loop.run_in_executor(executor, body.close)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+        await self.drain(writer)
+        log.info('"%s %s %s" %s' % (environ["REQUEST_METHOD"], environ["PATH_INFO"],
+                                    environ["SERVER_PROTOCOL"], status.split(" ")[0]))
+        return keepAlive
+
+    async def drain(self, writer):
+        """
+        Wait while the client has not read the buffered response,
+        a client that does not read within timeout is disconnected
+        """
+        if writer.transport.get_write_buffer_size() >= self.bufferSize:
+            await asyncio.wait_for(writer.drain(), self.timeout)
+        elif writer.transport.is_closing():
+            raise ConnectionResetError("Connection lost")
+
+    async def sendError(self, writer, code, message):
+        status = "%d %s" % (code, http.HTTPStatus(code).phrase)
+        body = ("%s\n" % message).encode()
+        writer.write(("HTTP/1.1 %s\r\nDate: %s\r\nContent-Type: text/plain\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n" %
+                      (status, self.date(), len(body))).encode("latin-1") + body)
+        await self.drain(writer)
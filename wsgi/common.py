@@ -36,11 +36,17 @@ Basium
 
 import os
 import sys
+import time
+import json
+import threading
+import contextvars
 import collections
 import inspect
+import functools
 import importlib.machinery
 
 import urllib.parse
+import zlib
 
 
 class Param:
@@ -105,6 +111,140 @@ def importFile(pythonFile):
         return loader.load_module()
 
 
+_current = contextvars.ContextVar("wsgi_request", default=None)
+
+
+class RequestContext:
+    """
+    The request being handled, with its response
+    Each request runs in its own contextvars.Context, so threads and
+    asyncio tasks that handle requests at the same time each see their
+    own request, response and output, see ContextAttr and OutputRedirect
+    """
+    def __init__(self, app, request, response):
+        self.app = app
+        self.db = app.db
+        self.request = request
+        self.response = response
+        self.pending = None     # coroutine of an async controller
+        self.context = contextvars.copy_context()
+        self.context.run(_current.set, self)
+
+    def run(self, func, *args, **kwargs):
+        """Call func in the context of this request"""
+        return self.context.run(func, *args, **kwargs)
+
+    def iter(self, iterable):
+        """
+        Generator, iterate in the context of this request. Used for
+        streamed responses, that are generated after the handler returns
+        The response is closed when the generator ends or is closed, so
+        a stream that reads from the database releases it at once
+        """
+        it = iter(iterable)
+        try:
+            while True:
+                try:
+                    data = self.context.run(next, it)
+                except StopIteration:
+                    return
+                yield data
+        finally:
+            self.context.run(self.response.close)
+
+
+def currentContext():
+    """Returns the RequestContext of the current request, or None"""
+    return _current.get()
+
+
+class ContextAttr:
+    """
+    Stands in for an attribute of the current RequestContext
+    Controllers get request and response with 'from wsgi.common import *'
+    and can use them as globals, also when requests run concurrently
+    """
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+
+    def __getattr__(self, attr):
+        return getattr(getattr(_current.get(), self._name), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(getattr(_current.get(), self._name), attr, value)
+
+
+request = ContextAttr("request")
+response = ContextAttr("response")
+
+
+class OutputRedirect:
+    """
+    Installed as sys.stdout and sys.stderr by captureOutput()
+    Output during a request is written to the response of the request,
+    other output to the original stream
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, msg):
+        context = _current.get()
+        if context is None:
+            return self.stream.write(msg)
+        context.response.write(msg)
+        return len(msg)
+
+    def flush(self):
+        if _current.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+def captureOutput():
+    """
+    Send print() and other output to sys.stdout and sys.stderr during
+    a request to the response, see OutputRedirect
+    """
+    if not isinstance(sys.stdout, OutputRedirect):
+        sys.stdout = OutputRedirect(sys.stdout)
+    if not isinstance(sys.stderr, OutputRedirect):
+        sys.stderr = OutputRedirect(sys.stderr)
+
+
+class ModuleCache:
+    """
+    Imported controller modules, used in production mode
+    A module is imported once, and imported again only when the
+    modification time of the file has changed. The routes in the
+    module stay registered until it is imported again, and are then
+    replaced with the new routes in one step
+    The file is checked at most every app.reloadInterval seconds
+    """
+    def __init__(self, app):
+        self.app = app
+        self.modules = {}   # key is file, value is [module, mtime, time of last check]
+        self.lock = threading.Lock()
+
+    def get(self, pythonFile, module_name):
+        now = time.monotonic()
+        entry = self.modules.get(pythonFile)
+        if entry is not None and now - entry[2] < self.app.reloadInterval:
+            return entry[0]
+        mtime = os.path.getmtime(pythonFile)
+        if entry is not None and entry[1] == mtime:
+            entry[2] = now
+            return entry[0]
+        with self.lock:
+            entry = self.modules.get(pythonFile)
+            if entry is not None and entry[1] == mtime:
+                return entry[0]
+            module = self.app.loadPageRoutes(module_name, pythonFile)
+            self.modules[pythonFile] = [module, mtime, now]
+            return module
+
+
 def pathToPythonModule(base, name):
     name = name[len(base):]  # strip the controller path
     if name[0] == "/":
@@ -122,49 +262,61 @@ class WsgiError(Exception):
         super().__init__(message, status_code, *args)
 
 
-class ArgsHandler:
+def decodeArg(value):
     """
-    Handle arguments sent in URL
-    Try to decode type, and store decoded type/value in a cache
+    Decode an argument in the URL, returns type and value
+    Type is int, float or str, whichever converts the value first
     """
-    def __init__(self, path):
-        self._path = path
-        self._patharray = list(filter(None, path.split("/")))
-
-        self._args = {}
-
-    def __len__(self):
-        return len(self._patharray)
-
-    def getUndecoded(self, ix):
-        return self._patharray[ix]
-
-    def getTypeValue(self, ix):
-        try:
-            return self._args[ix]
-        except KeyError:
-            pass
-
-        while True:
-            try:
-                v = int(self._patharray[ix])
-                t = 'int'
-                break
-            except ValueError:
-                pass
+    try:
+        return 'int', int(value)
+    except ValueError:
+        pass
+    try:
+        return 'float', float(value)
+    except ValueError:
+        pass
+    return 'str', value
+
+
+class RouteNode:
+    """
+    Node in the route trie of a Page, there is one level per part of
+    the path. Routes are numbered in the order they are added, the
+    first route that matches is used
+    """
+    __slots__ = ("static", "typed", "end", "optional")
 
-            try:
-                v = float(self._patharray[ix])
-                t = 'float'
-                break
-            except ValueError:
-                pass
+    def __init__(self):
+        self.static = {}        # static text -> RouteNode
+        self.typed = {}         # 'int', 'float', 'str' -> RouteNode
+        self.end = None         # first route with all params matched here
+        self.optional = None    # first route where the next param is optional
 
-            v = self._patharray[ix]
-            t = 'str'
-            break
-        self._args[ix] = t, v
-        return t, v
+    def search(self, parts, decoded, ix):
+        """
+        Returns the number of the first route matching parts[ix:], or None
+        Parts after the last param of a route are not used, the route
+        matches anyway
+        """
+        best = self.end
+        if ix == len(parts):
+            if self.optional is not None and (best is None or self.optional < best):
+                best = self.optional
+            return best
+        child = self.static.get(parts[ix])
+        if child is not None:
+            found = child.search(parts, decoded, ix + 1)
+            if found is not None and (best is None or found < best):
+                best = found
+        if self.typed:
+            if decoded[ix] is None:
+                decoded[ix] = decodeArg(parts[ix])
+            child = self.typed.get(decoded[ix][0])
+            if child is not None:
+                found = child.search(parts, decoded, ix + 1)
+                if found is not None and (best is None or found < best):
+                    best = found
+        return best
 
 
 class Page:
@@ -172,9 +324,12 @@ class Page:
     Each html page using render_view has one instance of this class.
     Contains the current request & response data
     """
+    cacheSize = 1024    # (method, path) lookups remembered
+
     def __init__(self):
         self._routerFunctions = []
         self.frozen = False
+        self._lookup = None
 
     def add(self, path=None, methods=None, func=None):
 #        log.debug("  Page.add(path='%s', methods=%s, func='%s')" %
@@ -207,54 +362,63 @@ class Page:
             rf.param.append(param)
 
         self._routerFunctions.append(rf)
+        self._lookup = None
+
+    def compile(self):
+        """
+        Returns the route trie, a RouteNode for each method, and the
+        routes it refers to
+        """
+        trie = {}
+        routes = list(self._routerFunctions)
+        for order, rf in enumerate(routes):
+            for method in rf.methods:
+                node = trie.setdefault(method, RouteNode())
+                for param in rf.param:
+                    if param.optional and node.optional is None:
+                        node.optional = order
+                    if param.typ == 'static':
+                        node = node.static.setdefault(param.name, RouteNode())
+                    else:
+                        node = node.typed.setdefault(param.typ, RouteNode())
+                if node.end is None:
+                    node.end = order
+        return trie, routes
 
     def getFunction(self, path, request):
         """
         Based on a function name, return the function to call and the arguments.
         All required args and arg-type need to match
         """
-        args = ArgsHandler(path)
-        kwargs = {}
+        lookup = self._lookup
+        if lookup is None:
+            # the routes have changed, compile them again
+            trie, routes = self.compile()
+            lookup = functools.lru_cache(maxsize=self.cacheSize)(
+                functools.partial(self._match, trie, routes))
+            self._lookup = lookup
+        func, kwargs = lookup(request.method, path)
+        if func is None:
+            return None, None
+        return func, dict(kwargs)
 
-        log.debug("Searching for a matching function. method=%s path=%s"  %
-                  (request.method, path))
-        for rf in self._routerFunctions:
-#            log.debug("  trying to match function %s" % rf)
-            if not request.method in rf.methods:
-#                log.debug("    no match, method %s not in %s" % (request.method, rf.methods))
-                continue
-            ix = 0
-            found = True
-            for param in rf.param:
-                ix += 1
-
-                if ix > len(args):
-                    # we are out of arguments
-                    if not param.optional:
-                        found = False
-                    break
-
-#                log.debug("    param %s ix=%s" % (param, ix))
-
-                if param.typ == 'static' and param.name == args.getUndecoded(ix-1):
-#                    log.debug("      found a match, static, continue")
-                    continue
-
-                typ, val = args.getTypeValue(ix-1)
-                if param.typ == typ:
-#                    log.debug("      found a match, typ=%s, value=%s" % (param.typ, val))
-                    kwargs[param.name] = val
-                    continue
-#                log.debug("      No match, wanted type %s got type %s" % (param.typ, typ))
-                found = False
-                break
-
-            if found:
-#                log.debug("  Function found")
-                return rf.func, kwargs
-
-#        log.debug("No matching function found")
-        return None, None
+    def _match(self, trie, routes, method, path):
+        log.debug("Searching for a matching function. method=%s path=%s" % (method, path))
+        root = trie.get(method)
+        if root is None:
+            return None, None
+        parts = list(filter(None, path.split("/")))
+        decoded = [None] * len(parts)
+        found = root.search(parts, decoded, 0)
+        if found is None:
+            return None, None
+
+        rf = routes[found]
+        kwargs = {}
+        for ix, param in enumerate(rf.param[:len(parts)]):
+            if param.typ != 'static':
+                kwargs[param.name] = decoded[ix][1]
+        return rf.func, kwargs
 
 
 class App:
@@ -288,8 +452,30 @@ class App:
 
         self.dbconf = None
         self.db = db
+
+        self.compressLevel = 6          # zlib level 1-9, 0 disables response compression
+        self.compressMinSize = 1024     # responses smaller than this are sent uncompressed
+
+        # rows per page in JSON responses from the REST API, when the
+        # query has no limit. A larger limit in the query is cut to
+        # maxPageSize. NDJSON and binary responses are streamed, not paged
+        self.pageSize = 1000
+        self.maxPageSize = 10000
+
+        # In production mode controller modules are imported once and
+        # cached, and imported again only if the file is changed. The
+        # modification time is checked every reloadInterval seconds.
+        # In development mode modules are imported on each request
+        self.production = False
+        self.reloadInterval = 2
         
         self._modules = {}  # key is module name, value is instance of Page()
+        self._loading = {}  # key is module name, value is Page() built by the import, see loadPageRoutes()
+
+    @property
+    def _reload(self):
+        """True if modules and views should be reloaded on each request"""
+        return not self.production
 
     def route(self, path, methods=["GET"]):
         # log.debug("App.route(path='%s', methods=%s)" % (path, methods))
@@ -300,9 +486,11 @@ class App:
                 app.controller_dir, calling_module)
             # log.debug("App.route.add(func=%s, calling module=%s)" % (func, calling_module))
 
-            if calling_module not in self._modules:
-                self._modules[calling_module] = Page()
-            page = self._modules[calling_module]
+            page = self._loading.get(calling_module)
+            if page is None:
+                if calling_module not in self._modules:
+                    self._modules[calling_module] = Page()
+                page = self._modules[calling_module]
             if not page.frozen:
                 page.add(path=path, methods=methods, func=func)
 
@@ -314,6 +502,22 @@ class App:
         except KeyError:
             pass
             
+    def loadPageRoutes(self, module_name, pythonFile):
+        """
+        Import a controller module and replace its routes with the ones
+        added by the import. Requests handled meanwhile use the old
+        routes, the new Page() is swapped in when complete
+        """
+        page = Page()
+        self._loading[module_name] = page
+        try:
+            module = importFile(pythonFile)
+        finally:
+            del self._loading[module_name]
+        page.frozen = True
+        self._modules[module_name] = page
+        return module
+
     def flushePageRoutes(self, module_name):
         try:
             del self._modules[module_name]
@@ -326,11 +530,12 @@ class App:
         matching path and method
         """
 
-        if module_name not in self._modules:
+        page = self._modules.get(module_name)
+        if page is None:
             log.debug("No such module %s" % module_name)
             return None, None
 
-        return self._modules[module_name].getFunction(path, request)
+        return page.getFunction(path, request)
 
 
 class Request:
@@ -350,10 +555,13 @@ class Request:
         self.args = None        # passed URL parameters
 
         self._form = None
+        self.body = None
 
-    def form(self, key=None, defaultdict=False):
-        # lazy decode form data, valid for POST, PUT
-        if self._form is None:
+    def getBody(self):
+        """
+        Return the request body, valid for POST, PUT
+        """
+        if self.body is None:
             if self.method not in ['POST', 'PUT']:
                 raise WsgiError("Cannot access form data with method %s" % self.method, 403)
 
@@ -368,6 +576,18 @@ class Request:
             # in the HTTP request body which is passed by the WSGI server
             # in the file like wsgi.input environment variable.
             self.body = self.environ['wsgi.input'].read(self.body_size)
+        return self.body
+
+    def json(self):
+        """
+        Decode the request body as JSON
+        """
+        return json.loads(self.getBody().decode())
+
+    def form(self, key=None, defaultdict=False):
+        # lazy decode form data, valid for POST, PUT
+        if self._form is None:
+            self.getBody()
 
             # decode the data
             if defaultdict:
@@ -387,6 +607,54 @@ class Request:
         return None
 
 
+# content types that are worth compressing
+COMPRESS_TYPES = ("text/", "application/json", "application/x-ndjson",
+                  "application/x-basium-rows", "application/javascript", "application/xml")
+
+
+def acceptEncoding(header):
+    """
+    Parse an Accept-Encoding header and return the preferred supported
+    content coding, "gzip", "deflate" or None
+    """
+    if not header:
+        return None
+    codings = {}
+    for item in header.split(","):
+        parts = item.strip().split(";")
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    best = None
+    for coding in ("gzip", "deflate"):
+        q = codings.get(coding, codings.get("*", 0.0))
+        if q > 0.0 and (best is None or q > codings.get(best, codings.get("*", 0.0))):
+            best = coding
+    return best
+
+
+FILE_CHUNK = 64 * 1024     # bytes read at a time from files sent
+
+
+def readFile(f, size=FILE_CHUNK):
+    """Generator, reads the file in chunks, closes it when done"""
+    try:
+        while True:
+            data = f.read(size)
+            if not data:
+                return
+            yield data
+    finally:
+        f.close()
+
+
 class Response:
     """
     Stores the HTTP response, sent back to the user
@@ -399,21 +667,113 @@ class Response:
         self.headers = []
 
         self._out = []
+        self._stream = None
+        self._file = None
+        self._compressor = None
         self.content_length = 0
 
     def write(self, msg, encoding=True):
+        """
+        Add msg to the response. bytes are added as they are, other
+        values are converted with str() and encoded with content_encoding
+        """
         if msg is not None:
-            msg = str(msg)
-            msg = msg.encode(self.content_encoding)
+            if not isinstance(msg, (bytes, bytearray)):
+                msg = str(msg).encode(self.content_encoding)
             self.content_length += len(msg)
             self._out.append(msg)
 
+    def sendFile(self, f):
+        """
+        Send the open binary file f after any written data, and close it
+        The file is read in chunks while it is sent, or sent by the
+        server using wsgi.file_wrapper, see getFile()
+        """
+        self._file = f
+        self.content_length += os.fstat(f.fileno()).st_size
+
+    def getFile(self):
+        """Returns the file to send, if the file is all of the response"""
+        if self._out or self._stream is not None or self._compressor is not None:
+            return None
+        return self._file
+
+    def close(self):
+        """Release the file or stream, when the response is not sent"""
+        for body in (self._file, self._stream):
+            if hasattr(body, "close"):
+                body.close()
+
+    def stream(self, iterable):
+        """
+        Send the data from iterable (str or bytes) after any written data
+        The data is generated while sending it, so the content length is
+        not known in advance
+        """
+        self._stream = iterable
+
+    def isStream(self):
+        return self._stream is not None
+
     def addHeader(self, header, value):
         self.headers.append((header, value))
 
-    def iter(self):
+    def compressible(self, minsize):
+        """True if the response is worth compressing"""
+        if not self.status_code.startswith("200") or self._compressor is not None:
+            return False
+        if not self.content_type.startswith(COMPRESS_TYPES):
+            return False
+        return self.isStream() or self.content_length >= minsize
+
+    def compress(self, coding, level=6):
+        """
+        Compress the response with coding "gzip" or "deflate"
+        Written data is compressed now so the content length is known,
+        a stream is compressed chunk by chunk while it is sent
+        """
+        wbits = zlib.MAX_WBITS
+        if coding == "gzip":
+            wbits += 16
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        if self._file is not None and self._stream is None:
+            # compressed while it is read, the length is not known
+            self._stream = readFile(self._file)
+            self._file = None
+        if self._stream is None:
+            out = [self._compressor.compress(data) for data in self._out]
+            out.append(self._compressor.flush())
+            self._out = [data for data in out if data]
+            self.content_length = sum(len(data) for data in self._out)
+            self._compressor = None
+        self.addHeader("Content-Encoding", coding)
+        if not any(header == "Vary" and "Accept-Encoding" in value for header, value in self.headers):
+            self.addHeader("Vary", "Accept-Encoding")
+
+    def _iter(self):
         for line in self._out:
             yield line
+        if self._file is not None:
+            yield from readFile(self._file)
+        if self._stream is not None:
+            for data in self._stream:
+                if isinstance(data, str):
+                    data = data.encode(self.content_encoding)
+                yield data
+
+    def iter(self):
+        if self._compressor is None:
+            return self._iter()
+        return self._iterCompressed()
+
+    def _iterCompressed(self):
+        compressor = self._compressor
+        for data in self._iter():
+            # sync flush, so each chunk reaches the client without delay
+            data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
 
 
 # These are mostly for IDEs so they can autocomplete classes
@@ -421,6 +781,4 @@ if 0:
     log = None
     db = basium.Basium()
     app = App()
-    request = Request()
-    response = Response()
     
\ No newline at end of file
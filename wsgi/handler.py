@@ -33,7 +33,13 @@ Can handle static files and importing and running python modules
 
 import os
 import sys
+import time
+import asyncio
+import inspect
+import socket
+import signal
 import threading
+import concurrent.futures
 import traceback
 import mimetypes
 import wsgiref.simple_server
@@ -44,6 +50,7 @@ import basium
 
 import wsgi.common
 import wsgi.view
+import wsgi.asyncserver
 
 if __name__.startswith("_mod_wsgi_"):
     # Running under wsgi, apache writes the date&time info so we don't
@@ -66,9 +73,43 @@ class URLRouter:
       absdir    absolute path in filesystem to file directory
       file      name of file to read
       path      rest of url after file
+
+    The entries of each directory are cached. In development mode a
+    directory is listed again when its modification time changes, in
+    production mode the cache is used as is
     """
-    def __init__(self, documentroot):
+    def __init__(self, documentroot, app=None):
         self.documentroot = documentroot
+        self.app = app
+        self._dirs = {}     # key is directory, value is (mtime, subdirectories, entries)
+
+    def listDir(self, path):
+        """Returns the subdirectories and entries in directory path"""
+        entry = self._dirs.get(path)
+        if entry is not None and self.app is not None and self.app.production:
+            return entry[1], entry[2]
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return (), ()
+        if entry is not None and entry[0] == mtime:
+            return entry[1], entry[2]
+        dirs = set()
+        names = set()
+        with os.scandir(path) as it:
+            for e in it:
+                if e.is_symlink() and not os.path.exists(e.path):
+                    continue    # broken link
+                names.add(e.name)
+                if e.is_dir():
+                    dirs.add(e.name)
+        self._dirs[path] = (mtime, dirs, names)
+        return dirs, names
+
+    def prebuild(self):
+        """List all directories, used at startup in production mode"""
+        for dirpath, dirnames, filenames in os.walk(self.documentroot, followlinks=True):
+            self.listDir(dirpath)
 
     def route(self, url):
         r = URLRouterResponse()
@@ -76,36 +117,36 @@ class URLRouter:
         r.file = None
         r.path = "/"
 
-        u = list(filter(None, url.split("/")))
+        u = [p for p in url.split("/") if p and p != "."]
 
         # check each path of url and walk down directories
+        dirs, names = self.listDir(r.abspath)
         ix = 0
         while ix < len(u):
-            if not os.path.isdir(r.abspath + os.sep + u[ix]):
+            if u[ix] not in dirs:
                 break
             r.abspath += os.sep + u[ix]
+            dirs, names = self.listDir(r.abspath)
             ix += 1
-            continue
         r.absdir = r.abspath
 
         # check for file name
         if ix < len(u):
-            tmp = r.abspath + os.sep + u[ix]
-            if os.path.exists(tmp):
+            if u[ix] in names:
                 r.file = u[ix]
-                r.abspath = tmp
+                r.abspath += os.sep + u[ix]
                 ix += 1
-            elif os.path.exists(tmp + ".py"):
+            elif u[ix] + ".py" in names:
                 r.file = u[ix] + ".py"
-                r.abspath = tmp + ".py"
+                r.abspath += os.sep + r.file
                 ix += 1
             else:
                 return r    # error, a path is specified but there is no file
         else:
-            if os.path.exists(r.abspath + os.sep + "index.py"):
+            if "index.py" in names:
                 r.file = "index.py"  # no file specified, use default
                 r.abspath += os.sep + r.file
-            elif os.path.exists(r.abspath + os.sep + "index.html"):
+            elif "index.html" in names:
                 r.file = "index.html"  # no file specified, use default
                 r.abspath += os.sep + r.file
             else:
@@ -133,131 +174,474 @@ class AppServer:
     def __init__(self, app=None):
         builtins.app = app
         self.app = app
-        self.urlrouter = URLRouter(self.app.controller_dir)
-        self.request = None
-        self.response = None
+        self.urlrouter = URLRouter(self.app.controller_dir, app=self.app)
+        if self.app.production:
+            self.urlrouter.prebuild()
+        self.moduleCache = wsgi.common.ModuleCache(self.app)
         sys.path.insert(0, self.app.controller_dir)
-        self.app._reload = 1    # during development
-
-    def handleRequest(self, environ):
-        self.response = wsgi.common.Response()
-        self.request = wsgi.common.Request()
-        self.request.path = environ["PATH_INFO"]
-        self.request.content_type = environ["CONTENT_TYPE"]
-
-        ur = self.urlrouter.route(self.request.path)
+        wsgi.common.captureOutput()     # print() in pages goes to the response
+
+        # Drivers that are not threadSafe share one connection, requests
+        # that can use the database are then handled one at a time, see
+        # __call__(). The SQL drivers have one connection per thread
+        self.lock = None
+        self.reloadLock = threading.Lock()     # development mode, see handleRequest()
+        driver = getattr(self.app.db, "driver", None)
+        if driver is not None and not driver.threadSafe:
+            self.lock = threading.Lock()
+
+    def handleRequest(self, context, environ):
+        """
+        Handle one request, runs in the context of the request
+        Nothing is stored in self, so requests can be handled concurrently
+        In development mode, modules are unloaded after each request,
+        the controllers then run one at a time
+        """
+        request = context.request
+        response = context.response
+        request.path = environ["PATH_INFO"]
+        request.content_type = environ["CONTENT_TYPE"]
+        for key, val in environ.items():
+            if key.startswith("HTTP_"):
+                request.headers[key[5:].replace("_", "-").title()] = val
+        request.accept = environ.get("HTTP_ACCEPT")
+
+        ur = self.urlrouter.route(request.path)
         if ur.file is None:
             return False
 
         mimetype = mimetypes.guess_type(ur.abspath)
         if mimetype[0] != None:
-            self.response.content_type = mimetype[0]
-        if self.response.content_type == 'text/x-python':
-            # import and execute code in the file
+            response.content_type = mimetype[0]
+        if response.content_type == 'text/x-python':
+            if self.app._reload:
+                # modules imported by the controller are unloaded after the
+                # request, so controllers run one at a time
+                with self.reloadLock:
+                    return self.callController(context, environ, ur)
+            return self.callController(context, environ, ur)
+        else:
+            # static file, read while it is sent
+            if response.content_type.startswith("image/"):
+                response.content_encoding = None    # always binary
+            # else assumes file is in utf-8 format
+            response.sendFile(open(ur.abspath, 'rb'))
+        return True
 
-            # we store these in self.request for easy access
-            for attr, key in self.copy_headers.items():
-                setattr(self.request, attr, environ[key])
-            self.request.environ = environ
+    def callController(self, context, environ, ur):
+        """
+        Import the controller file and call the function for the route
+        Returns False if there is no function for the path
+        """
+        request = context.request
+        response = context.response
 
-            self.response.content_type = 'text/html'
+        # we store these in request for easy access
+        for attr, key in self.copy_headers.items():
+            setattr(request, attr, environ[key])
+        request.environ = environ
 
-            if self.app._reload:
-                current_modules = sys.modules.copy()
-            old_stdout = sys.stdout
-            old_stderr = sys.stderr
+        response.content_type = 'text/html'
 
-            sys.stdout = self.response  # catch all output as html code
-            sys.stderr = self.response  # catch all output as html code
+        if self.app._reload:
+            current_modules = sys.modules.copy()
 
-            module_name = wsgi.common.pathToPythonModule(self.app.controller_dir, ur.abspath)
+        module_name = wsgi.common.pathToPythonModule(self.app.controller_dir, ur.abspath)
 
-            try:
+        try:
+            if self.app._reload:
                 extpage = wsgi.common.importFile(ur.abspath)
                 self.app.freezePageRoutes(module_name)
-            except ImportError as err:
-                log.debug("Can't import file %s, error %s" % (ur.abspath, err))
-                return False
-
-            extpage.log = log
-            extpage.app = self.app
-            extpage.db = self.app.db
-            extpage.request = self.request
-            extpage.response = self.response
-
-            func, kwargs = self.app.getMethodFunction(module_name, ur.path, self.request)
-            if func is None:
-                log.debug("  Cant find route for path %s in file %s" %
-                          (ur.path, ur.file))
-                return False  # no function to call found, return error
-            log.debug("Call function %s() in %s" % (func.__name__, ur.abspath))
-            try:
-                os.chdir(self.app.documentroot)
-                func(self.request, self.response, **kwargs)
-            except:     # yes, we catch all errors
-                # todo: make this a custom error page
-                # todo: if debug, show additional info, stacktrace
-                self.response.content_type = 'text/plain'
-                traceback.print_exc()
-                sys.stdout = old_stdout
-                sys.stderr = old_stderr
-                traceback.print_exc()
-            finally:
-                sys.stdout = old_stdout
-                sys.stderr = old_stderr
-
-            # unload any dynamically imported modules
-            # todo: add a debug/devel flag, only needed during development
-            if self.app._reload:
-                modules_to_unload = list(set(sys.modules) - set(current_modules))
-                log.debug("Unloading modules %s" % ", ".join(modules_to_unload))
-                for module in modules_to_unload:
-                    del(sys.modules[module])
-                # clear the Page() in the module routes
-                self.app.flushePageRoutes(module_name)
-
-        else:
-            f = open(ur.abspath, 'rb')
-            data = f.read()
-            if self.response.content_type.startswith("image/"):
-                self.response.write(data, encoding=False)  # always binary
-                self.response.content_encoding = None
             else:
-                # assumes file is in utf-8 format
-                self.response.write(data, encoding=False)
-            f.close()
+                extpage = self.moduleCache.get(ur.abspath, module_name)
+        except ImportError as err:
+            log.debug("Can't import file %s, error %s" % (ur.abspath, err))
+            return False
+
+        # request and response are wsgi.common.ContextAttr, from the
+        # import of wsgi.common, and refers to the current request
+        extpage.log = log
+        extpage.app = self.app
+        extpage.db = self.app.db
+
+        func, kwargs = self.app.getMethodFunction(module_name, ur.path, request)
+        if func is None:
+            log.debug("  Cant find route for path %s in file %s" %
+                      (ur.path, ur.file))
+            return False  # no function to call found, return error
+        log.debug("Call function %s() in %s" % (func.__name__, ur.abspath))
+        try:
+            os.chdir(self.app.documentroot)
+            result = func(request, response, **kwargs)
+            if inspect.isawaitable(result):
+                context.pending = result    # async controller, see callAsync()
+        except:     # yes, we catch all errors
+            self.controllerError(response)
+
+        # unload any dynamically imported modules, in development mode
+        if self.app._reload:
+            modules_to_unload = list(set(sys.modules) - set(current_modules))
+            log.debug("Unloading modules %s" % ", ".join(modules_to_unload))
+            for module in modules_to_unload:
+                del(sys.modules[module])
+            # clear the Page() in the module routes
+            self.app.flushePageRoutes(module_name)
         return True
 
-    def handleError(self):
+    def controllerError(self, response):
+        """The controller raised an exception"""
+        # todo: make this a custom error page
+        # todo: if debug, show additional info, stacktrace
+        response.content_type = 'text/plain'
+        traceback.print_exc()   # to the response
+        traceback.print_exc(file=sys.__stderr__)
+
+    async def callAsync(self, context):
+        """
+        Await the coroutine returned by an async controller
+        Must run in the context of the request
+        """
+        try:
+            await context.pending
+        except:
+            self.controllerError(context.response)
+        finally:
+            context.pending = None
+
+    def handleError(self, response):
         """File does not exist"""
-        self.response._out = []
-        self.response.write("404 Page not found\n")
-        self.response.status_code = "404 Page not found"
+        response._out = []
+        response.write("404 Page not found\n")
+        response.status_code = "404 Page not found"
 
     def __call__(self, environ, start_response):
         """
         Main entrypoint for HTTP requests
+        With the lock, it is held while the controller runs. A body in
+        memory is sent after the lock is released, a stream is generated
+        from the database while it is sent and keeps the lock until the
+        server calls close(), see LockedResult
+        """
+        if self.lock is None or self.isStatic(environ["PATH_INFO"]):
+            return self.handle(environ, start_response)
+        self.lock.acquire()
+        try:
+            context = self.begin(environ)
+            if context.pending is not None:
+                context.run(asyncio.run, self.callAsync(context))
+            status, headers, result = self.finish(context, environ)
+            start_response(status, headers)
+        except:
+            self.lock.release()
+            raise
+        if context.response.isStream() and environ["REQUEST_METHOD"] != "HEAD":
+            return LockedResult(result, self.lock)
+        self.lock.release()
+        return result
+
+    def isStatic(self, path):
+        """True if path is a file that is sent as is, not a controller"""
+        ur = self.urlrouter.route(path)
+        return ur.file is not None and mimetypes.guess_type(ur.abspath)[0] != "text/x-python"
+
+    def handle(self, environ, start_response):
+        context = self.begin(environ)
+        if context.pending is not None:
+            # no event loop in a WSGI server, run one for this request
+            context.run(asyncio.run, self.callAsync(context))
+        status, headers, result = self.finish(context, environ)
+        start_response(status, headers)
+        return result
+
+    def begin(self, environ):
+        """
+        Find and call the controller for the request, returns the
+        RequestContext. If the controller is async its coroutine is in
+        context.pending, and must be awaited with callAsync()
         """
         log.debug("basium_wsgihandler.__call__(), PATH_INFO %s" %
                   environ["PATH_INFO"])
 
-        if not self.handleRequest(environ):
-            self.handleError()
+        response = wsgi.common.Response()
+        context = wsgi.common.RequestContext(self.app, wsgi.common.Request(), response)
+        if not context.run(self.handleRequest, context, environ):
+            self.handleError(response)
+        return context
 
-        self.response.content_type += "; charset=utf-8"
-        self.response.addHeader('Content-type', self.response.content_type)
-        self.response.addHeader('Content-Length', str(self.response.content_length))
+    def finish(self, context, environ):
+        """
+        Complete the response, returns status, headers and an iterable
+        with the body
+        """
+        response = context.response
+        coding = wsgi.common.acceptEncoding(environ.get("HTTP_ACCEPT_ENCODING"))
+        if coding and self.app.compressLevel and \
+                response.compressible(self.app.compressMinSize):
+            response.compress(coding, self.app.compressLevel)
+
+        if response.content_encoding:
+            response.content_type += "; charset=%s" % response.content_encoding
+        response.addHeader('Content-type', response.content_type)
+        if not response.isStream():
+            response.addHeader('Content-Length', str(response.content_length))
+
+        if environ["REQUEST_METHOD"] == "HEAD":
+            response.close()    # headers only, the body is not read
+            return response.status_code, response.headers, []
+        if response.isStream():
+            # the stream is generated after we return, in the request context
+            return response.status_code, response.headers, context.iter(response.iter())
+        f = response.getFile()
+        if f is not None and "wsgi.file_wrapper" in environ:
+            # the server can send the file with sendfile()
+            return response.status_code, response.headers, \
+                environ["wsgi.file_wrapper"](f, wsgi.common.FILE_CHUNK)
+        return response.status_code, response.headers, response.iter()
+
+
+class LockedResult:
+    """
+    WSGI response that holds a lock until it is sent. The server calls
+    close() when done, also if sending fails
+    """
+    def __init__(self, result, lock):
+        self.result = result
+        self.lock = lock
+
+    def __iter__(self):
+        return iter(self.result)
 
-        start_response(self.response.status_code, self.response.headers)
-        return self.response.iter()
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            self.lock.release()
 
 
 class WSGIloghandler(wsgiref.simple_server.WSGIRequestHandler):
     """log to db handler"""
+    def setup(self):
+        # socket timeout, a client that stops sending or reading is dropped
+        self.timeout = getattr(self.server, "requestTimeout", None)
+        super().setup()
+
     def log_message(self, *args):
         log.info(args[0] % args[1:])
 
 
+def productionMode(app):
+    """
+    Switch app to production mode. In development mode modules are
+    reloaded on each request, and the controllers run one at a time
+    """
+    if app is not None and not app.production:
+        log.warning("Development mode does not handle requests concurrently, using production mode")
+        app.production = True
+
+
+class ThreadPoolServer(wsgiref.simple_server.WSGIServer):
+    """
+    WSGI server that handles requests in a pool of threads
+    An AppServer application is switched to production mode
+      threads     number of requests handled at the same time
+      backlog     connections waiting to be accepted. At most backlog
+                  accepted connections wait for a thread, then the server
+                  stops accepting until a thread is free
+      timeout     seconds before a silent client is disconnected
+      reusePort   bind with SO_REUSEPORT, so several processes can
+                  listen on the same port
+      sock        use this listening socket, shared with other processes
+    """
+    def __init__(self, server_address, handler_class=WSGIloghandler, threads=8, backlog=64,
+                 timeout=30, reusePort=False, sock=None):
+        self.request_queue_size = backlog
+        self.requestTimeout = timeout
+        self.reusePort = reusePort
+        self.requests = 0
+        super().__init__(server_address, handler_class, bind_and_activate=sock is None)
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+            host, port = self.server_address[:2]
+            self.server_name = socket.getfqdn(host)
+            self.server_port = port
+            self.setup_environ()
+            # all processes wait for the socket, only one gets the connection
+            sock.setblocking(False)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="wsgi")
+        self.slots = threading.BoundedSemaphore(threads + backlog)
+
+    def set_app(self, application):
+        productionMode(getattr(application, "app", None))
+        super().set_app(application)
+
+    def server_bind(self):
+        if self.reusePort:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def _handle_request_noblock(self):
+        # accept only when a slot is free, excess connections then wait in
+        # the listen queue. The timeout lets serve_forever() see shutdown()
+        if not self.slots.acquire(timeout=0.5):
+            return
+        self.submitted = False
+        try:
+            super()._handle_request_noblock()
+        finally:
+            if not self.submitted:
+                self.slots.release()
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.processRequestThread, request, client_address)
+        self.submitted = True
+        self.requests += 1
+
+    def processRequestThread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        """Stop listening, and wait for the requests being handled"""
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+class PreforkServer:
+    """
+    Runs the application in worker processes, each a ThreadPoolServer
+    The workers share one listening socket, or with reusePort each
+    binds its own and the kernel distributes the connections
+
+    Workers that exit are started again. A worker exits after
+    maxRequests requests if set, to release memory
+      SIGHUP           restart the workers, one at a time. A worker
+                       finishes the requests it has accepted before it exits
+      SIGTERM, SIGINT  stop all workers and exit
+
+    The application is switched to production mode. The workers are
+    forked from this process after the application is loaded. Each
+    worker connects to the database again, the database should not be
+    used in this process after serve() is called. The change sequence
+    of tables with _trackChanges is allocated in the database, so all
+    workers can store to them
+    """
+
+    def __init__(self, app, host="0.0.0.0", port=8051, workers=2, threads=8, backlog=64,
+                 timeout=30, reusePort=False, maxRequests=0):
+        productionMode(app)
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.backlog = backlog
+        self.timeout = timeout
+        self.reusePort = reusePort
+        self.maxRequests = maxRequests
+        self.sock = None
+        self.pids = set()
+        self.running = False
+        self.restarting = []    # workers to restart, one at a time
+        self.stopping = None    # pid of the worker being restarted
+
+    def serve(self):
+        if not self.reusePort:
+            self.sock = socket.create_server((self.host, self.port), backlog=self.backlog)
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.restart)
+        log.info("Starting %d workers with %d threads, on %s:%d" % (self.workers, self.threads, self.host, self.port))
+        for i in range(self.workers):
+            self.startWorker()
+        while self.running:
+            self.reap()
+            if self.restarting and self.stopping is None:
+                self.stopping = self.restarting.pop()
+                self.kill(self.stopping, signal.SIGTERM)
+            time.sleep(0.2)
+
+        for pid in self.pids:
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.timeout
+        while self.pids and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.pids:
+            self.kill(pid, signal.SIGKILL)
+        if self.sock is not None:
+            self.sock.close()
+        log.info("WSGI server stopped")
+
+    def stop(self, signum, frame):
+        self.running = False
+
+    def restart(self, signum, frame):
+        log.info("Restarting workers")
+        self.restarting = list(self.pids)
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        """Collect exited workers, and start new ones while running"""
+        while self.pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            self.pids.discard(pid)
+            if pid == self.stopping:
+                self.stopping = None
+            if self.running:
+                self.startWorker()
+
+    def startWorker(self):
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return
+        status = 0
+        try:
+            self.runWorker()
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def runWorker(self):
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if self.app.db is not None:
+            self.app.db.driver.disconnect()
+
+        httpd = ThreadPoolServer((self.host, self.port), threads=self.threads, backlog=self.backlog,
+                                 timeout=self.timeout, reusePort=self.reusePort, sock=self.sock)
+        httpd.set_app(AppServer(app=self.app))
+        thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.5})
+        thread.start()
+        while not stop.wait(1):
+            if self.maxRequests and httpd.requests >= self.maxRequests:
+                break
+        httpd.shutdown()
+        thread.join()
+        httpd.server_close()
+
+
 class Server(threading.Thread):
     """
     Standalone WSGI server
@@ -267,12 +651,13 @@ class Server(threading.Thread):
     Note: Does not implement authentification, not suitable for production
     """
 
-    def __init__(self, basium=None, documentroot=None, host='0.0.0.0', port=8051):
+    def __init__(self, basium=None, documentroot=None, host='0.0.0.0', port=8051, asyncServer=False):
         super(Server, self).__init__()
         self.running = True
         self.ready = False
         self.host = host
         self.port = port
+        self.asyncServer = asyncServer
         if documentroot is None:
             documentroot = os.path.dirname(os.path.abspath(sys.argv[0]))
         self.app = wsgi.common.App(documentroot=documentroot, db=basium)
@@ -283,6 +668,9 @@ class Server(threading.Thread):
         log.info("Using %s as documentroot" % self.app.documentroot)
 
         appServer = AppServer(app=self.app)
+        if self.asyncServer:
+            asyncio.run(self.runAsync(appServer))
+            return
 
         # Instantiate the WSGI server.
         # It will receive the request, pass it to the application
@@ -300,6 +688,15 @@ class Server(threading.Thread):
         self.ready = False
         self.log.info("WSGI server stopping")
 
+    async def runAsync(self, appServer):
+        server = wsgi.asyncserver.AsyncServer(appServer, host=self.host, port=self.port)
+        await server.start()
+        self.ready = True
+        while self.running:
+            await asyncio.sleep(0.5)
+        await server.stop()
+        self.ready = False
+
 
 if __name__ == "__main__":
     import argparse
@@ -317,6 +714,22 @@ if __name__ == "__main__":
     parser.add_argument("--dbname",   dest="dbname",   default="basium_db")
     parser.add_argument("--dbuser",   dest="dbuser",   default="basium_user")
     parser.add_argument("--dbpass",   dest="dbpass",   default="secret")
+    parser.add_argument("--production", dest="production", action="store_true",
+                        help="cache imported controller modules")
+    parser.add_argument("--server",   dest="server",   default="simple",
+                        choices=["simple", "threaded", "prefork", "async"],
+                        help="simple handles one request at a time")
+    parser.add_argument("--workers",  dest="workers",  default=2, type=int,
+                        help="worker processes, prefork server")
+    parser.add_argument("--threads",  dest="threads",  default=8, type=int,
+                        help="threads per process, threaded, prefork and async server")
+    parser.add_argument("--backlog",  dest="backlog",  default=64, type=int)
+    parser.add_argument("--timeout",  dest="timeout",  default=30, type=int,
+                        help="seconds before an idle client is disconnected")
+    parser.add_argument("--reuseport", dest="reusePort", action="store_true",
+                        help="each worker binds the port with SO_REUSEPORT")
+    parser.add_argument("--max-requests", dest="maxRequests", default=0, type=int,
+                        help="restart a worker after this many requests")
     
     args = parser.parse_args()
     # (opt, args) = parser.parse_args()
@@ -326,6 +739,7 @@ if __name__ == "__main__":
         print("  %13s: %s" % (key, getattr(args, key)))
 
     app = wsgi.common.App(documentroot=args.documentroot)
+    app.production = args.production
 
     app.dbconf = basium.DbConf(host=args.host, port=args.port, username=args.dbuser, password=args.dbpass, database=args.dbname)
 
@@ -335,6 +749,19 @@ if __name__ == "__main__":
     if not app.db.start():
         log.error("Cannot start database driver for wsgi server")
 
-    appServer = AppServer(app=app)
-    httpd = wsgiref.simple_server.make_server(args.host, args.port, appServer, handler_class=WSGIloghandler)
-    httpd.serve_forever()
+    if args.server == "prefork":
+        PreforkServer(app, host=args.host, port=args.port, workers=args.workers, threads=args.threads,
+                      backlog=args.backlog, timeout=args.timeout, reusePort=args.reusePort,
+                      maxRequests=args.maxRequests).serve()
+    elif args.server == "async":
+        wsgi.asyncserver.AsyncServer(AppServer(app=app), host=args.host, port=args.port, threads=args.threads,
+                                     backlog=args.backlog, timeout=args.timeout).serve()
+    elif args.server == "threaded":
+        httpd = ThreadPoolServer((args.host, args.port), threads=args.threads, backlog=args.backlog,
+                                 timeout=args.timeout)
+        httpd.set_app(AppServer(app=app))
+        httpd.serve_forever()
+    else:
+        appServer = AppServer(app=app)
+        httpd = wsgiref.simple_server.make_server(args.host, args.port, appServer, handler_class=WSGIloghandler)
+        httpd.serve_forever()
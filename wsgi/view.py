@@ -33,6 +33,7 @@ Template engine
 import os
 import sys
 import io
+import tempfile
 import collections
 
 import wsgi.common
@@ -286,9 +287,22 @@ class CompileView:
     def save(self, module_name, module_file):
         """
         Save the compiled template to disk
+        The module is written to a temporary file that replaces module_file
+        when complete, so a concurrent request never loads a partial module
+        """
+        fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(module_file))
+        try:
+            with os.fdopen(fd, "w") as f:
+                self.write(module_name, f)
+            os.replace(tmpname, module_file)
+        except:
+            os.remove(tmpname)
+            raise
+
+    def write(self, module_name, f):
+        """
+        Write the compiled template as python code to file f
         """
-        self.module_file = open(module_file, "w")
-        f = self.module_file   # less typing
         f.write("#!/usr/bin/env python3\n")
         f.write("\n")
         f.write("# This file is generated, do not edit changes will be lost\n")
@@ -301,16 +315,15 @@ class CompileView:
         f.write("def out_safe(msg):\n")
         f.write("    if msg: sys.stdout.write( html.escape( str(msg) ) )\n")
         f.write("\n")
-        tmp = ""
         if self.extends:
-            tmp = "%s" % os.path.splitext(self.extends)[0].replace("/", ".")
-            import_cls = tmp.rsplit(".", 1)
-            # import_cls[-1] = import_cls[-1].capitalize()
-            f.write("import %s\n" % ".".join(import_cls))
+            # the parent view is loaded in its own namespace, see loadView()
+            f.write("import wsgi.view\n")
+            f.write("\n")
+            f.write("_base = wsgi.view.loadView(%r)\n" % os.path.splitext(self.extends)[0])
             f.write("\n")
         f.write("class %s" % (module_name.capitalize()))
-        if tmp:
-            f.write("(%s.%s)" % (tmp, import_cls[-1].capitalize()))
+        if self.extends:
+            f.write("(_base)")
         f.write(":\n")
         f.write("\n")
         
@@ -349,7 +362,6 @@ class CompileView:
         f.write("    %s()\n" % module_name)
         f.write("\n")
         # f.write("sys.modules[__name__] = %s()\n" % module_name.capitalize())
-        self.module_file.close()
 
     def compileFile(self, view_filename_rel, **kwargs):
         """
@@ -365,8 +377,7 @@ class CompileView:
         module_name = os.path.splitext(module_name)[0]
         module_file = os.path.join(app.view_code_dir, module_dir, module_name) + ".py"
         module_full_dir = os.path.dirname(module_file)
-        if not os.path.exists(module_full_dir):
-            os.makedirs(module_full_dir)
+        os.makedirs(module_full_dir, exist_ok=True)
 
         if not app._reload:
             if os.path.exists(module_file):
@@ -389,25 +400,40 @@ class CompileView:
         return module_name, module_file
 
 
+_codeCache = {}    # key is compiled view file, value is (mtime, code)
+
+
+def loadView(view_name):
+    """
+    Run the compiled view in a new namespace and return the view class
+    view_name is the view file relative to app.view_dir, without .html
+    The view sets the variables passed to it as globals, each render
+    gets its own namespace so views can be rendered concurrently
+    """
+    module_file = os.path.join(app.view_code_dir, view_name) + ".py"
+    mtime = os.path.getmtime(module_file)
+    entry = _codeCache.get(module_file)
+    if entry is None or entry[0] != mtime:
+        with open(module_file, "r") as f:
+            entry = (mtime, compile(f.read(), module_file, "exec"))
+        _codeCache[module_file] = entry
+    namespace = {"__name__": "view." + view_name.replace("/", "."), "__file__": module_file,
+                 "log": log, "db": app.db}
+    exec(entry[1], namespace)
+    return namespace[os.path.basename(view_name).capitalize()]
+
+
 def render(view_filename, request, response, **kwargs):
     """
     Compile the view to a python module
-    Import and run the module to generate output
+    Run the module to generate output, print() and out() writes to the
+    response of the current request
     """
     log.debug("view.render(view_filename='%s')" % (view_filename))
     compile_view = CompileView()
-    module_name, module_file = compile_view.compileFile(view_filename, **kwargs)
-
-    # We now have a python module, import it
-    # We add the view_code_dir as the first entry in pythonpath,
-    # which makes it possible for compiled modules to find each other
-    with wsgi.common.AddSysPath(app.view_code_dir):
-        mod = wsgi.common.importFile(module_file)
-    mod.log = log
-    mod.db = app.db
-
-    cls = getattr(mod, module_name.capitalize())
-    
+    compile_view.compileFile(view_filename, **kwargs)
+    cls = loadView(os.path.splitext(view_filename)[0])
+
     # we ignore the object instance
     cls(request=request, response=response, **kwargs)
 